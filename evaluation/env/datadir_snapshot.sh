@@ -0,0 +1,151 @@
+#!/bin/bash
+# Prebuilt data-directory snapshots, so a fresh stack starts from an archive
+# instead of loading every template from its dumps.
+#
+#   capture <postgresql|mysql> [version]   (host, next to docker-compose.yml)
+#       Record a checksum per template of the running service, checkpoint it,
+#       stop it cleanly, archive its data directory to
+#       datadir_snapshots/<dialect>-<version>.tar.gz with a
+#       <dialect>-<version>.manifest.json (image, sha256 of the archive,
+#       template checksums), and start it again.
+#
+#   verify <postgresql|mysql> <manifest>   (host)
+#       Compare the template checksums of the running service with a manifest.
+#
+#   restore                                (in the <dialect>_seed service)
+#       Extract /snapshots/$DATADIR_SNAPSHOT into the empty data volume
+#       mounted at /data, after checking its sha256 against the manifest.
+#       The database then starts on it and skips its init scripts. Nothing is
+#       done when DATADIR_SNAPSHOT is empty or the volume is initialized.
+set -e
+
+SNAPSHOT_DIR="${SNAPSHOT_DIR:-./datadir_snapshots}"
+ARCHIVE_IMAGE="debian:bookworm-slim"
+
+service_datadir() {
+  case "$1" in
+    postgresql) echo "/var/lib/postgresql/data" ;;
+    mysql) echo "/var/lib/mysql" ;;
+    *) echo "Unknown dialect: $1 (postgresql or mysql)" >&2; return 1 ;;
+  esac
+}
+
+# SQL from stdin, tab-separated rows out
+psql_exec() {
+  docker compose exec -T postgresql psql -U root -d "$1" -tA
+}
+
+mysql_exec() {
+  docker compose exec -T mysql sh -c 'mysql -u root -p"${MYSQL_ROOT_PASSWORD}" -N -B' 2>/dev/null
+}
+
+# One "<template> <checksum>" line per template, independent of row order
+template_checksums() {
+  local dialect="$1" template tables
+  if [[ "${dialect}" == "postgresql" ]]; then
+    for template in $(echo "SELECT datname FROM pg_database WHERE datname LIKE '%\_template' ORDER BY datname;" | psql_exec postgres); do
+      echo "SELECT format('SELECT %L, md5(coalesce(string_agg(h, '''' ORDER BY h), '''')) FROM (SELECT md5(t::text) AS h FROM %s t) s', c.oid::regclass, c.oid::regclass) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema') ORDER BY 1 \gexec" \
+        | psql_exec "${template}" | sort | md5sum | sed "s/ .*//; s/^/${template} /"
+    done
+  else
+    for template in $(echo "SELECT SCHEMA_NAME FROM information_schema.SCHEMATA WHERE SCHEMA_NAME LIKE '%\_template' ORDER BY SCHEMA_NAME;" | mysql_exec); do
+      tables=$(echo "SET SESSION group_concat_max_len = 1000000; SELECT GROUP_CONCAT(CONCAT(CHAR(96), TABLE_SCHEMA, CHAR(96), '.', CHAR(96), TABLE_NAME, CHAR(96)) SEPARATOR ', ') FROM information_schema.TABLES WHERE TABLE_SCHEMA = '${template}' AND TABLE_TYPE = 'BASE TABLE';" | mysql_exec)
+      echo "CHECKSUM TABLE ${tables};" | mysql_exec | sort | md5sum | sed "s/ .*//; s/^/${template} /"
+    done
+  fi
+}
+
+capture() {
+  local dialect="$1"
+  local version="${2:-$(date +%Y%m%d)}"
+  local datadir name container image checksums start
+  datadir=$(service_datadir "${dialect}")
+  name="${dialect}-${version}"
+  container=$(docker compose ps -q "${dialect}")
+  if [[ -z "${container}" ]]; then
+    echo "Service ${dialect} is not running; start it and let it initialize first." >&2
+    return 1
+  fi
+  image=$(docker inspect --format '{{.Config.Image}}' "${container}")
+  mkdir -p "${SNAPSHOT_DIR}"
+
+  echo "Computing template checksums of ${dialect}..."
+  checksums=$(template_checksums "${dialect}")
+
+  # A clean shutdown leaves nothing to replay or merge on the next start
+  echo "Checkpointing and stopping ${dialect}..."
+  if [[ "${dialect}" == "postgresql" ]]; then
+    echo "CHECKPOINT;" | psql_exec postgres
+  else
+    echo "SET GLOBAL innodb_fast_shutdown = 0;" | mysql_exec
+  fi
+  docker compose stop "${dialect}"
+
+  start=$SECONDS
+  echo "Archiving ${datadir} to ${SNAPSHOT_DIR}/${name}.tar.gz..."
+  docker run --rm --volumes-from "${container}" \
+    -v "$(cd "${SNAPSHOT_DIR}" && pwd)":/snapshots "${ARCHIVE_IMAGE}" \
+    tar --numeric-owner -C "${datadir}" -czf "/snapshots/${name}.tar.gz" .
+  docker compose start "${dialect}"
+
+  {
+    echo "{"
+    echo "  \"dialect\": \"${dialect}\","
+    echo "  \"version\": \"${version}\","
+    echo "  \"image\": \"${image}\","
+    echo "  \"created\": \"$(date -u +%Y-%m-%dT%H:%M:%SZ)\","
+    echo "  \"archive\": \"${name}.tar.gz\","
+    echo "  \"sha256\": \"$(sha256sum "${SNAPSHOT_DIR}/${name}.tar.gz" | sed 's/ .*//')\","
+    echo "  \"templates\": {"
+    echo "${checksums}" | sed 's/^\(.*\) \(.*\)$/    "\1": "\2",/; $ s/,$//'
+    echo "  }"
+    echo "}"
+  } > "${SNAPSHOT_DIR}/${name}.manifest.json"
+  echo "Captured ${name} in $((SECONDS - start))s: $(du -h "${SNAPSHOT_DIR}/${name}.tar.gz" | cut -f1)"
+  echo "Start from it with DATADIR_SNAPSHOT=${name}.tar.gz on the ${dialect}_seed service."
+}
+
+verify() {
+  local dialect="$1" manifest="$2"
+  local expected actual
+  expected=$(sed -n '/"templates"/,/}/ s/^ *"\(.*\)": "\(.*\)",\{0,1\}$/\1 \2/p' "${manifest}" | sort)
+  actual=$(template_checksums "${dialect}" | sort)
+  if [[ "${expected}" == "${actual}" ]]; then
+    echo "All $(echo "${actual}" | wc -l) template checksums match ${manifest}"
+  else
+    echo "Template checksums differ from ${manifest}:"
+    diff <(echo "${expected}") <(echo "${actual}") || true
+    return 1
+  fi
+}
+
+restore() {
+  local archive="/snapshots/${DATADIR_SNAPSHOT}"
+  local manifest="${archive%.tar.gz}.manifest.json"
+  local expected start=$SECONDS
+  if [[ -z "${DATADIR_SNAPSHOT}" ]]; then
+    echo "No DATADIR_SNAPSHOT set; the database initializes from its dumps."
+    return 0
+  fi
+  if [[ -n "$(ls -A /data)" ]]; then
+    echo "Data directory already initialized; not restoring ${DATADIR_SNAPSHOT}."
+    return 0
+  fi
+  expected=$(sed -n 's/^ *"sha256": "\(.*\)",$/\1/p' "${manifest}")
+  if [[ "$(sha256sum "${archive}" | sed 's/ .*//')" != "${expected}" ]]; then
+    echo "${archive} does not match the sha256 in ${manifest}" >&2
+    return 1
+  fi
+  tar --numeric-owner -C /data -xzf "${archive}"
+  echo "Restored ${DATADIR_SNAPSHOT} in $((SECONDS - start))s"
+}
+
+case "$1" in
+  capture) capture "$2" "$3" ;;
+  verify) verify "$2" "$3" ;;
+  restore) restore ;;
+  *)
+    echo "Usage: $0 capture <postgresql|mysql> [version] | verify <postgresql|mysql> <manifest> | restore" >&2
+    exit 1
+    ;;
+esac
@@ -22,7 +22,7 @@ BACKUP_DIR="/app/mssql_table_dumps"
 if [ ! -d "$BACKUP_DIR" ]; then
   echo "Warning: Directory $BACKUP_DIR does not exist or is not mounted, cannot automatically restore databases (.bak)."
   echo "If you need to restore databases from .bak files, please place them in $BACKUP_DIR inside the container."
-  # Can exit directly with exit 1 or keep bcp logic as fallback
+  echo "They can also be built from bcp data files: run src/bootstrap_mssql.py in the evaluation container."
   exit 0
 fi
 
@@ -32,7 +32,7 @@ BAK_FILES=("$BACKUP_DIR"/*.bak)
 
 if [ ${#BAK_FILES[@]} -eq 0 ]; then
   echo "Warning: No .bak files found in $BACKUP_DIR, skipping restoration."
-  # Can also fallback to original bcp method here
+  echo "Build them from bcp data files with src/bootstrap_mssql.py in the evaluation container."
   exit 0
 fi
 
@@ -68,11 +68,155 @@ import_db_dump() {
 }
 
 # ------------------------------------------------------------------------------
-# 4. Import each template database from its dump file
+# 3b. Bulk-load path: a template imported from its dump is converted once into
+#     ${BULK_PATH}/<db>/ (mount it to keep it across containers):
+#
+#       schema.sql      tables, views, routines and events, without triggers
+#       triggers.sql    triggers, created after the data as in the dump
+#       <table>.txt     rows (SELECT ... INTO OUTFILE) of the columns listed
+#       <table>.columns in <table>.columns (generated columns are left out)
+#       .checksums      CHECKSUM TABLE of every table after the dump import
+#
+#     Later bootstraps create the schema, LOAD DATA LOCAL INFILE the tables
+#     LOAD_JOBS at a time, and compare the table checksums with the dump's; on
+#     a mismatch the template is imported from its dump again. The redo log,
+#     binary logging, foreign-key and unique checks are off only while loading.
 # ------------------------------------------------------------------------------
-echo "Importing template databases from dump files..."
+BULK_PATH="${MYSQL_BULK_PATH:-/var/lib/mysql-files/bird_bulk}"
+LOAD_JOBS="${LOAD_JOBS:-4}"
+
+mysql_root() {
+  mysql -u root -p"${MYSQL_ROOT_PASSWORD}" "$@"
+}
+
+table_checksums() {
+  local db_name="$1"
+  local tables
+  tables=$(mysql_root -N -B -e "SET SESSION group_concat_max_len = 1000000; SELECT GROUP_CONCAT(CONCAT(CHAR(96), TABLE_SCHEMA, CHAR(96), '.', CHAR(96), TABLE_NAME, CHAR(96)) SEPARATOR ', ') FROM information_schema.TABLES WHERE TABLE_SCHEMA = '${db_name}' AND TABLE_TYPE = 'BASE TABLE';")
+  if [[ "${tables}" != "NULL" ]]; then
+    mysql_root -N -B -e "CHECKSUM TABLE ${tables};" | sort
+  fi
+}
+
+convert_dump() {
+  local db_name="$1"
+  local dir="${BULK_PATH}/${db_name}"
+  local secure_dir
+  secure_dir=$(mysql_root -N -B -e "SELECT @@secure_file_priv;")
+  if [[ -z "${secure_dir}" || "${secure_dir}" == "NULL" ]]; then
+    echo "  [WARN] secure_file_priv is disabled, cannot convert ${db_name} for bulk loading"
+    return 1
+  fi
+
+  echo "  - Converting ${db_name} to bulk-load files in ${dir}"
+  rm -rf "${dir}"
+  mkdir -p "${dir}"
+  mysqldump -u root -p"${MYSQL_ROOT_PASSWORD}" --no-data --skip-triggers --routines --events "${db_name}" > "${dir}/schema.sql" || return 1
+  mysqldump -u root -p"${MYSQL_ROOT_PASSWORD}" --no-data --no-create-info --triggers "${db_name}" > "${dir}/triggers.sql" || return 1
+
+  local tables table columns outfile
+  tables=$(mysql_root -N -B -e "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = '${db_name}' AND TABLE_TYPE = 'BASE TABLE';") || return 1
+  while IFS= read -r table; do
+    [[ -n "${table}" ]] || continue
+    columns=$(mysql_root -N -B -e "SET SESSION group_concat_max_len = 1000000; SELECT GROUP_CONCAT(CONCAT(CHAR(96), COLUMN_NAME, CHAR(96)) ORDER BY ORDINAL_POSITION SEPARATOR ', ') FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '${db_name}' AND TABLE_NAME = '${table}' AND COALESCE(GENERATION_EXPRESSION, '') = '';") || return 1
+    outfile="${secure_dir%/}/${db_name}.${table}.txt"
+    rm -f "${outfile}"
+    mysql_root -e "SELECT ${columns} INTO OUTFILE '${outfile}' CHARACTER SET utf8mb4 FROM \`${db_name}\`.\`${table}\`;" || return 1
+    mv "${outfile}" "${dir}/${table}.txt"
+    echo "${columns}" > "${dir}/${table}.columns"
+  done <<< "${tables}"
+
+  table_checksums "${db_name}" > "${dir}/.checksums" || return 1
+  touch "${dir}/.complete"
+}
+
+load_table() {
+  local db_name="$1" table="$2" data_file="$3"
+  local columns
+  columns=$(cat "${data_file%.txt}.columns")
+  mysql_root --local-infile=1 "${db_name}" -e "SET SESSION foreign_key_checks = 0, unique_checks = 0, sql_log_bin = 0; LOAD DATA LOCAL INFILE '${data_file}' INTO TABLE \`${table}\` CHARACTER SET utf8mb4 (${columns});" 2>>/tmp/error.log
+}
+
+bulk_load_db() {
+  local db_name="$1"
+  local dir="${BULK_PATH}/${db_name}"
+  local failed="/tmp/${db_name}.load_failed"
+  local start=$SECONDS data_file
+  rm -f "${failed}"
+
+  echo "  - Bulk-loading ${db_name} from ${dir}"
+  mysql_root -e "DROP DATABASE IF EXISTS \`${db_name}\`; CREATE DATABASE \`${db_name}\` DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;" || return 1
+  mysql_root "${db_name}" < "${dir}/schema.sql" 2>>/tmp/error.log || return 1
+  for data_file in "${dir}"/*.txt; do
+    [[ -e "${data_file}" ]] || continue
+    while (( $(jobs -rp | wc -l) >= LOAD_JOBS )); do
+      wait -n || true
+    done
+    load_table "${db_name}" "$(basename "${data_file}" .txt)" "${data_file}" || touch "${failed}" &
+  done
+  wait || true
+  if [[ -f "${failed}" ]]; then
+    echo "    [ERROR] Loading a table of ${db_name} failed. See /tmp/error.log"
+    return 1
+  fi
+  mysql_root "${db_name}" < "${dir}/triggers.sql" 2>>/tmp/error.log || return 1
+
+  if ! diff <(table_checksums "${db_name}") "${dir}/.checksums" >/dev/null; then
+    echo "    [ERROR] Table checksums of ${db_name} differ from its dump import"
+    return 1
+  fi
+  echo "  - Bulk-loaded ${db_name} in $((SECONDS - start))s; table checksums match the dump"
+}
+
+LOCAL_INFILE_BEFORE=""
+
+relax_durability() {
+  LOCAL_INFILE_BEFORE=$(mysql_root -N -B -e "SELECT @@GLOBAL.local_infile;")
+  mysql_root -e "SET GLOBAL local_infile = 1;"
+  mysql_root -e "ALTER INSTANCE DISABLE INNODB REDO_LOG;" \
+    || echo "  [WARN] Cannot disable the redo log; loading with it on"
+}
+
+restore_durability() {
+  mysql_root -e "ALTER INSTANCE ENABLE INNODB REDO_LOG;" || true
+  if [[ -n "${LOCAL_INFILE_BEFORE}" ]]; then
+    mysql_root -e "SET GLOBAL local_infile = ${LOCAL_INFILE_BEFORE};" || true
+  fi
+}
+
+# ------------------------------------------------------------------------------
+# 4. Import each template database (bulk load if converted, else its dump)
+# ------------------------------------------------------------------------------
+echo "Importing template databases..."
+BULK_DBS=()
+DUMP_DBS=()
 for DB_TEMPLATE in "${TEMPLATE_DBS[@]}"; do
+  if [[ -f "${BULK_PATH}/${DB_TEMPLATE}/.complete" ]]; then
+    BULK_DBS+=("${DB_TEMPLATE}")
+  else
+    DUMP_DBS+=("${DB_TEMPLATE}")
+  fi
+done
+
+if (( ${#BULK_DBS[@]} > 0 )); then
+  relax_durability
+  trap restore_durability EXIT
+  for DB_TEMPLATE in "${BULK_DBS[@]}"; do
+    if ! bulk_load_db "${DB_TEMPLATE}"; then
+      echo "  [WARN] Bulk load of ${DB_TEMPLATE} failed; importing its dump instead"
+      DUMP_DBS+=("${DB_TEMPLATE}")
+    fi
+  done
+  restore_durability
+  trap - EXIT
+fi
+
+for DB_TEMPLATE in "${DUMP_DBS[@]}"; do
+  if [[ -f "${DUMP_PATH}/${DB_TEMPLATE}_dump.sql" ]]; then
+    mysql_root -e "DROP DATABASE IF EXISTS \`${DB_TEMPLATE}\`;"
+  fi
   import_db_dump "${DB_TEMPLATE}"
+  convert_dump "${DB_TEMPLATE}" || echo "  [WARN] ${DB_TEMPLATE} will be imported from its dump next time too"
 done
 
 # ------------------------------------------------------------------------------
@@ -56,7 +56,22 @@ declare -A DATABASE_MAPPING=(
 ############################
 # 2. Create template DBs and import data
 ############################
+# A template whose folder holds a directory-format dump
+# (pg_dump -Fd -f postgre_table_dumps/<template>/dump <template>) is
+# bootstrapped with pg_restore (section 2b); the others are imported from
+# their plain SQL files.
+DUMPS_ROOT="/docker-entrypoint-initdb.d/postgre_table_dumps"
+BOOTSTRAP_TEMPLATES=()
+PLAIN_TEMPLATES=()
 for DB_TEMPLATE in "${!DATABASE_MAPPING[@]}"; do
+    if [[ -f "${DUMPS_ROOT}/${DB_TEMPLATE}/dump/toc.dat" ]]; then
+        BOOTSTRAP_TEMPLATES+=("${DB_TEMPLATE}")
+    else
+        PLAIN_TEMPLATES+=("${DB_TEMPLATE}")
+    fi
+done
+
+for DB_TEMPLATE in "${PLAIN_TEMPLATES[@]}"; do
     echo "Creating template database: $DB_TEMPLATE"
     psql -U root -tc "SELECT 1 FROM pg_database WHERE datname='${DB_TEMPLATE}'" | grep -q 1 \
       || psql -U root -c "CREATE DATABASE ${DB_TEMPLATE} WITH OWNER=root ENCODING='UTF8' TEMPLATE=template0;"
@@ -120,10 +135,87 @@ import_table_files() {
 }
 
 # Import data for each database
-for DB_TEMPLATE in "${!DATABASE_MAPPING[@]}"; do
+for DB_TEMPLATE in "${PLAIN_TEMPLATES[@]}"; do
     import_db_files "${DB_TEMPLATE}"
 done
 
+############################
+# 2b. Bootstrap templates from directory-format dumps
+############################
+# TEMPLATE_JOBS templates are restored at once, each by pg_restore with
+# PG_RESTORE_JOBS workers: tables first, then the data, then indexes and
+# constraints (post-data), so indexes are built once over the loaded rows.
+# A loaded template gets a marker in BOOTSTRAP_MARKER_DIR holding its
+# timings; on a restart it is skipped. A template without a marker may be
+# half-loaded and is restored again from scratch.
+PG_RESTORE_JOBS="${PG_RESTORE_JOBS:-4}"
+TEMPLATE_JOBS="${TEMPLATE_JOBS:-2}"
+BOOTSTRAP_MARKER_DIR="${BOOTSTRAP_MARKER_DIR:-${PGDATA:-/var/lib/postgresql/data}/bird_bootstrap}"
+mkdir -p "${BOOTSTRAP_MARKER_DIR}"
+
+database_exists() {
+    psql -U root -tc "SELECT 1 FROM pg_database WHERE datname='$1'" | grep -q 1
+}
+
+drop_database() {
+    if database_exists "$1"; then
+        psql -U root -c "ALTER DATABASE $1 IS_TEMPLATE false;"
+        psql -U root -c "DROP DATABASE $1 WITH (FORCE);"
+    fi
+}
+
+restore_template() {
+    local db_template="$1"
+    local dump_dir="${DUMPS_ROOT}/${db_template}/dump"
+    local marker="${BOOTSTRAP_MARKER_DIR}/${db_template}.done"
+    local start=$SECONDS phase_start
+
+    # The real database was created from the old template
+    drop_database "${db_template%_template}"
+    drop_database "${db_template}"
+    psql -U root -c "CREATE DATABASE ${db_template} WITH OWNER=root ENCODING='UTF8' TEMPLATE=template0;"
+
+    local timings=""
+    for section in pre-data data post-data; do
+        phase_start=$SECONDS
+        if ! pg_restore -U root -d "${db_template}" --no-owner \
+                -j "${PG_RESTORE_JOBS}" --section="${section}" "${dump_dir}" \
+                2>>/tmp/error.log; then
+            echo "Error restoring ${section} of ${db_template}. Check /tmp/error.log for details."
+            return 1
+        fi
+        timings+=" ${section}=$((SECONDS - phase_start))s"
+    done
+    echo "total=$((SECONDS - start))s${timings}" > "${marker}"
+    echo "Bootstrapped ${db_template} in $((SECONDS - start))s (${timings# })"
+}
+
+for DB_TEMPLATE in "${BOOTSTRAP_TEMPLATES[@]}"; do
+    if [[ -f "${BOOTSTRAP_MARKER_DIR}/${DB_TEMPLATE}.done" ]] && database_exists "${DB_TEMPLATE}"; then
+        echo "Template ${DB_TEMPLATE} already bootstrapped ($(cat "${BOOTSTRAP_MARKER_DIR}/${DB_TEMPLATE}.done")), skipping."
+        continue
+    fi
+    rm -f "${BOOTSTRAP_MARKER_DIR}/${DB_TEMPLATE}.done"
+    while (( $(jobs -rp | wc -l) >= TEMPLATE_JOBS )); do
+        wait -n || true
+    done
+    echo "Bootstrapping ${DB_TEMPLATE} from ${DUMPS_ROOT}/${DB_TEMPLATE}/dump"
+    restore_template "${DB_TEMPLATE}" &
+done
+wait || true
+
+if (( ${#BOOTSTRAP_TEMPLATES[@]} > 0 )); then
+    echo "Bootstrap time per template (slowest first):"
+    for DB_TEMPLATE in "${BOOTSTRAP_TEMPLATES[@]}"; do
+        marker="${BOOTSTRAP_MARKER_DIR}/${DB_TEMPLATE}.done"
+        if [[ -f "${marker}" ]]; then
+            echo "$(cat "${marker}") ${DB_TEMPLATE}"
+        else
+            echo "total=FAILED ${DB_TEMPLATE}"
+        fi
+    done | sort -t= -k2 -rn
+fi
+
 if [[ -s /tmp/error.log ]]; then
     echo "Errors occurred during import:"
     cat /tmp/error.log
@@ -0,0 +1,14 @@
+# Compare database-affinity scheduling with the round-robin order on the same instances.
+# Each run prints "Evaluation time: ...s (schedule=...)"; results of both runs must match.
+postgresql_files=("/app/data/flash.jsonl" "/app/data/postgresql_530.jsonl")
+num_threads=8
+mode="gold"
+
+for jsonl_file in "${postgresql_files[@]}"; do
+    for schedule in round_robin affinity; do
+        echo "== $jsonl_file ($schedule)"
+        python /app/src/wrapper_evaluation_postgresql.py --jsonl_file "$jsonl_file" --mode "$mode" \
+            --logging "false" --report "false" --num_threads $num_threads --schedule $schedule \
+            | grep -E "Evaluation time|Passed instances|Overall accuracy"
+    done
+done
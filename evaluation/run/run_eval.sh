@@ -27,6 +27,15 @@ logging="save"
 # limit=n for limiting the number of instances to evaluate
 # limit=1
 
+# db_hosts="host[:port][@weight],..." for sharding databases across several servers of the same dialect
+# db_hosts="bird_critic_postgresql:5432@2,bird_critic_postgresql_2:5432@1"
+
+# queue_db=/shared/path/run.sqlite lets wrappers on several machines split one evaluation (same path on every node)
+# queue_db="/app/data/eval_queue.sqlite"
+
+# instance_timeout=seconds per instance; queries still running when it runs out are cancelled on the server
+# instance_timeout=300
+
 python /app/src/wrapper_evaluation_${dialect}.py --jsonl_file "$jsonl_file"  --logging "$logging" --mode "$mode" \
-    # --limit $limit
+    # --limit $limit --db_hosts "$db_hosts" --queue_db "$queue_db" --instance_timeout $instance_timeout
 
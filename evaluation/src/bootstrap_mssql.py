@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bootstrap the SQL Server template databases by bulk-loading their tables in
+parallel with bcp, then take the <db>_template.bak backups the evaluation
+restores from.
+
+Run it from the evaluation container (it has bcp, sqlcmd and pymssql). The
+data directory holds one folder per database of BCP_DATABASE_MAPPING:
+
+    <data_dir>/<db>/schema.sql     tables, keys, indexes, ... (sqlcmd script)
+    <data_dir>/<db>/<table>.bcp    rows of a table in bcp native format
+                                   (bcp <db>.dbo.<table> out <file> -n)
+
+Each database is dropped (with its snapshot) and created, its schema is run,
+and its constraints and nonclustered indexes are disabled. Tables are then
+loaded by --workers bcp processes, the largest files first, with TABLOCK so
+the load is minimally logged; while constraints are off, their order does
+not matter. As soon as all tables of a database are loaded, its disabled
+indexes are rebuilt, its constraints are re-enabled WITH CHECK in
+TABLE_ORDER (so they are trusted again) and the database is backed up to
+<backup_dir>/<db>_template.bak.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pymssql
+
+from logger import configure_logger
+from mssql_utils import (
+    BCP_DATABASE_MAPPING,
+    DEFAULT_SQLSERVER_CONFIG,
+    MSSQL_BACKUP_DIR,
+    TABLE_ORDER,
+    resetter,
+)
+
+DEFAULT_DATA_DIR = "/app/mssql_bcp_data"
+BCP_BATCH_SIZE = 50000
+
+
+def _connect(database, server, port):
+    conn = pymssql.connect(
+        server=server,
+        port=port,
+        user=DEFAULT_SQLSERVER_CONFIG["USER"],
+        password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+        database=database,
+    )
+    conn.autocommit(True)
+    return conn
+
+
+def _run_tool(command, what):
+    """Run a bcp/sqlcmd command; raise with its output if it fails."""
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        output = (completed.stdout + completed.stderr).strip()
+        raise RuntimeError(f"{what} failed: {output[-1000:]}")
+    return completed.stdout
+
+
+def _table_rank(table):
+    """Position of table in TABLE_ORDER (unknown tables go last)."""
+    try:
+        return TABLE_ORDER.index(table)
+    except ValueError:
+        return len(TABLE_ORDER)
+
+
+def prepare_database(db_name, data_dir, server, port, logger):
+    """
+    (Re)create db_name from its schema.sql and disable its constraints and
+    nonclustered indexes. Returns the disabled indexes as (table, index).
+    """
+    conn = _connect("master", server, port)
+    try:
+        cur = conn.cursor()
+        resetter.drop(cur, db_name, logger)
+        cur.execute(f"CREATE DATABASE [{db_name}]")
+        cur.execute(f"ALTER DATABASE [{db_name}] SET RECOVERY SIMPLE")
+    finally:
+        conn.close()
+
+    _run_tool(
+        [
+            "sqlcmd",
+            "-S",
+            f"{server},{port}",
+            "-No",
+            "-U",
+            DEFAULT_SQLSERVER_CONFIG["USER"],
+            "-P",
+            DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+            "-d",
+            db_name,
+            "-b",
+            "-i",
+            os.path.join(data_dir, db_name, "schema.sql"),
+        ],
+        f"Schema of {db_name}",
+    )
+
+    conn = _connect(db_name, server, port)
+    try:
+        cur = conn.cursor()
+        # Unique indexes stay: a foreign key may reference them
+        cur.execute(
+            "SELECT t.name, i.name FROM sys.indexes i "
+            "JOIN sys.tables t ON t.object_id = i.object_id "
+            "WHERE i.type = 2 AND i.is_unique = 0 AND i.is_disabled = 0"
+        )
+        indexes = cur.fetchall()
+        cur.execute("SELECT name FROM sys.tables")
+        for (table,) in cur.fetchall():
+            cur.execute(f"ALTER TABLE [dbo].[{table}] NOCHECK CONSTRAINT ALL")
+        for table, index in indexes:
+            cur.execute(f"ALTER INDEX [{index}] ON [dbo].[{table}] DISABLE")
+    finally:
+        conn.close()
+    logger.info(f"Created {db_name}; constraints and {len(indexes)} indexes disabled")
+    return indexes
+
+
+def load_table(db_name, table, data_file, server, port, logger):
+    """Bulk-load data_file into db_name's table with bcp."""
+    start = time.time()
+    output = _run_tool(
+        [
+            "bcp",
+            f"[{db_name}].[dbo].[{table}]",
+            "in",
+            data_file,
+            "-S",
+            f"{server},{port}",
+            "-u",
+            "-U",
+            DEFAULT_SQLSERVER_CONFIG["USER"],
+            "-P",
+            DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+            "-q",
+            "-n",
+            "-E",
+            "-b",
+            str(BCP_BATCH_SIZE),
+            "-h",
+            "TABLOCK",
+        ],
+        f"Loading {db_name}.{table}",
+    )
+    copied = [line for line in output.splitlines() if "rows copied" in line]
+    logger.info(
+        f"Loaded {db_name}.{table} in {time.time() - start:.2f}s "
+        f"({copied[-1].strip() if copied else 'no rows'})"
+    )
+
+
+def finalize_database(db_name, indexes, backup_dir, server, port, logger):
+    """
+    Rebuild the disabled indexes of db_name, re-enable its constraints WITH
+    CHECK in TABLE_ORDER and back it up as its template.
+    """
+    start = time.time()
+    conn = _connect(db_name, server, port)
+    try:
+        cur = conn.cursor()
+        for table, index in indexes:
+            cur.execute(f"ALTER INDEX [{index}] ON [dbo].[{table}] REBUILD")
+        cur.execute("SELECT name FROM sys.tables")
+        tables = sorted((row[0] for row in cur.fetchall()), key=_table_rank)
+        for table in tables:
+            cur.execute(f"ALTER TABLE [dbo].[{table}] WITH CHECK CHECK CONSTRAINT ALL")
+    finally:
+        conn.close()
+
+    backup_file = f"{backup_dir}/{db_name}_template.bak"
+    conn = _connect("master", server, port)
+    try:
+        conn.cursor().execute(
+            f"BACKUP DATABASE [{db_name}] TO DISK = '{backup_file}' "
+            "WITH FORMAT, INIT, COMPRESSION, STATS = 10"
+        )
+    finally:
+        conn.close()
+    logger.info(
+        f"Rebuilt, checked and backed up {db_name} to {backup_file} "
+        f"in {time.time() - start:.2f}s"
+    )
+
+
+def bootstrap(db_names, data_dir, backup_dir, workers, server, port, logger):
+    """
+    Bootstrap db_names on workers threads (see the module docstring).
+    Returns the names of the databases that failed.
+    """
+    failed = set()
+    indexes = {}
+    remaining = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        prepared = {
+            executor.submit(
+                prepare_database, db_name, data_dir, server, port, logger
+            ): db_name
+            for db_name in db_names
+        }
+        loads = []
+        for future, db_name in prepared.items():
+            try:
+                indexes[db_name] = future.result()
+            except Exception as e:
+                logger.error(f"Cannot create {db_name}: {e}")
+                failed.add(db_name)
+                continue
+            for table in BCP_DATABASE_MAPPING[db_name]:
+                data_file = os.path.join(data_dir, db_name, f"{table}.bcp")
+                if os.path.exists(data_file):
+                    loads.append(
+                        (os.path.getsize(data_file), db_name, table, data_file)
+                    )
+                else:
+                    logger.warning(f"No data for {db_name}.{table} ({data_file})")
+            remaining[db_name] = 0
+
+        pending = {}
+
+        def submit_finalize(db_name):
+            future = executor.submit(
+                finalize_database,
+                db_name,
+                indexes[db_name],
+                backup_dir,
+                server,
+                port,
+                logger,
+            )
+            pending[future] = (db_name, None)
+
+        # Largest files first, so the longest loads do not start last
+        for _, db_name, table, data_file in sorted(loads, reverse=True):
+            future = executor.submit(
+                load_table, db_name, table, data_file, server, port, logger
+            )
+            pending[future] = (db_name, table)
+            remaining[db_name] += 1
+        for db_name in list(remaining):
+            if remaining[db_name] == 0:
+                submit_finalize(db_name)
+
+        # A database is finalized as soon as its last table is loaded
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                db_name, table = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(str(e))
+                    failed.add(db_name)
+                if table is None:
+                    continue
+                remaining[db_name] -= 1
+                if remaining[db_name] == 0 and db_name not in failed:
+                    submit_finalize(db_name)
+    return sorted(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk-load the SQL Server template databases with bcp and back them up."
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=DEFAULT_DATA_DIR,
+        help="Folder with <db>/schema.sql and <db>/<table>.bcp per database.",
+    )
+    parser.add_argument(
+        "--backup_dir",
+        type=str,
+        default=MSSQL_BACKUP_DIR,
+        help="Folder (on the server) for the <db>_template.bak backups.",
+    )
+    parser.add_argument(
+        "--databases",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Databases to bootstrap (default: every database in the data folder).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of concurrent bcp loads.",
+    )
+    parser.add_argument(
+        "--server", type=str, default=DEFAULT_SQLSERVER_CONFIG["SERVER"]
+    )
+    parser.add_argument("--port", type=int, default=DEFAULT_SQLSERVER_CONFIG["PORT"])
+    parser.add_argument(
+        "--log_file", type=str, default="bootstrap_mssql.log", help="Log file."
+    )
+    args = parser.parse_args()
+
+    logger = configure_logger(args.log_file)
+    db_names = args.databases or [
+        db_name
+        for db_name in BCP_DATABASE_MAPPING
+        if os.path.isdir(os.path.join(args.data_dir, db_name))
+    ]
+    unknown = [db_name for db_name in db_names if db_name not in BCP_DATABASE_MAPPING]
+    if unknown:
+        logger.error(f"Not in BCP_DATABASE_MAPPING: {unknown}")
+        sys.exit(1)
+    if not db_names:
+        logger.error(f"No database folders found in {args.data_dir}")
+        sys.exit(1)
+
+    start = time.time()
+    logger.info(f"Bootstrapping {len(db_names)} databases: {db_names}")
+    failed = bootstrap(
+        db_names,
+        args.data_dir,
+        args.backup_dir,
+        args.workers,
+        args.server,
+        args.port,
+        logger,
+    )
+    logger.info(f"Bootstrap finished in {time.time() - start:.2f}s")
+    if failed:
+        logger.error(f"Failed databases: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
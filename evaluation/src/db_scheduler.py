@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Database-affinity scheduling of evaluation instances.
+
+Instances of the same db_id are serialised by the wrappers' per-database
+lock, so interleaving db_ids across workers only makes every worker switch
+databases (cold buffer cache, new connection pool) on every instance. This
+scheduler binds each worker to one db_id at a time: the worker runs all of
+that database's instances back to back and only moves on once its queue is
+empty, taking the unclaimed database with the most work left.
+"""
+
+import threading
+from collections import deque
+
+
+class DbAffinityScheduler:
+    """
+    Hands out (original_idx, instance_data) items to worker threads so that
+    each database is worked on by at most one worker at a time.
+    """
+
+    def __init__(self, items, db_key=None):
+        """
+        Args:
+            items: Iterable of (original_idx, instance_data), in input order.
+            db_key: Function mapping instance_data to the database it uses
+                (default: its db_id).
+        """
+        db_key = db_key or (lambda data: data.get("db_id", "unknown"))
+        self._queues = {}
+        for original_idx, data in items:
+            self._queues.setdefault(db_key(data), deque()).append((original_idx, data))
+        self._owner = {}  # db_id -> worker currently bound to it
+        self._current = {}  # worker -> db_id it is bound to
+        self._lock = threading.Lock()
+
+    def _claim_next_db(self, worker):
+        """Bind worker to the unclaimed database with the most pending items."""
+        candidates = [
+            db_id
+            for db_id, pending in self._queues.items()
+            if pending and db_id not in self._owner
+        ]
+        if not candidates:
+            return None
+        db_id = max(candidates, key=lambda d: (len(self._queues[d]), d))
+        self._owner[db_id] = worker
+        self._current[worker] = db_id
+        return db_id
+
+    def next(self, worker):
+        """
+        Return the next item for worker, or None when no unclaimed work is
+        left (the remaining databases are each being drained by another
+        worker).
+        """
+        with self._lock:
+            db_id = self._current.get(worker)
+            if db_id is None or not self._queues[db_id]:
+                if db_id is not None:
+                    del self._owner[db_id]
+                    del self._current[worker]
+                db_id = self._claim_next_db(worker)
+                if db_id is None:
+                    return None
+            return self._queues[db_id].popleft()
+
+    def pending(self):
+        """Number of items not handed out yet."""
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-instance deadline for the single-instance evaluators.
+
+The wrapper turns its per-instance budget into an absolute wall-clock
+deadline and passes it with --deadline. Inside the evaluator every
+statement-level timeout is capped at the time that is left, and a watchdog
+thread cancels the in-flight statement of every registered connection the
+moment the deadline passes:
+
+    PostgreSQL  cancel request for the backend (same as pg_cancel_backend)
+    MySQL       KILL QUERY <thread id> over a separate connection
+    Oracle      connection.cancel(); call_timeout also caps each round trip
+    SQL Server  KILL <spid> over a separate connection
+    SQLite      connection.interrupt(); a progress handler also enforces a
+                VM-step budget
+
+so server-side work stops when the instance's budget runs out instead of
+running on after the wrapper has given up on the subprocess.
+"""
+
+import threading
+import time
+
+# Smallest timeout handed to a driver; 0 means "no timeout" for most of them.
+MIN_TIMEOUT_SECONDS = 0.05
+# Extra time the wrapper gives an evaluator after its deadline to report the
+# timeout and reset its database before the process is killed.
+DEADLINE_GRACE_SECONDS = 60
+# VM steps between calls of the SQLite progress handler.
+SQLITE_PROGRESS_INTERVAL = 10000
+
+_deadline = None
+_timer = None
+_expired = threading.Event()
+_watched = {}
+_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the instance's time budget has been used up."""
+
+
+def set_deadline(deadline):
+    """
+    Set the absolute deadline (epoch seconds, None to disable) and arm the
+    watchdog that cancels registered connections when it passes.
+    """
+    global _deadline, _timer
+    with _lock:
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+        _expired.clear()
+        _deadline = float(deadline) if deadline is not None else None
+        if _deadline is None:
+            return
+        delay = max(0.0, _deadline - time.time())
+        _timer = threading.Timer(delay, _on_deadline)
+        _timer.daemon = True
+        _timer.start()
+
+
+def get_deadline():
+    return _deadline
+
+
+def remaining(default=None):
+    """Seconds left before the deadline, or default when none is set."""
+    if _deadline is None:
+        return default
+    return max(0.0, _deadline - time.time())
+
+
+def expired():
+    return _expired.is_set() or (_deadline is not None and time.time() >= _deadline)
+
+
+def check():
+    """Raise DeadlineExceeded if the deadline has passed."""
+    if expired():
+        raise DeadlineExceeded("Instance time budget exhausted")
+
+
+def cap(seconds):
+    """Return min(seconds, time left), never below MIN_TIMEOUT_SECONDS."""
+    left = remaining()
+    if left is None:
+        return seconds
+    if seconds is None:
+        return max(left, MIN_TIMEOUT_SECONDS)
+    return max(min(seconds, left), MIN_TIMEOUT_SECONDS)
+
+
+def watch(conn, cancel):
+    """
+    Register cancel(conn) to be called when the deadline passes.
+    Registering the same connection again is a no-op.
+    """
+    with _lock:
+        _watched.setdefault(id(conn), (conn, cancel))
+
+
+def unwatch(conn):
+    with _lock:
+        _watched.pop(id(conn), None)
+
+
+def _on_deadline():
+    _expired.set()
+    with _lock:
+        targets = list(_watched.values())
+    for conn, cancel in targets:
+        try:
+            cancel(conn)
+        except Exception as e:
+            print(f"[Deadline] Failed to cancel query on {conn!r}: {e}")
+
+
+def sqlite_progress_handler(max_steps=None, max_seconds=None):
+    """
+    Build a handler for sqlite3.Connection.set_progress_handler. It returns
+    non-zero (which aborts the statement with "interrupted") once the
+    statement has run max_steps VM steps or max_seconds seconds, or the
+    deadline has passed. Install a fresh handler for every statement; it is
+    meant to be called every SQLITE_PROGRESS_INTERVAL steps.
+    """
+    calls = 0
+    max_calls = None
+    if max_steps is not None:
+        max_calls = max(1, max_steps // SQLITE_PROGRESS_INTERVAL)
+    stop_at = time.time() + max_seconds if max_seconds is not None else None
+
+    def handler():
+        nonlocal calls
+        calls += 1
+        if max_calls is not None and calls > max_calls:
+            return 1
+        if stop_at is not None and time.time() >= stop_at:
+            return 1
+        return 1 if expired() else 0
+
+    return handler
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazily created, demand-sized pools of ephemeral database copies.
+
+Loading an ephemeral copy (a MySQL database from its dump, an Oracle user
+with its grants and synonyms) is the slowest part of a run's start-up.
+Instead of creating num_threads copies of every database before the first
+instance runs, each database gets a copy quota proportional to its share of
+the pending instances, and a copy is only created when an instance needs
+one and every existing copy is busy. Evaluation starts as soon as the first
+copy of the first database is ready.
+"""
+
+import math
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+
+def copy_quota(pending, total_pending, max_copies):
+    """
+    Number of copies for a database with `pending` of `total_pending`
+    instances: its proportional share of max_copies, at least one, and never
+    more than it has instances.
+    """
+    if pending <= 0:
+        return 0
+    share = math.ceil(max_copies * pending / max(total_pending, 1))
+    return max(1, min(pending, max_copies, share))
+
+
+class LazyEphemeralPool:
+    """
+    Per-database pools of ephemeral copies, created on first demand.
+
+    get() and put() mirror the per-database queue.Queue objects the wrappers
+    used before: get() raises queue.Empty if no copy became free in time.
+    """
+
+    def __init__(self, demand, max_copies, create_copy, logger=None):
+        """
+        Args:
+            demand: {db_id: number of pending instances}.
+            max_copies: Upper bound on copies of any one database (usually
+                the number of worker threads).
+            create_copy: create_copy(db_id, copy_index) creates copy number
+                copy_index (1-based) and returns its name.
+        """
+        total = sum(demand.values())
+        self.quota = {
+            db_id: copy_quota(n, total, max_copies) for db_id, n in demand.items()
+        }
+        self.create_copy = create_copy
+        self.logger = logger
+
+        self._idle = {db_id: deque() for db_id in demand}
+        self._created = {db_id: [] for db_id in demand}
+        self._creating = Counter()
+        self._next_index = Counter()
+        self._cond = threading.Condition()
+
+    def __contains__(self, db_id):
+        return db_id in self.quota
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+        else:
+            print(message)
+
+    def _reserve_locked(self, db_id):
+        """
+        Reserve a copy of db_id; the caller holds the lock. Returns
+        ("idle", name), ("create", copy_index) or None if every copy is busy
+        and the database is at its quota.
+        """
+        if self._idle[db_id]:
+            return ("idle", self._idle[db_id].popleft())
+        if len(self._created[db_id]) + self._creating[db_id] < self.quota[db_id]:
+            self._creating[db_id] += 1
+            self._next_index[db_id] += 1
+            return ("create", self._next_index[db_id])
+        return None
+
+    def _can_reserve_locked(self, db_id):
+        return bool(self._idle[db_id]) or (
+            len(self._created[db_id]) + self._creating[db_id] < self.quota[db_id]
+        )
+
+    def get(self, db_id, timeout=None, reservation=None):
+        """
+        Return an idle copy of db_id, creating one if the database is below
+        its quota; otherwise wait up to timeout seconds (not counting time
+        spent waiting for copies that are still loading) for one to be put
+        back. A reservation made by a DatabaseDispatcher is redeemed without
+        waiting.
+        """
+        stop_at = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while reservation is None:
+                reservation = self._reserve_locked(db_id)
+                if reservation is not None:
+                    break
+                if self._creating[db_id]:
+                    # A copy is still loading; the timeout starts once it is ready
+                    self._cond.wait()
+                    if stop_at is not None:
+                        stop_at = time.time() + timeout
+                    continue
+                wait = None if stop_at is None else stop_at - time.time()
+                if wait is not None and wait <= 0:
+                    raise queue.Empty
+                self._cond.wait(wait)
+
+        kind, value = reservation
+        if kind == "idle":
+            return value
+        return self._create(db_id, value)
+
+    def _create(self, db_id, copy_index):
+        # Create outside the lock so other databases are not held up
+        self._log(f"Creating copy {copy_index}/{self.quota[db_id]} of {db_id}")
+        try:
+            name = self.create_copy(db_id, copy_index)
+        except Exception:
+            with self._cond:
+                self._creating[db_id] -= 1
+                # Do not keep retrying beyond the copies that already work
+                self.quota[db_id] = max(1, len(self._created[db_id]))
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._creating[db_id] -= 1
+            self._created[db_id].append(name)
+            self._cond.notify_all()
+        return name
+
+    def put(self, db_id, name):
+        """Return a copy to its database's pool."""
+        with self._cond:
+            self._idle[db_id].append(name)
+            self._cond.notify_all()
+
+    def created_copies(self):
+        """Return {db_id: [copy names]} for every copy created so far."""
+        with self._cond:
+            return {
+                db_id: list(names) for db_id, names in self._created.items() if names
+            }
+
+    def describe(self):
+        """Return a human-readable summary of quotas and created copies."""
+        with self._cond:
+            return ", ".join(
+                f"{db_id}: {len(self._created[db_id])}/{quota}"
+                for db_id, quota in sorted(self.quota.items())
+            )
+
+
+class DatabaseDispatcher:
+    """
+    Hands each worker the highest-priority pending instance whose database
+    has a free (or creatable) copy, so a worker never sits on an instance
+    whose copies are all busy while copies of other databases are idle.
+
+    get() reserves the copy and returns (original_idx, instance_data,
+    reservation); pass the reservation to pool.get() to redeem it. It blocks
+    while every pending instance's database is busy and raises queue.Empty
+    once nothing is pending. task_done() and join() are kept for queue.Queue
+    parity.
+    """
+
+    def __init__(self, items, pool, db_key):
+        """
+        Args:
+            items: (original_idx, instance_data) pairs in priority order.
+            pool: The LazyEphemeralPool the copies come from.
+            db_key: Function mapping instance_data to its pool key.
+        """
+        self.pool = pool
+        self.db_key = db_key
+        self._pending = {}
+        for seq, (original_idx, data) in enumerate(items):
+            self._pending.setdefault(db_key(data), deque()).append(
+                (seq, original_idx, data)
+            )
+
+    def _ready_db_locked(self):
+        """Database whose next instance has the best priority and a free copy."""
+        best = None
+        for db_id, items in self._pending.items():
+            if best is not None and items[0][0] > self._pending[best][0][0]:
+                continue
+            # Instances of databases without a pool are handed out as they are
+            if db_id not in self.pool or self.pool._can_reserve_locked(db_id):
+                best = db_id
+        return best
+
+    def get(self, block=True):
+        with self.pool._cond:
+            while True:
+                if not self._pending:
+                    raise queue.Empty
+                db_id = self._ready_db_locked()
+                if db_id is not None:
+                    break
+                if not block:
+                    raise queue.Empty
+                # Woken when a copy is put back or finishes loading
+                self.pool._cond.wait()
+
+            _, original_idx, data = self._pending[db_id].popleft()
+            if not self._pending[db_id]:
+                del self._pending[db_id]
+            reservation = None
+            if db_id in self.pool:
+                reservation = self.pool._reserve_locked(db_id)
+            return original_idx, data, reservation
+
+    def task_done(self):
+        """Nothing to track; kept for queue.Queue parity."""
+
+    def join(self):
+        """Workers only exit once nothing is pending; nothing to wait for."""
+
+    def pending(self):
+        with self.pool._cond:
+            return sum(len(items) for items in self._pending.values())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bounded fetching of query results for the Oracle and SQL Server evaluators.
+
+PostgreSQL and MySQL fetch at most MAX_ROWS rows of a result. Oracle and SQL
+Server use the same cap here, plus a cap on the size of the fetched values,
+so a runaway prediction (a cross join, a huge CLOB column) cannot exhaust the
+evaluator's memory:
+
+    max_rows     rows kept per result (default MAX_ROWS, as on PostgreSQL
+                 and MySQL); the rest is not fetched
+    max_bytes    approximate size of the values kept per result; fetching
+                 stops at the first row past it
+    lob_limit    characters (or bytes) read of one Oracle CLOB/NCLOB/BLOB;
+                 LOBs are fetched as locators and only that much is read
+
+The caps are checked row by row as the rows arrive. The driver transfers
+rows ARRAYSIZE at a time (Oracle also prefetches that many rows with the
+execute call), so a large legitimate result takes few round trips.
+
+A result that hit a cap is marked truncated. The evaluators pass
+result_truncated to the test cases, so a test can tell a short result from
+a cut one.
+"""
+
+MAX_ROWS = 10000
+MAX_BYTES = 256 * 1024 * 1024
+LOB_INLINE_LIMIT = 1024 * 1024
+ARRAYSIZE = 1000
+
+# Size counted for a value that is not a string or bytes
+SCALAR_BYTES = 16
+
+_limits = {"max_rows": MAX_ROWS, "max_bytes": MAX_BYTES, "lob_limit": LOB_INLINE_LIMIT}
+_truncated = None
+
+
+def configure(max_rows=None, max_bytes=None, lob_limit=None):
+    """Set the caps of this process (None keeps the current value)."""
+    for name, value in (
+        ("max_rows", max_rows),
+        ("max_bytes", max_bytes),
+        ("lob_limit", lob_limit),
+    ):
+        if value is not None:
+            _limits[name] = int(value)
+
+
+def lob_limit():
+    return _limits["lob_limit"]
+
+
+def _value_bytes(value):
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    return SCALAR_BYTES
+
+
+def fetch(cursor, convert=None):
+    """
+    Fetch the rows of cursor's result up to the row and byte caps, checking
+    them after each row; the rows past them are left unfetched. convert(row),
+    if given, is applied to each row before its size is counted.
+    """
+    max_rows = _limits["max_rows"]
+    max_bytes = _limits["max_bytes"]
+    rows = []
+    size = 0
+    for row in cursor:
+        if len(rows) >= max_rows:
+            note_truncated(f"more than {max_rows} rows")
+            break
+        if convert is not None:
+            row = convert(row)
+        values = row.values() if isinstance(row, dict) else row
+        size += sum(_value_bytes(value) for value in values)
+        if size > max_bytes:
+            note_truncated(f"more than {max_bytes} bytes after {len(rows)} rows")
+            break
+        rows.append(row)
+    return rows
+
+
+def note_truncated(what):
+    """Record that a result was cut (first cause since clear() wins)."""
+    global _truncated
+    if _truncated is None:
+        _truncated = what
+
+
+def clear():
+    global _truncated
+    _truncated = None
+
+
+def truncated():
+    """Why a result fetched since the last clear() was cut, or None."""
+    return _truncated
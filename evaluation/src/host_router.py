@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Routing of evaluation instances across several database servers.
+
+A run may be given more than one server per dialect (for example a second
+PostgreSQL container loaded from the same dumps). Every db_id is placed on
+exactly one host, so all ephemeral copies of a database and every instance
+that uses it are served by the same server. Placement is weighted by the
+number of pending instances per db_id and by each host's capacity weight.
+
+Host specs are comma separated: "host[:port][@weight]", e.g.
+    "bird_critic_postgresql:5432@2,bird_critic_postgresql_2:5432@1"
+"""
+
+import threading
+
+
+def parse_db_hosts(spec, default_host, default_port):
+    """
+    Parse a host spec string into a list of host dicts:
+        [{"host": ..., "port": ..., "weight": ...}, ...]
+    An empty spec yields the single default host.
+    """
+    if not spec:
+        return [{"host": default_host, "port": int(default_port), "weight": 1.0}]
+
+    hosts = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        weight = 1.0
+        if "@" in item:
+            item, weight_str = item.rsplit("@", 1)
+            weight = float(weight_str)
+            if weight <= 0:
+                raise ValueError(f"Host weight must be positive: {weight_str}")
+        if ":" in item:
+            host, port_str = item.rsplit(":", 1)
+            port = int(port_str)
+        else:
+            host, port = item, int(default_port)
+        hosts.append({"host": host, "port": port, "weight": weight})
+
+    if not hosts:
+        raise ValueError(f"No hosts found in spec: {spec!r}")
+    return hosts
+
+
+def host_key(host):
+    """Return the "host:port" key used to identify a host."""
+    return f"{host['host']}:{host['port']}"
+
+
+class HostRouter:
+    """
+    Places db_ids on hosts and routes instances to the host holding their db.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self._placement = {}
+        self._load = {host_key(h): 0.0 for h in self.hosts}
+        self._lock = threading.Lock()
+
+    def _least_loaded(self, load):
+        return min(
+            self.hosts,
+            key=lambda h: ((self._load[host_key(h)] + load) / h["weight"], host_key(h)),
+        )
+
+    def place(self, db_loads):
+        """
+        Place each db_id on a host. db_loads maps db_id -> number of pending
+        instances. The heaviest databases are placed first, each on the host
+        whose weighted load stays lowest.
+        """
+        with self._lock:
+            for db_id, load in sorted(db_loads.items(), key=lambda kv: (-kv[1], kv[0])):
+                if db_id in self._placement:
+                    continue
+                host = self._least_loaded(load)
+                self._placement[db_id] = host
+                self._load[host_key(host)] += load
+        return dict(self._placement)
+
+    def route(self, db_id):
+        """
+        Return the host dict that holds db_id, placing it on the least
+        loaded host if it was not placed up front.
+        """
+        with self._lock:
+            host = self._placement.get(db_id)
+            if host is None:
+                host = self._least_loaded(1)
+                self._placement[db_id] = host
+                self._load[host_key(host)] += 1
+            return host
+
+    def group_by_host(self, db_ids):
+        """
+        Return a list of (host, [db_id, ...]) pairs for the given db_ids.
+        """
+        groups = {}
+        for db_id in db_ids:
+            host = self.route(db_id)
+            groups.setdefault(host_key(host), (host, []))[1].append(db_id)
+        return list(groups.values())
+
+    def describe(self):
+        """Return a human-readable summary of the current placement."""
+        lines = []
+        for host in self.hosts:
+            key = host_key(host)
+            dbs = sorted(d for d, h in self._placement.items() if host_key(h) == key)
+            lines.append(
+                f"{key} (weight={host['weight']}, load={self._load[key]:.0f}): {dbs}"
+            )
+        return "\n".join(lines)
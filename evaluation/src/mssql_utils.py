@@ -7,10 +7,17 @@ Database utility functions for SQL Server operations.
 import os, csv
 import pymssql
 from logger import PrintLogger, log_section_header, log_section_footer
+import deadline
+import fetch_limits
+import reset_ledger
+import sql_lexer
+from quiescence import QUIESCE_TIMEOUT_SECONDS, wait_until
 import json
 import sys
 import re
 import os
+import threading
+import time
 
 from datetime import datetime
 
@@ -99,27 +106,6 @@ BCP_DATABASE_MAPPING = {
 TABLE_ORDER = [table for tables in BCP_DATABASE_MAPPING.values() for table in tables]
 
 
-SQLSERVER_COMMIT_KEYWORDS = (
-    "insert",
-    "update",
-    "delete",
-    "create",
-    "drop",
-    "alter",
-    "truncate",
-    "merge",
-    "grant",
-    "revoke",
-    "backup",
-    "restore",
-    "begin tran",
-    "commit tran",
-    "rollback tran",
-    "save tran",
-    "dbcc",
-    "sp_",
-)
-
 DEFAULT_SQLSERVER_CONFIG = {
     "SERVER": "bird_critic_sqlserver",  # Docker service or container name
     "PORT": 1433,
@@ -128,6 +114,47 @@ DEFAULT_SQLSERVER_CONFIG = {
 }
 
 
+def configure_db_host(host=None, port=None):
+    """
+    Point this process at a specific SQL Server instance (used when a run is
+    sharded across several hosts).
+    """
+    if host:
+        DEFAULT_SQLSERVER_CONFIG["SERVER"] = host
+    if port:
+        DEFAULT_SQLSERVER_CONFIG["PORT"] = int(port)
+
+
+def _kill_session(spid):
+    """
+    KILL the session running the timed-out statement, over a separate
+    connection. SQL Server has no per-statement KILL, so the session goes;
+    its open transaction is rolled back.
+    """
+    killer = pymssql.connect(
+        server=DEFAULT_SQLSERVER_CONFIG["SERVER"],
+        port=DEFAULT_SQLSERVER_CONFIG["PORT"],
+        user=DEFAULT_SQLSERVER_CONFIG["USER"],
+        password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+        database="master",
+        login_timeout=10,
+    )
+    try:
+        killer.autocommit(True)
+        cursor = killer.cursor()
+        cursor.execute(f"KILL {int(spid)}")
+    finally:
+        killer.close()
+
+
+def is_timeout_error(e):
+    """True if e comes from a statement that was stopped for running too long."""
+    if isinstance(e, deadline.DeadlineExceeded) or deadline.expired():
+        return True
+    # 20003: DB-Lib "Adaptive Server connection timed out" (query timeout)
+    return "20003" in str(e)
+
+
 def perform_query_on_sqlserver_databases(query, db_name, conn=None, as_dict=False):
     if conn == None:
         conn = pymssql.connect(
@@ -137,15 +164,24 @@ def perform_query_on_sqlserver_databases(query, db_name, conn=None, as_dict=Fals
             password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
             database=db_name,
         )
+        if deadline.get_deadline() is not None:
+            cursor = conn.cursor()
+            cursor.execute("SELECT @@SPID")
+            spid = cursor.fetchone()[0]
+            cursor.close()
+            deadline.watch(conn, lambda c, spid=spid: _kill_session(spid))
+    if deadline.get_deadline() is not None:
+        # Query timeout in whole seconds, capped at the time left
+        conn._conn.query_timeout = max(1, int(deadline.cap(None)))
     cursor = conn.cursor(as_dict=as_dict)
     try:
         cursor.execute(query)
-        sql_tokens = query.lower().split()
-        # print(sql_tokens)
-        if any(kw in sql_tokens for kw in SQLSERVER_COMMIT_KEYWORDS):
+        # Commit only statements that can have written something
+        if sql_lexer.needs_commit(query, "sqlserver"):
             conn.commit()
         try:
-            rows = cursor.fetchall()
+            # A later execute on conn discards the rows left past the caps
+            rows = fetch_limits.fetch(cursor)
         except pymssql.OperationalError:
             rows = None
         return rows, conn
@@ -161,27 +197,153 @@ def close_sqlserver_connection(conn):
         conn.close()
 
 
-def reset_and_restore_database(db_name, logger=None):
+def wait_for_quiescence(
+    db_name, server=None, port=None, timeout=QUIESCE_TIMEOUT_SECONDS, logger=None
+):
     """
-    Reset and restore a SQL Server database to a known initial state.
+    Wait until no other user session is in db_name, polling
+    sys.dm_exec_sessions with exponential backoff. Returns True once it is
+    idle.
     """
-    if logger is None:
-        logger = PrintLogger()
-
-    logger.info(f"Resetting database [{db_name}] ...")
-
-    master_conn = None
+    logger = logger or PrintLogger()
     try:
-        master_conn = pymssql.connect(
-            server="bird_critic_sqlserver",
-            port=1433,
-            user="sa",
-            password="Y.sa123123",
+        conn = pymssql.connect(
+            server=server or DEFAULT_SQLSERVER_CONFIG["SERVER"],
+            port=port or DEFAULT_SQLSERVER_CONFIG["PORT"],
+            user=DEFAULT_SQLSERVER_CONFIG["USER"],
+            password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
             database="master",
+            login_timeout=10,
         )
-        master_conn.autocommit(True)
-        cur = master_conn.cursor()
+    except pymssql.Error as e:
+        logger.error(f"Cannot check sessions in {db_name}: {e}")
+        return False
+    try:
+        conn.autocommit(True)
+        cursor = conn.cursor()
+
+        def idle():
+            cursor.execute(
+                "SELECT COUNT(*) FROM sys.dm_exec_sessions "
+                "WHERE database_id = DB_ID(%s) AND session_id <> @@SPID "
+                "AND is_user_process = 1",
+                (db_name,),
+            )
+            return cursor.fetchone()[0] == 0
+
+        return bool(
+            wait_until(idle, timeout, logger, what=f"sessions in {db_name} to end")
+        )
+    finally:
+        conn.close()
+
+
+MSSQL_BACKUP_DIR = "/app/mssql_table_dumps"
+SNAPSHOT_SUFFIX = "_template_snapshot"
+EPHEMERAL_INFIX = "_process_"
+SNAPSHOT = "snapshot"
+BACKUP = "backup"
+EMPTY = "empty"
+RESET_STRATEGIES = (SNAPSHOT, BACKUP)
+
+
+def base_db_name(db_name):
+    """The database an ephemeral copy <db>_process_<i> was made from."""
+    return db_name.split(EPHEMERAL_INFIX)[0]
+
+
+class DatabaseResetter:
+    """
+    Resets SQL Server databases to their template state over a connection to
+    master (pymssql's, or a fake one in tests). Two strategies:
+
+        snapshot  RESTORE DATABASE ... FROM DATABASE_SNAPSHOT, which only
+                  rewrites the pages changed since the snapshot was taken
+        backup    drop the database and RESTORE DATABASE ... FROM DISK its
+                  <db>_template.bak, reading the whole backup (an empty
+                  database is created if there is none)
+
+    The snapshot <db>_template_snapshot is taken right after a restore from
+    the backup, so it always holds the template state; it is kept on the
+    server and reused by later resets and runs. A database without one is
+    restored from the backup once. If a snapshot cannot be created or
+    reverted to, the backup is used. The time of each reset is recorded per
+    strategy.
+
+    An ephemeral copy <db>_process_<i> is restored from <db>'s backup, with
+    its files moved to <copy>_<logical name> next to the original ones.
+    """
+
+    def __init__(self, strategy=SNAPSHOT, backup_dir=MSSQL_BACKUP_DIR):
+        self.strategy = strategy
+        self.backup_dir = backup_dir
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def snapshot_name(self, db_name):
+        return f"{db_name}{SNAPSHOT_SUFFIX}"
+
+    def reset(self, conn, db_name, logger):
+        """
+        Reset db_name over conn, a connection to master. Returns (strategy,
+        seconds), the strategy being "snapshot", "backup" or "empty".
+        """
+        start = time.time()
+        conn.autocommit(True)
+        cur = conn.cursor()
+        strategy = None
+        if self.strategy == SNAPSHOT and self._has_snapshot(cur, db_name):
+            try:
+                self._revert_to_snapshot(cur, db_name, logger)
+                strategy = SNAPSHOT
+            except Exception as e:
+                logger.warning(
+                    f"[Reset] Cannot revert {db_name} to its snapshot ({e}); "
+                    "restoring it from the backup"
+                )
+        if strategy is None:
+            strategy = self._restore_from_backup(cur, db_name, logger)
+            if self.strategy == SNAPSHOT and strategy == BACKUP:
+                self._create_snapshot(cur, db_name, logger)
+        elapsed = time.time() - start
+        self.record(strategy, elapsed)
+        logger.info(f"[Reset] {db_name} reset from {strategy} in {elapsed:.2f}s")
+        return strategy, elapsed
+
+    def record(self, strategy, seconds, count=1):
+        with self._lock:
+            entry = self.timings.setdefault(strategy, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+    def report(self):
+        """Timings for the evaluator's result (JSON serialisable)."""
+        with self._lock:
+            return {strategy: list(entry) for strategy, entry in self.timings.items()}
+
+    def absorb(self, report):
+        """Add the timings an evaluator reported."""
+        for strategy, (count, seconds) in (report or {}).items():
+            self.record(strategy, seconds, count)
+
+    def summary(self):
+        with self._lock:
+            parts = [
+                f"{strategy} {count} (avg {seconds / count:.2f}s)"
+                for strategy, (count, seconds) in sorted(self.timings.items())
+                if count
+            ]
+        return f"Database restores: {', '.join(parts) or 'none'}"
+
+    def _has_snapshot(self, cur, db_name):
+        cur.execute(
+            "SELECT COUNT(*) FROM sys.databases "
+            "WHERE name = %s AND source_database_id = DB_ID(%s)",
+            (self.snapshot_name(db_name), db_name),
+        )
+        return cur.fetchone()[0] > 0
 
+    def _kill_sessions(self, cur, db_name, logger):
         kill_sql = f"""
         DECLARE @kill varchar(8000) = '';
         SELECT @kill = @kill + 'KILL ' + CONVERT(varchar(5), session_id) + ';'
@@ -197,30 +359,129 @@ def reset_and_restore_database(db_name, logger=None):
         logger.info(f"[Reset] Killing active connections for DB {db_name} ...")
         cur.execute(kill_sql)
 
+    def _revert_to_snapshot(self, cur, db_name, logger):
+        snapshot = self.snapshot_name(db_name)
+        logger.info(f"[Reset] Reverting DB {db_name} to snapshot {snapshot} ...")
+        # Reverting needs the database to itself
+        cur.execute(
+            f"ALTER DATABASE [{db_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE"
+        )
+        try:
+            cur.execute(
+                f"RESTORE DATABASE [{db_name}] FROM DATABASE_SNAPSHOT = '{snapshot}'"
+            )
+        finally:
+            cur.execute(f"ALTER DATABASE [{db_name}] SET MULTI_USER")
+
+    def _drop_snapshot(self, cur, db_name):
+        snapshot = self.snapshot_name(db_name)
+        cur.execute(f"IF DB_ID('{snapshot}') IS NOT NULL DROP DATABASE [{snapshot}];")
+
+    def drop(self, cur, db_name, logger):
+        """Kill the sessions of db_name and drop it with its snapshot."""
+        self._kill_sessions(cur, db_name, logger)
+
+        # A database with a snapshot can neither be dropped nor restored
+        self._drop_snapshot(cur, db_name)
         drop_sql = f"IF DB_ID('{db_name}') IS NOT NULL DROP DATABASE [{db_name}];"
         logger.info(f"[Reset] Dropping DB {db_name} if exists ...")
         cur.execute(drop_sql)
 
-        backup_file = f"/app/mssql_table_dumps/{db_name}_template.bak"
+    def _move_clauses(self, cur, db_name, backup_file):
+        """MOVE clauses giving the files of db_name's restore their own names."""
+        cur.execute(f"RESTORE FILELISTONLY FROM DISK = '{backup_file}'")
+        clauses = ""
+        for row in cur.fetchall():
+            logical_name, physical_name = row[0], row[1]
+            sep = "\\" if "\\" in physical_name else "/"
+            directory, _, file_name = physical_name.rpartition(sep)
+            extension = os.path.splitext(file_name)[1]
+            target = f"{directory}{sep}{db_name}_{logical_name}{extension}"
+            clauses += f"\n                 MOVE '{logical_name}' TO '{target}',"
+        return clauses
+
+    def _restore_from_backup(self, cur, db_name, logger):
+        self.drop(cur, db_name, logger)
+
+        backup_file = f"{self.backup_dir}/{base_db_name(db_name)}_template.bak"
         if os.path.exists(backup_file):
             logger.info(f"[Reset] Restoring DB {db_name} from {backup_file} ...")
+            # A copy must not reuse the files of the database it copies
+            move = ""
+            if db_name != base_db_name(db_name):
+                move = self._move_clauses(cur, db_name, backup_file)
             restore_sql = f"""
             RESTORE DATABASE [{db_name}]
             FROM DISK = '{backup_file}'
             WITH REPLACE,
-                 RECOVERY,
+                 RECOVERY,{move}
                  STATS = 5
             """
             cur.execute(restore_sql)
             logger.info(f"[Reset] Database {db_name} restored successfully.")
-        else:
+            return BACKUP
+        logger.warning(f"[Reset] {backup_file} not found, creating empty DB {db_name}")
+        create_db_sql = f"CREATE DATABASE [{db_name}];"
+        cur.execute(create_db_sql)
+        logger.info(f"[Reset] Empty database {db_name} created.")
+        return EMPTY
+
+    def _create_snapshot(self, cur, db_name, logger):
+        """Snapshot db_name (just restored); a failure only leaves it without one."""
+        snapshot = self.snapshot_name(db_name)
+        try:
+            # One sparse file per data file, next to it
+            cur.execute(
+                "SELECT name, physical_name FROM sys.master_files "
+                "WHERE database_id = DB_ID(%s) AND type = 0",
+                (db_name,),
+            )
+            files = ", ".join(
+                f"(NAME = [{name}], FILENAME = '{path.rsplit('.', 1)[0]}"
+                f"{SNAPSHOT_SUFFIX}.ss')"
+                for name, path in cur.fetchall()
+            )
+            cur.execute(
+                f"CREATE DATABASE [{snapshot}] ON {files} AS SNAPSHOT OF [{db_name}]"
+            )
+            logger.info(f"[Reset] Created snapshot {snapshot} of {db_name}")
+        except Exception as e:
             logger.warning(
-                f"[Reset] {backup_file} not found, creating empty DB {db_name}"
+                f"[Reset] Cannot create snapshot {snapshot} ({e}); "
+                f"{db_name} will be restored from the backup"
             )
-            create_db_sql = f"CREATE DATABASE [{db_name}];"
-            cur.execute(create_db_sql)
-            logger.info(f"[Reset] Empty database {db_name} created.")
 
+
+# The resetter of this process
+resetter = DatabaseResetter()
+
+
+def configure_reset_strategy(strategy):
+    """Reset databases from snapshots ("snapshot") or always from backups ("backup")."""
+    resetter.strategy = strategy
+
+
+def reset_and_restore_database(db_name, logger=None, server=None, port=None):
+    """
+    Reset and restore a SQL Server database to a known initial state (see
+    DatabaseResetter). server/port default to DEFAULT_SQLSERVER_CONFIG.
+    Returns the strategy used and the time it took.
+    """
+    if logger is None:
+        logger = PrintLogger()
+
+    logger.info(f"Resetting database [{db_name}] ...")
+
+    master_conn = None
+    try:
+        master_conn = pymssql.connect(
+            server=server or DEFAULT_SQLSERVER_CONFIG["SERVER"],
+            port=port or DEFAULT_SQLSERVER_CONFIG["PORT"],
+            user=DEFAULT_SQLSERVER_CONFIG["USER"],
+            password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+            database="master",
+        )
+        return resetter.reset(master_conn, db_name, logger)
     except Exception as e:
         logger.error(f"Error resetting {db_name} from backup or template: {e}")
         raise
@@ -229,6 +490,45 @@ def reset_and_restore_database(db_name, logger=None):
             master_conn.close()
 
 
+def create_ephemeral_db_copy(base_db, copy_index, logger, server=None, port=None):
+    """
+    Restore the ephemeral copy <base_db>_process_<copy_index> from base_db's
+    backup and return its name.
+    """
+    ephemeral_name = f"{base_db}{EPHEMERAL_INFIX}{copy_index}"
+    logger.info(f"Creating ephemeral db {ephemeral_name} from {base_db}'s backup")
+    reset_and_restore_database(ephemeral_name, logger, server=server, port=port)
+    reset_ledger.mark_clean(ephemeral_name, "created")
+    return ephemeral_name
+
+
+def drop_ephemeral_dbs(db_names, logger, server=None, port=None):
+    """
+    Drop the ephemeral copies db_names (and their snapshots) over one
+    connection to master. Returns the names that could not be dropped.
+    """
+    failed = []
+    master_conn = pymssql.connect(
+        server=server or DEFAULT_SQLSERVER_CONFIG["SERVER"],
+        port=port or DEFAULT_SQLSERVER_CONFIG["PORT"],
+        user=DEFAULT_SQLSERVER_CONFIG["USER"],
+        password=DEFAULT_SQLSERVER_CONFIG["PASSWORD"],
+        database="master",
+    )
+    try:
+        master_conn.autocommit(True)
+        cur = master_conn.cursor()
+        for db_name in db_names:
+            try:
+                resetter.drop(cur, db_name, logger)
+            except Exception as e:
+                logger.error(f"Failed to drop ephemeral DB {db_name}: {e}")
+                failed.append(db_name)
+    finally:
+        master_conn.close()
+    return failed
+
+
 def get_connection_for_phase(db_name, logger=None):
     """
     Obtain a dedicated connection for the current phase.
@@ -255,6 +555,8 @@ def execute_queries(
     if logger is None:
         logger = PrintLogger()
 
+    if not all(sql_lexer.is_read_only(query, "sqlserver") for query in queries):
+        reset_ledger.mark_dirty(db_name, section_title or "queries")
     log_section_header(section_title, logger)
     query_result = None
     execution_error = False
@@ -262,15 +564,25 @@ def execute_queries(
 
     for i, query in enumerate(queries):
         try:
+            deadline.check()
             logger.info(f"Executing query {i+1}/{len(queries)}: {query}")
             query_result, conn = perform_query_on_sqlserver_databases(
                 query, db_name, conn, as_dict=as_dict
             )
             logger.info(f"[execute_queries] Query result:: {query_result}")
+        except deadline.DeadlineExceeded as e:
+            # Out of time: the remaining queries are not run
+            logger.error(f"[execute_queries] Timeout before query {i}: {e}")
+            if is_solution:
+                timeout_error = True
+            break
         except pymssql.OperationalError as e:
             logger.error(f"[execute_queries] OperationalError executing query {i}: {e}")
             if is_solution:
-                execution_error = True
+                if is_timeout_error(e):
+                    timeout_error = True
+                else:
+                    execution_error = True
         except pymssql.Error as e:
             logger.error(f"[execute_queries] pymssql Error executing query {i}: {e}")
             if is_solution:
@@ -335,6 +647,7 @@ def generate_report_and_output(
     number_of_timeouts,
     number_of_assertion_errors,
     total_passed_instances,
+    save_status_file=True,
 ):
     """
     Generate the final report and output JSONL with status.
@@ -418,12 +731,13 @@ def generate_report_and_output(
 
     print("Overall report generated:", report_file_path)
 
-    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
-    with open(output_jsonl_file, "w", encoding="utf-8") as f:
-        for data in output_data:
-            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+    if save_status_file:
+        output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
+        with open(output_jsonl_file, "w", encoding="utf-8") as f:
+            for data in output_data:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
 
-    print("Done. Output JSONL:", output_jsonl_file)
+        print("Done. Output JSONL:", output_jsonl_file)
 
 
 def generate_category_report(
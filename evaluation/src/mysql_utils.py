@@ -16,47 +16,23 @@ import logging
 from queue import Queue
 import subprocess
 import sys
+import threading
 
 import json
 import re
 import os, csv
 from logger import PrintLogger, log_section_footer, log_section_header
+import deadline
+import read_only
+import reset_ledger
+import sql_lexer
+import transaction_sandbox
+from quiescence import QUIESCE_TIMEOUT_SECONDS, wait_until
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-MYSQL_COMMIT_KEYWORDS = (
-    "insert",
-    "update",
-    "delete",
-    "create",
-    "drop",
-    "alter",
-    "truncate",
-    "rename",
-    "replace",
-    "grant",
-    "revoke",
-    "lock tables",
-    "unlock tables",
-    "start transaction",
-    "begin",
-    "commit",
-    "rollback",
-    "call",
-    "load data",
-    "set",
-    "do",
-    "handler",
-    "load xml",
-    "merge",
-    "prepare",
-    "execute",
-    "deallocate prepare",
-    "xa",
-)
-
 # In PostgreSQL code, there's a dictionary _postgresql_pools. We'll mirror that:
 _mysql_pools = {}
 
@@ -123,6 +99,18 @@ class SimpleMySQLConnectionPool:
             conn.close()
 
 
+def configure_db_host(host=None, port=None):
+    """
+    Point this process at a specific MySQL server (used when a run is
+    sharded across several hosts). Existing pools are closed.
+    """
+    if host:
+        DEFAULT_DB_CONFIG["host"] = host
+    if port:
+        DEFAULT_DB_CONFIG["port"] = int(port)
+    close_all_mysql_pools()
+
+
 def _get_or_init_pool(db_name):
     """
     Returns a connection pool for the given database name, creating one if it does not exist.
@@ -138,13 +126,42 @@ def _get_or_init_pool(db_name):
     return _mysql_pools[db_name]
 
 
+# Server error codes for a statement stopped by KILL QUERY (1317) or by
+# MAX_EXECUTION_TIME (3024)
+MYSQL_TIMEOUT_ERROR_CODES = (1317, 3024)
+
+
+def _kill_query(conn):
+    """KILL QUERY the statement running on conn, over a separate connection."""
+    killer = pymysql.connect(
+        host=DEFAULT_DB_CONFIG["host"],
+        port=DEFAULT_DB_CONFIG["port"],
+        user=DEFAULT_DB_CONFIG["user"],
+        password=DEFAULT_DB_CONFIG["password"],
+        connect_timeout=10,
+    )
+    try:
+        with killer.cursor() as cursor:
+            cursor.execute(f"KILL QUERY {conn.thread_id()}")
+    finally:
+        killer.close()
+
+
+def is_timeout_error(e):
+    """True if e comes from a statement that was stopped for running too long."""
+    if isinstance(e, deadline.DeadlineExceeded) or deadline.expired():
+        return True
+    return bool(e.args) and e.args[0] in MYSQL_TIMEOUT_ERROR_CODES
+
+
 def perform_query_on_mysql_databases(query, db_name, conn=None):
     """
     Executes the given query on the specified MySQL database.
 
-    1. If conn is None, we fetch a connection from the pool.
+    1. If conn is None, we fetch a connection from the pool (or use the
+       transaction sandbox's connection while one is active).
     2. If conn is provided, we reuse that connection.
-    3. We automatically commit if it's a write operation (based on keywords).
+    3. We automatically commit if it's a write operation (see sql_lexer).
     4. We return (result, conn) so the caller can reuse 'conn' for subsequent queries.
 
     Args:
@@ -163,24 +180,36 @@ def perform_query_on_mysql_databases(query, db_name, conn=None):
     pool = _get_or_init_pool(db_name)
     need_to_put_back = False  # Whether we acquired this conn from the pool
 
-    if conn is None:
+    if conn is None and transaction_sandbox.active():
+        # Every statement of a sandboxed instance runs in its transaction
+        conn = transaction_sandbox.connection()
+    elif conn is None:
         conn = pool.getconn()
         need_to_put_back = True
 
-    # Attempt to set a max execution time for safety (120 seconds = 120000 ms)
+    deadline.watch(conn, _kill_query)
+
+    # Attempt to set a max execution time for safety (120 seconds = 120000 ms),
+    # capped at the instance's remaining budget
     try:
         with conn.cursor() as tmp_cursor:
-            tmp_cursor.execute("SET SESSION MAX_EXECUTION_TIME=120000;")
+            max_execution_ms = int(deadline.cap(120) * 1000)
+            tmp_cursor.execute(f"SET SESSION MAX_EXECUTION_TIME={max_execution_ms};")
     except Exception as e:
         logger.warning(f"Could not set MAX_EXECUTION_TIME: {e}")
+    if read_only.active():
+        # Read-only instance: a write fails instead of changing the database
+        with conn.cursor() as tmp_cursor:
+            tmp_cursor.execute("SET SESSION TRANSACTION READ ONLY;")
 
+    transaction_sandbox.check_statement(query)
     cursor = conn.cursor()
     try:
         cursor.execute(query)
-        lower_q = query.strip().lower()
 
-        # Auto-commit if we find any commit keyword
-        if any(kw in lower_q for kw in MYSQL_COMMIT_KEYWORDS):
+        # Commit only statements that can have written something (a savepoint
+        # in the transaction sandbox)
+        if sql_lexer.needs_commit(query, "mysql"):
             conn.commit()
 
         try:
@@ -195,6 +224,7 @@ def perform_query_on_mysql_databases(query, db_name, conn=None):
 
     except Exception as e:
         conn.rollback()  # rollback on error
+        read_only.check_error(e, query)
         raise e
 
     finally:
@@ -207,6 +237,18 @@ def perform_query_on_mysql_databases(query, db_name, conn=None):
             pass
 
 
+def non_transactional_tables(db_name, conn):
+    """Names of the tables of db_name whose changes cannot be rolled back."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE' "
+            "AND ENGINE <> 'InnoDB'",
+            (db_name,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
 def close_mysql_connection(db_name, conn):
     """
     After the user is finished using this connection (e.g., after multiple queries),
@@ -244,42 +286,387 @@ def get_conn(db_name):
     return pool.getconn()
 
 
+def wait_for_quiescence(
+    db_name,
+    mysql_password,
+    mysql_host=None,
+    mysql_port=None,
+    timeout=QUIESCE_TIMEOUT_SECONDS,
+    logger=None,
+):
+    """
+    Wait until no other connection is using db_name, polling the
+    PROCESSLIST with exponential backoff. Returns True once it is idle.
+    """
+    logger = logger or PrintLogger()
+    try:
+        conn = pymysql.connect(
+            host=mysql_host or DEFAULT_DB_CONFIG["host"],
+            port=mysql_port or DEFAULT_DB_CONFIG["port"],
+            user=DEFAULT_DB_CONFIG["user"],
+            password=mysql_password,
+            connect_timeout=10,
+        )
+    except pymysql.MySQLError as e:
+        logger.error(f"Cannot check connections to {db_name}: {e}")
+        return False
+    try:
+        with conn.cursor() as cursor:
+
+            def idle():
+                cursor.execute(
+                    "SELECT COUNT(*) FROM information_schema.PROCESSLIST "
+                    "WHERE DB = %s AND ID <> CONNECTION_ID()",
+                    (db_name,),
+                )
+                return cursor.fetchone()[0] == 0
+
+            return bool(
+                wait_until(
+                    idle, timeout, logger, what=f"connections to {db_name} to end"
+                )
+            )
+    finally:
+        conn.close()
+
+
 # -------------------------------------------------------------------
-# Functions to reset ephemeral DB by "cloning" from a pre-dumped file
+# Functions to reset ephemeral DBs by cloning the <db>_template schema
 # -------------------------------------------------------------------
+# The <db>_template schemas stay loaded on the server (the init script loads
+# them; ensure_template_schema loads a missing one from its dump once). A
+# clone is copied on the server, table by table: its SHOW CREATE TABLE DDL
+# plus INSERT ... SELECT on CLONE_WORKERS connections, with binary logging and
+# foreign-key/unique checks off, instead of re-parsing the whole SQL dump.
+TEMPLATE_DUMP_DIR = "/app/mysql_table_dumps"
+CLONE_WORKERS = 4
+DROP_WORKERS = 4
+
+_template_locks = {}
+_template_locks_lock = threading.Lock()
+
+
+def _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port, database=None):
+    return pymysql.connect(
+        host=mysql_host,
+        user=mysql_user,
+        password=mysql_password,
+        port=mysql_port,
+        database=database,
+        connect_timeout=10,
+        autocommit=True,
+    )
+
+
+def _bulk_load_session(cur, logger):
+    """Turn off binary logging and foreign-key/unique checks for a copy."""
+    cur.execute("SET SESSION foreign_key_checks = 0")
+    cur.execute("SET SESSION unique_checks = 0")
+    try:
+        cur.execute("SET SESSION sql_log_bin = 0")
+    except pymysql.MySQLError as e:
+        # Needs SUPER / SYSTEM_VARIABLES_ADMIN; the copy still works without
+        logger.warning(f"Cannot turn off binary logging for the copy: {e}")
+
+
+def _terminate_connections(cur, db_names, logger):
+    """KILL every other connection using one of db_names, in one pass."""
+    wanted = {db_name.lower() for db_name in db_names}
+    cur.execute(
+        "SELECT ID, DB FROM information_schema.PROCESSLIST "
+        "WHERE ID <> CONNECTION_ID()"
+    )
+    for process_id, db_in_use in cur.fetchall():
+        if db_in_use and db_in_use.lower() in wanted:
+            logger.info(f"Killing connection {process_id} to {db_in_use}")
+            try:
+                cur.execute(f"KILL {int(process_id)}")
+            except pymysql.MySQLError as e:
+                # It may have ended on its own in the meantime
+                logger.warning(f"Failed to KILL {process_id}: {e}")
+
+
 def terminate_mysql_connections(
     db_name, mysql_user, mysql_password, mysql_host, mysql_port, logger
 ):
     """
-    Forcibly terminates all connections to `db_name` in MySQL by:
-      1) SHOW PROCESSLIST
-      2) KILL <process_id> for rows where the database = `db_name`
+    Forcibly terminates all connections to `db_name` in MySQL by KILLing the
+    PROCESSLIST rows whose database is `db_name`.
     """
     logger.info(f"Terminating all connections to MySQL DB: {db_name}")
     try:
-        conn = pymysql.connect(
-            host=mysql_host,
-            user=mysql_user,
-            password=mysql_password,
-            port=mysql_port,
-            database="information_schema",  # any DB is fine to run SHOW PROCESSLIST
+        conn = _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port)
+        try:
+            with conn.cursor() as cur:
+                _terminate_connections(cur, [db_name], logger)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.warning(f"Unable to terminate connections for {db_name}: {e}")
+
+
+def ensure_template_schema(
+    template_db, mysql_user, mysql_password, mysql_host, mysql_port, logger
+):
+    """
+    Make sure the schema template_db is loaded on the server. If it is
+    missing, it is loaded (once) from TEMPLATE_DUMP_DIR/<template_db>_dump.sql.
+    """
+    key = (mysql_host, mysql_port, template_db)
+    with _template_locks_lock:
+        lock = _template_locks.setdefault(key, threading.Lock())
+    with lock:
+        conn = _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT COUNT(*) FROM information_schema.SCHEMATA "
+                    "WHERE SCHEMA_NAME = %s",
+                    (template_db,),
+                )
+                if cur.fetchone()[0]:
+                    return
+                cur.execute(
+                    f"CREATE DATABASE `{template_db}` "
+                    "DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci"
+                )
+
+            dump_file = f"{TEMPLATE_DUMP_DIR}/{template_db}_dump.sql"
+            logger.info(f"Loading template schema {template_db} from {dump_file}")
+            load_cmd = [
+                "mysql",
+                f"-h{mysql_host}",
+                f"-P{mysql_port}",
+                f"-u{mysql_user}",
+                f"-p{mysql_password}",
+                "--init-command=SET SESSION sql_log_bin = 0",
+                template_db,
+            ]
+            try:
+                with open(dump_file, "rb") as fin:
+                    load_proc = subprocess.run(
+                        load_cmd,
+                        stdin=fin,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        check=False,
+                    )
+                if load_proc.returncode != 0:
+                    raise RuntimeError(
+                        f"Failed to load {template_db} from {dump_file}, stderr:\n"
+                        f"{load_proc.stderr.decode('utf-8', 'replace')}"
+                    )
+            except Exception:
+                # Do not leave a half-loaded template behind for the next clone
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP DATABASE IF EXISTS `{template_db}`")
+                raise
+            logger.info(f"Loaded template schema {template_db}")
+        finally:
+            conn.close()
+
+
+def _copy_tables(
+    tables,
+    columns,
+    template_db,
+    target_db,
+    mysql_user,
+    mysql_password,
+    mysql_host,
+    mysql_port,
+    logger,
+):
+    """Create and fill `tables` of target_db from template_db on one connection."""
+    conn = _admin_connect(
+        mysql_user, mysql_password, mysql_host, mysql_port, database=target_db
+    )
+    try:
+        with conn.cursor() as cur:
+            _bulk_load_session(cur, logger)
+            for table in tables:
+                # Replay the DDL rather than CREATE TABLE ... LIKE, which drops
+                # foreign keys and the table's AUTO_INCREMENT counter
+                cur.execute(f"SHOW CREATE TABLE `{template_db}`.`{table}`")
+                cur.execute(cur.fetchone()[1])
+                # Generated columns are left out: they cannot be inserted into
+                column_list = ", ".join(f"`{c}`" for c in columns.get(table, []))
+                if column_list:
+                    cur.execute(
+                        f"INSERT INTO `{table}` ({column_list}) "
+                        f"SELECT {column_list} FROM `{template_db}`.`{table}`"
+                    )
+    finally:
+        conn.close()
+
+
+def _copy_schema_objects(cur, template_db, target_db, views, logger):
+    """
+    Copy the views, routines and triggers of template_db into target_db (the
+    current database of cur). Triggers come last so that the table copy does
+    not fire them.
+    """
+    # Views may select from other views: create them in passes until every
+    # view exists or a pass makes no progress
+    pending = list(views)
+    while pending:
+        failed = []
+        for view in pending:
+            cur.execute(f"SHOW CREATE VIEW `{template_db}`.`{view}`")
+            ddl = cur.fetchone()[1].replace(f"`{template_db}`.", f"`{target_db}`.")
+            try:
+                cur.execute(ddl)
+            except pymysql.MySQLError:
+                failed.append(view)
+        if len(failed) == len(pending):
+            raise RuntimeError(f"Cannot copy views {failed} of {template_db}")
+        pending = failed
+
+    cur.execute(
+        "SELECT ROUTINE_NAME, ROUTINE_TYPE FROM information_schema.ROUTINES "
+        "WHERE ROUTINE_SCHEMA = %s",
+        (template_db,),
+    )
+    routines = cur.fetchall()
+    cur.execute(
+        "SELECT TRIGGER_NAME FROM information_schema.TRIGGERS "
+        "WHERE TRIGGER_SCHEMA = %s ORDER BY EVENT_OBJECT_TABLE, ACTION_ORDER",
+        (template_db,),
+    )
+    triggers = [("TRIGGER", row[0]) for row in cur.fetchall()]
+    for object_type, name in [(t, n) for n, t in routines] + triggers:
+        cur.execute(f"SHOW CREATE {object_type} `{template_db}`.`{name}`")
+        _, sql_mode, ddl = cur.fetchone()[:3]
+        cur.execute("SET SESSION sql_mode = %s", (sql_mode,))
+        cur.execute(ddl)
+    if routines or triggers:
+        logger.info(
+            f"Copied {len(routines)} routines and {len(triggers)} triggers "
+            f"into {target_db}"
         )
+
+
+def clone_template_schema(
+    template_db, target_db, mysql_user, mysql_password, mysql_host, mysql_port, logger
+):
+    """
+    (Re)create target_db on the server as a copy of the template schema
+    template_db: connections to target_db are killed, it is dropped, its
+    tables are copied in parallel, then its views, routines and triggers.
+    """
+    ensure_template_schema(
+        template_db, mysql_user, mysql_password, mysql_host, mysql_port, logger
+    )
+    conn = _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port)
+    try:
         with conn.cursor() as cur:
-            cur.execute("SHOW PROCESSLIST;")
+            _bulk_load_session(cur, logger)
+            _terminate_connections(cur, [target_db], logger)
+            cur.execute(f"DROP DATABASE IF EXISTS `{target_db}`")
+            cur.execute(
+                "SELECT DEFAULT_CHARACTER_SET_NAME, DEFAULT_COLLATION_NAME "
+                "FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = %s",
+                (template_db,),
+            )
+            charset, collation = cur.fetchone()
+            cur.execute(
+                f"CREATE DATABASE `{target_db}` "
+                f"DEFAULT CHARACTER SET {charset} COLLATE {collation}"
+            )
+            cur.execute(f"USE `{target_db}`")
+
+            # Largest tables first, dealt round-robin to the workers
+            cur.execute(
+                "SELECT TABLE_NAME, TABLE_TYPE FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = %s ORDER BY DATA_LENGTH DESC",
+                (template_db,),
+            )
             rows = cur.fetchall()
-            for row in rows:
-                process_id = row[0]
-                db_in_use = row[3]
-                if db_in_use and db_in_use.lower() == db_name.lower():
-                    kill_sql = f"KILL {process_id}"
-                    logger.info(f"Killing connection for process id: {process_id}")
-                    try:
-                        cur.execute(kill_sql)
-                    except Exception as e:
-                        logger.warning(f"Failed to KILL {process_id}: {e}")
+            tables = [name for name, kind in rows if kind == "BASE TABLE"]
+            views = [name for name, kind in rows if kind == "VIEW"]
+            cur.execute(
+                "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = %s AND COALESCE(GENERATION_EXPRESSION, '') = '' "
+                "ORDER BY TABLE_NAME, ORDINAL_POSITION",
+                (template_db,),
+            )
+            columns = {}
+            for table, column in cur.fetchall():
+                columns.setdefault(table, []).append(column)
+
+            workers = max(1, min(CLONE_WORKERS, len(tables)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        _copy_tables,
+                        tables[i::workers],
+                        columns,
+                        template_db,
+                        target_db,
+                        mysql_user,
+                        mysql_password,
+                        mysql_host,
+                        mysql_port,
+                        logger,
+                    )
+                    for i in range(workers)
+                ]
+                for fut in as_completed(futures):
+                    fut.result()
+
+            _copy_schema_objects(cur, template_db, target_db, views, logger)
+    finally:
         conn.close()
-    except Exception as e:
-        logger.warning(f"Unable to terminate connections for {db_name}: {e}")
+    logger.info(f"Cloned {target_db} from template schema {template_db}")
+
+
+def drop_databases(
+    db_names, mysql_user, mysql_password, mysql_host, mysql_port, logger
+):
+    """
+    Drop the databases db_names: their pools are closed, their connections
+    are KILLed in one PROCESSLIST pass over one admin connection, and the
+    DROPs run in parallel on DROP_WORKERS connections. Returns the names
+    that could not be dropped.
+    """
+    db_names = list(db_names)
+    if not db_names:
+        return []
+    for db_name in db_names:
+        close_mysql_pool(db_name)
+
+    conn = _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port)
+    try:
+        with conn.cursor() as cur:
+            _terminate_connections(cur, db_names, logger)
+    finally:
+        conn.close()
+
+    def drop_all(names):
+        failed = []
+        conn = _admin_connect(mysql_user, mysql_password, mysql_host, mysql_port)
+        try:
+            with conn.cursor() as cur:
+                _bulk_load_session(cur, logger)
+                for db_name in names:
+                    try:
+                        logger.info(f"Dropping database: {db_name}")
+                        cur.execute(f"DROP DATABASE IF EXISTS `{db_name}`")
+                    except pymysql.MySQLError as e:
+                        logger.error(f"Error dropping database {db_name}: {e}")
+                        failed.append(db_name)
+        finally:
+            conn.close()
+        return failed
+
+    workers = max(1, min(DROP_WORKERS, len(db_names)))
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for fut in [
+            executor.submit(drop_all, db_names[i::workers]) for i in range(workers)
+        ]:
+            failed.extend(fut.result())
+    return failed
 
 
 def reset_and_restore_database(
@@ -293,10 +680,8 @@ def reset_and_restore_database(
 ):
     """
     1) Close pool for ephemeral_db_name
-    2) Terminate all connections to ephemeral_db_name
-    3) DROP DATABASE ephemeral_db_name
-    4) CREATE DATABASE ephemeral_db_name
-    5) Load ephemeral_db_name from /app/mysql_table_dumps/<base_template_db_name>_dump.sql
+    2) Re-clone ephemeral_db_name from the template schema base_template_db_name
+       (connections are killed and the database is dropped first)
     """
     if logger is None:
         logger = PrintLogger()
@@ -311,103 +696,27 @@ def reset_and_restore_database(
     )
     close_mysql_pool(ephemeral_db_name)
 
-    # 2) Terminate connections
-    terminate_mysql_connections(
-        ephemeral_db_name, mysql_user, mysql_password, mysql_host, mysql_port, logger
-    )
-
-    # 3) DROP ephemeral DB
-    drop_sql = f"DROP DATABASE IF EXISTS `{ephemeral_db_name}`"
-    cmd_drop = [
-        "mysql",
-        f"-h{mysql_host}",
-        f"-P{mysql_port}",
-        f"-u{mysql_user}",
-        f"-p{mysql_password}",
-        "-e",
-        drop_sql,
-    ]
+    # 2) Clone from the template schema on the server
     try:
-        subprocess.run(
-            cmd_drop,
-            check=True,
-            timeout=90,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+        clone_template_schema(
+            base_template_db_name,
+            ephemeral_db_name,
+            mysql_user,
+            mysql_password,
+            mysql_host,
+            mysql_port,
+            logger,
         )
-        logger.info(f"Dropped DB {ephemeral_db_name} (if existed).")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error dropping DB {ephemeral_db_name}: {e}")
-        sys.exit(1)
-
-    # 4) CREATE ephemeral DB
-    create_sql = f"CREATE DATABASE `{ephemeral_db_name}`"
-    cmd_create = [
-        "mysql",
-        f"-h{mysql_host}",
-        f"-P{mysql_port}",
-        f"-u{mysql_user}",
-        f"-p{mysql_password}",
-        "-e",
-        create_sql,
-    ]
-    try:
-        subprocess.run(
-            cmd_create,
-            check=True,
-            timeout=90,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        logger.info(f"Created new DB {ephemeral_db_name}.")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error creating DB {ephemeral_db_name}: {e}")
-        sys.exit(1)
-
-    # 5) Load from the pre-dumped SQL file
-    #    e.g. /app/mysql_table_dumps/financial_template_dump.sql
-    dump_file = f"/app/mysql_table_dumps/{base_template_db_name}_dump.sql"
-    logger.info(f"Loading {ephemeral_db_name} from {dump_file}")
-    load_cmd = [
-        "mysql",
-        f"-h{mysql_host}",
-        f"-P{mysql_port}",
-        f"-u{mysql_user}",
-        f"-p{mysql_password}",
-        ephemeral_db_name,
-    ]
-    try:
-        with open(dump_file, "rb") as fin:
-            load_proc = subprocess.run(
-                load_cmd,
-                stdin=fin,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                timeout=300,  # Adjust if needed for large dumps
-                check=False,
-            )
-        if load_proc.returncode != 0:
-            logger.error(
-                f"Failed to load {ephemeral_db_name} from {dump_file}, "
-                f"stderr:\n{load_proc.stderr.decode('utf-8', 'replace')}"
-            )
-            sys.exit(1)
-
-        logger.info(f"Successfully loaded {ephemeral_db_name} from {dump_file}.")
-    except subprocess.TimeoutExpired as e:
-        logger.error(f"Timeout while loading {ephemeral_db_name} from {dump_file}: {e}")
-        sys.exit(1)
-    except FileNotFoundError:
-        logger.error(f"Dump file not found: {dump_file}")
-        sys.exit(1)
     except Exception as e:
-        logger.error(f"Unexpected error loading DB: {e}")
+        logger.error(
+            f"Error resetting {ephemeral_db_name} from {base_template_db_name}: {e}"
+        )
         sys.exit(1)
 
 
 def create_one_ephemeral_db(
     ephemeral_name,
-    dump_path,
+    template_db,
     mysql_host,
     mysql_port,
     mysql_user,
@@ -415,98 +724,76 @@ def create_one_ephemeral_db(
     logger,
 ):
     """
-    Creates one ephemeral DB named 'ephemeral_name' and loads it from 'dump_path'.
-    Returns the ephemeral_name if successful.
+    Creates one ephemeral DB named 'ephemeral_name' as a server-side clone of
+    the template schema 'template_db'. Returns the ephemeral_name if successful.
     """
-    # 1) Drop ephemeral DB if exists
-    drop_sql = f"DROP DATABASE IF EXISTS `{ephemeral_name}`"
-    drop_cmd = [
-        "mysql",
-        f"-h{mysql_host}",
-        f"-P{mysql_port}",
-        f"-u{mysql_user}",
-        f"-p{mysql_password}",
-        "-e",
-        drop_sql,
-    ]
-    subprocess.run(
-        drop_cmd,
-        check=False,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-
-    # 2) Create ephemeral DB
-    create_sql = f"CREATE DATABASE `{ephemeral_name}`"
-    create_cmd = [
-        "mysql",
-        f"-h{mysql_host}",
-        f"-P{mysql_port}",
-        f"-u{mysql_user}",
-        f"-p{mysql_password}",
-        "-e",
-        create_sql,
-    ]
-    subprocess.run(
-        create_cmd,
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-
-    # 3) Load ephemeral_name from the pre-dumped file
     try:
-        with open(dump_path, "rb") as fin:
-            load_cmd = [
-                "mysql",
-                f"-h{mysql_host}",
-                f"-P{mysql_port}",
-                f"-u{mysql_user}",
-                f"-p{mysql_password}",
-                ephemeral_name,
-            ]
-            load_proc = subprocess.run(
-                load_cmd,
-                stdin=fin,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                check=False,
-            )
-        if load_proc.returncode != 0:
-            logger.error(
-                f"Failed to load ephemeral DB {ephemeral_name} from {dump_path}, "
-                f"stderr:\n{load_proc.stderr.decode('utf-8', 'replace')}"
-            )
-            # Return None or raise an exception; here we'll raise for clarity
-            raise RuntimeError(f"Loading ephemeral DB {ephemeral_name} failed.")
-    except FileNotFoundError:
-        logger.error(f"Dump file not found: {dump_path}")
-        raise
+        clone_template_schema(
+            template_db,
+            ephemeral_name,
+            mysql_user,
+            mysql_password,
+            mysql_host,
+            mysql_port,
+            logger,
+        )
     except Exception as e:
-        logger.error(f"Unexpected error loading {ephemeral_name}: {e}")
+        logger.error(f"Unexpected error creating {ephemeral_name}: {e}")
         raise
 
     logger.info(
-        f"Successfully created ephemeral DB '{ephemeral_name}' from {dump_path}"
+        f"Successfully created ephemeral DB '{ephemeral_name}' from {template_db}"
     )
     return ephemeral_name
 
 
-def create_ephemeral_db_copies(base_db_names, num_copies, mysql_password, logger):
+def base_db_name(db_name):
+    """The database an ephemeral copy <db>_process_<i> was made from."""
+    return db_name.split("_process_")[0]
+
+
+def create_ephemeral_db_copy(
+    base_db, copy_index, mysql_password, logger, mysql_host=None, mysql_port=None
+):
+    """
+    Creates the single ephemeral DB <base_db>_process_<copy_index> as a clone
+    of the template schema <base_db>_template and returns its name.
+    """
+    ephemeral_name = f"{base_db}_process_{copy_index}"
+    template_db = f"{base_db}_template"
+    logger.info(f"Creating ephemeral db {ephemeral_name} from {template_db}")
+    return create_one_ephemeral_db(
+        ephemeral_name,
+        template_db,
+        mysql_host or DEFAULT_DB_CONFIG["host"],
+        mysql_port or DEFAULT_DB_CONFIG["port"],
+        DEFAULT_DB_CONFIG["user"],
+        mysql_password,
+        logger,
+    )
+
+
+def create_ephemeral_db_copies(
+    base_db_names,
+    num_copies,
+    mysql_password,
+    logger,
+    mysql_host=None,
+    mysql_port=None,
+):
     """
     Creates ephemeral DBs in parallel for each base DB:
         <base_db>_process_1, <base_db>_process_2, ...
-    Loads each from /app/mysql_table_dumps/<base_db>_template_dump.sql
+    Each is a clone of the template schema <base_db>_template.
     """
-    mysql_host = "bird_critic_mysql"
-    mysql_port = 3306
-    mysql_user = "root"
+    mysql_host = mysql_host or DEFAULT_DB_CONFIG["host"]
+    mysql_port = mysql_port or DEFAULT_DB_CONFIG["port"]
+    mysql_user = DEFAULT_DB_CONFIG["user"]
 
     ephemeral_db_pool = {}
 
     for base_db in base_db_names:
         template_db = base_db + "_template"  # e.g. "financial_template"
-        dump_path = f"/app/mysql_table_dumps/{template_db}_dump.sql"
 
         ephemeral_db_pool[base_db] = []
 
@@ -516,13 +803,13 @@ def create_ephemeral_db_copies(base_db_names, num_copies, mysql_password, logger
             for i in range(1, num_copies + 1):
                 ephemeral_name = f"{base_db}_process_{i}"
                 logger.info(
-                    f"Creating ephemeral db {ephemeral_name} from file: {dump_path}"
+                    f"Creating ephemeral db {ephemeral_name} from {template_db}"
                 )
 
                 fut = executor.submit(
                     create_one_ephemeral_db,
                     ephemeral_name,
-                    dump_path,
+                    template_db,
                     mysql_host,
                     mysql_port,
                     mysql_user,
@@ -554,6 +841,8 @@ def execute_queries(
     if logger is None:
         logger = PrintLogger()
 
+    if not all(sql_lexer.is_read_only(query, "mysql") for query in queries):
+        reset_ledger.mark_dirty(db_name, section_title or "queries")
     log_section_header(section_title, logger)
     query_result = None
     execution_error = False
@@ -561,16 +850,27 @@ def execute_queries(
     error_msg = ""
     for i, query in enumerate(queries):
         try:
+            deadline.check()
             logger.info(f"Executing query {i+1}/{len(queries)}: {query}")
             query_result, conn = perform_query_on_mysql_databases(
                 query, db_name, conn=conn
             )
             logger.info(f"Query result: {query_result}")
+        except deadline.DeadlineExceeded as e:
+            # Out of time: the remaining queries are not run
+            logger.error(f"Timeout before query {i+1}: {e}")
+            if is_solution:
+                timeout_error = True
+            error_msg += f"\n {str(e)}"
+            break
         except pymysql.err.OperationalError as e:
             # This could include timeouts or other operational issues
             logger.error(f"OperationalError executing query {i+1}: {e}")
             if is_solution:
-                execution_error = True
+                if is_timeout_error(e):
+                    timeout_error = True
+                else:
+                    execution_error = True
             error_msg += f"\n {str(e)}"
         except pymysql.err.InternalError as e:
             logger.error(f"InternalError executing query {i+1}: {e}")
@@ -644,6 +944,7 @@ def save_report_and_status(
     Writes a summary report to 'report_file_path' and, if logging_enabled is true,
     writes an updated JSONL file with status to <base_output_folder>_output_with_status.jsonl.
     """
+    output_index = {item.get("instance_id"): item for item in output_data}
     try:
         with open(report_file_path, "w") as report_file:
             report_file.write("--------------------------------------------------\n")
@@ -685,14 +986,12 @@ def save_report_and_status(
                     f"Question_{q_idx}: ({t_pass}/{t_total}) test cases passed, "
                     f"failed test cases: {failed_list_str}{error_phase_note}{sol_phase_note}\n"
                 )
-                for output_data_item in output_data:
-                    if output_data_item["instance_id"] == q_res["instance_id"]:
-                        output_data_item["status"] = q_res["status"]
-                        output_data_item["error_message"] = q_res["error_message"]
-                        output_data_item["original_schema"] = q_res["original_schema"]
-                        output_data_item["preprocess_schema"] = q_res[
-                            "preprocess_schema"
-                        ]
+                output_data_item = output_index.get(q_res["instance_id"])
+                if output_data_item is not None:
+                    output_data_item["status"] = q_res["status"]
+                    output_data_item["error_message"] = q_res["error_message"]
+                    output_data_item["original_schema"] = q_res["original_schema"]
+                    output_data_item["preprocess_schema"] = q_res["preprocess_schema"]
 
     except Exception as e:
         print(f"Failed to write report: {e}")
@@ -939,32 +1238,12 @@ def cleanup_ephemeral_databases(
             f"Found {len(ephemeral_dbs)} ephemeral databases to clean up: {ephemeral_dbs}"
         )
 
-        # 3. First terminate all connections
-        for db in ephemeral_dbs:
-            terminate_mysql_connections(
-                db, mysql_user, mysql_password, mysql_host, mysql_port, logger
-            )
-
-            # Also clean up any connection pools for this database
-            close_mysql_pool(db)
-
-        # 4. Drop each database
-        conn = pymysql.connect(
-            host=mysql_host, user=mysql_user, password=mysql_password, port=mysql_port
+        # 3. Terminate their connections and drop them
+        drop_databases(
+            ephemeral_dbs, mysql_user, mysql_password, mysql_host, mysql_port, logger
         )
 
-        with conn.cursor() as cur:
-            for db in ephemeral_dbs:
-                try:
-                    logger.info(f"Dropping database: {db}")
-                    cur.execute(f"DROP DATABASE IF EXISTS `{db}`")
-                    conn.commit()
-                except Exception as e:
-                    logger.error(f"Error dropping database {db}: {e}")
-
-        conn.close()
-
-        # 5. Clear all connection pools
+        # 4. Clear all connection pools
         close_all_mysql_pools()
 
         logger.info("Database cleanup completed successfully")
@@ -974,49 +1253,31 @@ def cleanup_ephemeral_databases(
         raise
 
 
-def drop_ephemeral_dbs(ephemeral_db_pool_dict, mysql_password, logger):
+def drop_ephemeral_dbs(
+    ephemeral_db_pool_dict, mysql_password, logger, mysql_host=None, mysql_port=None
+):
     """
     Enhanced version of drop_ephemeral_dbs with better error handling and cleanup.
     """
-    mysql_host = "bird_critic_mysql"
-    mysql_port = 3306
-    mysql_user = "root"
+    mysql_host = mysql_host or DEFAULT_DB_CONFIG["host"]
+    mysql_port = mysql_port or DEFAULT_DB_CONFIG["port"]
+    mysql_user = DEFAULT_DB_CONFIG["user"]
 
     logger.info("=== Starting cleanup of ephemeral databases ===")
 
     try:
-        # First cleanup all known ephemeral databases
-        for base_db, ephemeral_list in ephemeral_db_pool_dict.items():
-            for ephemeral_db in ephemeral_list:
-                logger.info(f"Processing cleanup for: {ephemeral_db}")
-
-                # 1. Terminate all connections
-                terminate_mysql_connections(
-                    ephemeral_db,
-                    mysql_user,
-                    mysql_password,
-                    mysql_host,
-                    mysql_port,
-                    logger,
-                )
-
-                # 2. Close connection pool
-                close_mysql_pool(ephemeral_db)
-
-                # 3. Drop database
-                try:
-                    conn = pymysql.connect(
-                        host=mysql_host,
-                        user=mysql_user,
-                        password=mysql_password,
-                        port=mysql_port,
-                    )
-                    with conn.cursor() as cur:
-                        cur.execute(f"DROP DATABASE IF EXISTS `{ephemeral_db}`")
-                        conn.commit()
-                    conn.close()
-                except Exception as e:
-                    logger.error(f"Failed to drop database {ephemeral_db}: {e}")
+        # First drop all known ephemeral databases
+        known = [
+            ephemeral_db
+            for ephemeral_list in ephemeral_db_pool_dict.values()
+            for ephemeral_db in ephemeral_list
+        ]
+        logger.info(f"Dropping ephemeral databases: {known}")
+        failed = drop_databases(
+            known, mysql_user, mysql_password, mysql_host, mysql_port, logger
+        )
+        if failed:
+            logger.error(f"Failed to drop databases: {failed}")
 
         # Then do a comprehensive cleanup to catch any missed databases
         cleanup_ephemeral_databases(
@@ -1041,18 +1302,22 @@ def drop_ephemeral_dbs(ephemeral_db_pool_dict, mysql_password, logger):
     logger.info("=== Completed cleanup of ephemeral databases ===")
 
 
-def enhanced_cleanup(mysql_password, logger, force=False):
+def enhanced_cleanup(
+    mysql_password, logger, force=False, mysql_host=None, mysql_port=None
+):
+    mysql_host = mysql_host or DEFAULT_DB_CONFIG["host"]
+    mysql_port = mysql_port or DEFAULT_DB_CONFIG["port"]
     try:
         cleanup_ephemeral_databases(
-            "root", mysql_password, "bird_critic_mysql", 3306, logger
+            "root", mysql_password, mysql_host, mysql_port, logger
         )
 
         if force:
             conn = pymysql.connect(
-                host="bird_critic_mysql",
+                host=mysql_host,
                 user="root",
                 password=mysql_password,
-                port=3306,
+                port=mysql_port,
             )
             try:
                 with conn.cursor() as cursor:
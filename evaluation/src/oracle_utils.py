@@ -8,30 +8,16 @@ import os
 import oracledb
 import json
 from logger import PrintLogger, log_section_header, log_section_footer
+import deadline
+import fetch_limits
+import sql_lexer
+from quiescence import QUIESCE_TIMEOUT_SECONDS, wait_until
 from datetime import datetime
 import csv
 import re
+import threading
 import time
-
-# Common write operation keywords that will trigger a commit
-ORACLE_COMMIT_KEYWORDS = (
-    "insert",
-    "update",
-    "delete",
-    "create",
-    "drop",
-    "alter",
-    "truncate",
-    "merge",
-    "grant",
-    "revoke",
-    "begin",
-    "commit",
-    "rollback",
-    "savepoint",
-    "call",
-    "dbms_",
-)
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Default Oracle connection configuration
 DEFAULT_ORACLE_CONFIG = {
@@ -43,6 +29,17 @@ DEFAULT_ORACLE_CONFIG = {
 }
 
 
+def configure_db_host(host=None, port=None):
+    """
+    Point this process at a specific Oracle server (used when a run is
+    sharded across several hosts).
+    """
+    if host:
+        DEFAULT_ORACLE_CONFIG["host"] = host
+    if port:
+        DEFAULT_ORACLE_CONFIG["port"] = int(port)
+
+
 def lob_as_str_handler(cursor, name, defaultType, size, precision, scale):
     """
     Handle CLOB/NCLOB as string to prevent LOB object issues during serialization.
@@ -52,6 +49,53 @@ def lob_as_str_handler(cursor, name, defaultType, size, precision, scale):
     return None
 
 
+LOB_TYPES = (oracledb.DB_TYPE_CLOB, oracledb.DB_TYPE_NCLOB, oracledb.DB_TYPE_BLOB)
+
+
+def lob_locator_handler(cursor, name, defaultType, size, precision, scale):
+    """
+    Fetch CLOB/NCLOB/BLOB columns as LOB locators (overriding
+    lob_as_str_handler), so only fetch_limits.lob_limit() of each is read.
+    """
+    if defaultType in LOB_TYPES:
+        return cursor.var(defaultType, arraysize=cursor.arraysize)
+    return None
+
+
+def _read_lobs(row):
+    """Replace the LOB locators in row with their first lob_limit() characters."""
+    if not any(isinstance(value, oracledb.LOB) for value in row):
+        return row
+    limit = fetch_limits.lob_limit()
+    values = []
+    for value in row:
+        if isinstance(value, oracledb.LOB):
+            # One more than the limit tells a cut value from one that fits
+            value = value.read(1, limit + 1)
+            if len(value) > limit:
+                fetch_limits.note_truncated(f"LOB value longer than {limit}")
+                value = value[:limit]
+        values.append(value)
+    return tuple(values)
+
+
+# Errors raised when a call is cancelled (ORA-01013) or exceeds call_timeout
+# (DPY-4024)
+ORACLE_TIMEOUT_ERRORS = ("ORA-01013", "DPY-4024")
+
+
+def _cancel_call(conn):
+    """Break the call currently running on conn."""
+    conn.cancel()
+
+
+def is_timeout_error(e):
+    """True if e comes from a call that was stopped for running too long."""
+    if isinstance(e, deadline.DeadlineExceeded) or deadline.expired():
+        return True
+    return any(code in str(e) for code in ORACLE_TIMEOUT_ERRORS)
+
+
 def perform_query_on_oracle_databases(query, db_name, conn=None, as_dict=False):
     """
     Execute a query on an Oracle database.
@@ -82,16 +126,23 @@ def perform_query_on_oracle_databases(query, db_name, conn=None, as_dict=False):
         )
         conn.outputtypehandler = lob_as_str_handler
 
+    deadline.watch(conn, _cancel_call)
+    if deadline.get_deadline() is not None:
+        # Every round trip of this query must finish within the time left
+        conn.call_timeout = int(deadline.cap(None) * 1000)
+
     cursor = conn.cursor()
+    # Rows come back with the execute call and in large batches after it
+    cursor.arraysize = fetch_limits.ARRAYSIZE
+    cursor.prefetchrows = fetch_limits.ARRAYSIZE + 1
+    cursor.outputtypehandler = lob_locator_handler
     try:
         cursor.execute(query)
 
         # Check if the operation is a DDL or DML operation
-        query_lower = query.lower()
-        is_ddl_or_dml = any(kw in query_lower for kw in ORACLE_COMMIT_KEYWORDS)
-        is_query = query_lower.strip().startswith(
-            "select"
-        ) or query_lower.strip().startswith("with")
+        info = sql_lexer.classify(query, "oracle")
+        is_ddl_or_dml = info.needs_commit
+        is_query = info.returns_rows
 
         # Commit for DDL/DML operations
         if is_ddl_or_dml:
@@ -100,14 +151,11 @@ def perform_query_on_oracle_databases(query, db_name, conn=None, as_dict=False):
         # Try to fetch results only for queries that should return rows
         if is_query:
             try:
+                rows = fetch_limits.fetch(cursor, _read_lobs)
                 if as_dict and cursor.description:
                     # Convert result to list of dictionaries
                     columns = [col[0] for col in cursor.description]
-                    rows = []
-                    for row in cursor.fetchall():
-                        rows.append(dict(zip(columns, row)))
-                else:
-                    rows = cursor.fetchall()
+                    rows = [dict(zip(columns, row)) for row in rows]
             except oracledb.DatabaseError as e:
                 # For genuine errors during fetch
                 rows = None
@@ -118,9 +166,7 @@ def perform_query_on_oracle_databases(query, db_name, conn=None, as_dict=False):
 
         return rows, conn
     except Exception as e:
-        query_lower = query.lower()
-        is_ddl_or_dml = any(kw in query_lower for kw in ORACLE_COMMIT_KEYWORDS)
-        if is_ddl_or_dml:
+        if sql_lexer.needs_commit(query, "oracle"):
             conn.rollback()
         raise e
     finally:
@@ -161,14 +207,14 @@ def execute_queries(
     error_msg = ""
     for i, query in enumerate(queries):
         try:
+            deadline.check()
             logger.info(f"Executing query {i+1}/{len(queries)}: {query}")
             query_result, conn = perform_query_on_oracle_databases(
                 query, db_name, conn, as_dict=as_dict
             )
 
             # For queries that return data, log the result
-            query_lower = query.lower().strip()
-            if query_lower.startswith("select") or query_lower.startswith("with"):
+            if sql_lexer.returns_rows(query, "oracle"):
                 # logger.info(f"[execute_queries] Query result:: {query_result}")
                 pass
             else:
@@ -180,8 +226,7 @@ def execute_queries(
             # Check if this is the "no rows returned" message for non-query statements
             if "DPY-1003" in error_msg:
                 # This is expected for DDL/DML statements - not an error
-                query_lower = query.lower()
-                if any(kw in query_lower for kw in ORACLE_COMMIT_KEYWORDS):
+                if sql_lexer.needs_commit(query, "oracle"):
                     logger.info(
                         f"[execute_queries] Statement executed successfully (no rows returned)"
                     )
@@ -191,8 +236,18 @@ def execute_queries(
             # Otherwise, it's a genuine error
             logger.error(f"[execute_queries] DatabaseError executing query {i}: {e}")
             if is_solution:
-                execution_error = True
+                if is_timeout_error(e):
+                    timeout_error = True
+                else:
+                    execution_error = True
+            error_msg += f"\n {str(e)}"
+        except deadline.DeadlineExceeded as e:
+            # Out of time: the remaining queries are not run
+            logger.error(f"[execute_queries] Timeout before query {i}: {e}")
+            if is_solution:
+                timeout_error = True
             error_msg += f"\n {str(e)}"
+            break
         except Exception as e:
             logger.error(f"[execute_queries] Generic error executing query {i}: {e}")
             if is_solution:
@@ -220,29 +275,345 @@ def close_oracle_connections(conn):
     close_oracle_connection(conn)
 
 
-def reset_and_restore_database(db_name, logger=None):
-    """
-    Reset and restore an Oracle database (ephemeral user) to a known initial state.
+def _no_sessions(cursor, username):
+    """Probe for wait_until: True once username has no sessions left."""
 
-    For Oracle, this involves:
-    1. Dropping all user objects from the ephemeral schema
-    2. Recreating synonyms for master tables
-    """
-    if logger is None:
-        logger = PrintLogger()
+    def probe():
+        cursor.execute(
+            "SELECT COUNT(*) FROM v$session WHERE username = UPPER(:username)",
+            username=username,
+        )
+        return cursor.fetchone()[0] == 0
 
-    logger.info(f"Resetting database (user schema) [{db_name}] ...")
+    return probe
 
-    admin_conn = None
+
+def wait_for_quiescence(
+    ephemeral_user, host=None, port=None, timeout=QUIESCE_TIMEOUT_SECONDS, logger=None
+):
+    """
+    Wait until ephemeral_user has no sessions left, polling v$session with
+    exponential backoff. Returns True once it is idle.
+    """
+    logger = logger or PrintLogger()
     try:
-        # Connect as admin (MASTER)
-        admin_conn = oracledb.connect(
+        conn = oracledb.connect(
             user=DEFAULT_ORACLE_CONFIG["user"],
             password=DEFAULT_ORACLE_CONFIG["password"],
-            host=DEFAULT_ORACLE_CONFIG["host"],
-            port=DEFAULT_ORACLE_CONFIG["port"],
+            host=host or DEFAULT_ORACLE_CONFIG["host"],
+            port=port or DEFAULT_ORACLE_CONFIG["port"],
             service_name=DEFAULT_ORACLE_CONFIG["service_name"],
         )
+    except oracledb.Error as e:
+        logger.error(f"Cannot check sessions of {ephemeral_user}: {e}")
+        return False
+    try:
+        probe = _no_sessions(conn.cursor(), ephemeral_user)
+        return bool(
+            wait_until(
+                probe, timeout, logger, what=f"sessions of {ephemeral_user} to end"
+            )
+        )
+    finally:
+        conn.close()
+
+
+# A table and a database trigger owned by MASTER record the DDL run by or on
+# the ephemeral users, so a reset only has to deal with the objects an
+# instance created, altered or dropped. They stay out of the ephemeral
+# schemas, so an instance does not find them among its own objects.
+DDL_LOG_TABLE = "BIRD_DDL_LOG"
+DDL_TRIGGER = "BIRD_DDL_TRACK"
+# Object types a targeted reset drops, in order (dependent objects first)
+DROP_ORDER = (
+    "MATERIALIZED VIEW",
+    "TRIGGER",
+    "VIEW",
+    "SYNONYM",
+    "PACKAGE",
+    "PROCEDURE",
+    "FUNCTION",
+    "SEQUENCE",
+    "INDEX",
+    "TABLE",
+    "TYPE",
+)
+
+
+def _install_ddl_tracking(admin_cursor):
+    """
+    Create the DDL log table and the database trigger that fills it in the
+    MASTER schema, unless they are already there.
+    """
+    try:
+        admin_cursor.execute(
+            f"CREATE TABLE {DDL_LOG_TABLE} (login_user VARCHAR2(128), "
+            "event VARCHAR2(30), object_type VARCHAR2(30), "
+            "object_owner VARCHAR2(128), object_name VARCHAR2(128))"
+        )
+    except oracledb.DatabaseError:
+        pass  # ORA-00955: the table already exists
+    admin_cursor.execute(
+        "SELECT status FROM user_triggers WHERE trigger_name = :name",
+        name=DDL_TRIGGER,
+    )
+    row = admin_cursor.fetchone()
+    if row and row[0] == "ENABLED":
+        return
+
+    # Fires before the DDL, so an ephemeral user cannot drop or alter the
+    # tracking objects. Logging is autonomous and never fails the DDL.
+    admin_cursor.execute(f"""
+        CREATE OR REPLACE TRIGGER {DDL_TRIGGER}
+        BEFORE DDL ON DATABASE
+        DECLARE
+            PRAGMA AUTONOMOUS_TRANSACTION;
+            ephemeral BOOLEAN := ora_login_user LIKE '%!_PROC!_%' ESCAPE '!';
+        BEGIN
+            IF ephemeral AND ora_dict_obj_owner = 'MASTER'
+               AND ora_dict_obj_name IN ('{DDL_LOG_TABLE}', '{DDL_TRIGGER}') THEN
+                RAISE_APPLICATION_ERROR(-20001, 'insufficient privileges');
+            END IF;
+            IF ephemeral OR ora_dict_obj_owner LIKE '%!_PROC!_%' ESCAPE '!' THEN
+                BEGIN
+                    INSERT INTO {DDL_LOG_TABLE}
+                        (login_user, event, object_type, object_owner, object_name)
+                    VALUES (ora_login_user, ora_sysevent, ora_dict_obj_type,
+                            ora_dict_obj_owner, ora_dict_obj_name);
+                    COMMIT;
+                EXCEPTION
+                    WHEN OTHERS THEN ROLLBACK;
+                END;
+            END IF;
+        END;""")
+    admin_cursor.connection.commit()
+
+
+def _install_tracking_or_warn(admin_cursor, logger):
+    try:
+        _install_ddl_tracking(admin_cursor)
+    except oracledb.DatabaseError as e:
+        # Every reset falls back to the full reset
+        logger.warning(f"Cannot install DDL tracking: {e}")
+
+
+def _clear_ddl_log(admin_cursor, db_name):
+    """Delete the logged DDL run by or on the ephemeral user db_name."""
+    admin_cursor.execute(
+        f"DELETE FROM {DDL_LOG_TABLE} WHERE login_user = :name OR object_owner = :name",
+        name=db_name.upper(),
+    )
+    admin_cursor.connection.commit()
+
+
+def _targeted_reset(cursor, admin_cursor, db_name, logger):
+    """
+    Undo the DDL logged for db_name, over a cursor connected as db_name
+    (the log is read and cleared over admin_cursor): every object named in
+    the log is dropped from the schema, and the synonym is recreated where
+    the name is a MASTER table. Returns False (nothing done) if the log
+    cannot be trusted: the trigger is missing or disabled, or an object was
+    renamed (the log does not hold the new name).
+    """
+    user = db_name.upper()
+    admin_cursor.execute(
+        "SELECT status FROM user_triggers WHERE trigger_name = :name",
+        name=DDL_TRIGGER,
+    )
+    row = admin_cursor.fetchone()
+    if not row or row[0] != "ENABLED":
+        logger.info(f"No DDL tracking for {db_name}; using the full reset")
+        return False
+    try:
+        admin_cursor.execute(
+            "SELECT event, object_owner, object_name FROM "
+            f"{DDL_LOG_TABLE} WHERE login_user = :name OR object_owner = :name",
+            name=user,
+        )
+        events = admin_cursor.fetchall()
+    except oracledb.DatabaseError as e:
+        logger.info(f"Cannot read the DDL log of {db_name} ({e}); using the full reset")
+        return False
+    for event, owner, name in events:
+        if event == "RENAME":
+            logger.info(f"{event} of {owner}.{name} in {db_name}; using the full reset")
+            return False
+
+    names = sorted({name for _, owner, name in events if owner in (user, "MASTER")})
+    if len(names) > 1000:
+        # More than an IN list can hold; the full reset is as fast by then
+        logger.info(f"{len(names)} objects changed in {db_name}; using the full reset")
+        return False
+    if names:
+        binds = {f"n{i}": name for i, name in enumerate(names)}
+        in_list = ", ".join(f":{key}" for key in binds)
+        cursor.execute(
+            "SELECT table_name FROM all_tables "
+            f"WHERE owner = 'MASTER' AND table_name IN ({in_list})",
+            binds,
+        )
+        master_tables = {row[0] for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT object_name, object_type FROM user_objects "
+            f"WHERE object_name IN ({in_list})",
+            binds,
+        )
+        objects = sorted(
+            (
+                (name, object_type)
+                for name, object_type in cursor.fetchall()
+                if object_type in DROP_ORDER
+            ),
+            key=lambda obj: DROP_ORDER.index(obj[1]),
+        )
+        for name, object_type in objects:
+            drop_sql = f'DROP {object_type} "{name}"'
+            if object_type == "TABLE":
+                drop_sql += " CASCADE CONSTRAINTS"
+            elif object_type == "TYPE":
+                drop_sql += " FORCE"
+            try:
+                cursor.execute(drop_sql)
+            except oracledb.DatabaseError as e:
+                # Already gone with the object it belonged to
+                logger.info(f"{drop_sql} skipped: {e}")
+        for name in sorted(master_tables):
+            cursor.execute(f'CREATE OR REPLACE SYNONYM "{name}" FOR MASTER."{name}"')
+        logger.info(
+            f"Dropped {len(objects)} objects and recreated "
+            f"{len(master_tables)} synonyms in {db_name}"
+        )
+
+    # The log now also holds the DDL of this reset
+    _clear_ddl_log(admin_cursor, db_name)
+    return True
+
+
+# MASTER tables are shared through the synonyms, and the INSERT/UPDATE/DELETE
+# ANY TABLE grants let an instance change their rows. With the "flashback"
+# strategy the SCN is captured before an instance, and the reset runs
+# FLASHBACK TABLE ... TO SCN on the MASTER tables the instance may have
+# written: those named in its writing SQL statements or in its test cases.
+FLASHBACK = "flashback"
+NO_MASTER_RESET = "none"
+MASTER_RESET_STRATEGIES = (FLASHBACK, NO_MASTER_RESET)
+SQL_FIELDS = ("preprocess_sql", "issue_sql", "sol_sql", "clean_up_sql")
+# ORA-08189: cannot flashback the table because row movement is not enabled
+ROW_MOVEMENT_ERROR = "ORA-08189"
+
+
+def _admin_connect(host=None, port=None):
+    return oracledb.connect(
+        user=DEFAULT_ORACLE_CONFIG["user"],
+        password=DEFAULT_ORACLE_CONFIG["password"],
+        host=host or DEFAULT_ORACLE_CONFIG["host"],
+        port=port or DEFAULT_ORACLE_CONFIG["port"],
+        service_name=DEFAULT_ORACLE_CONFIG["service_name"],
+    )
+
+
+def capture_scn(logger):
+    """The current SCN of the database, or None if it cannot be read."""
+    try:
+        conn = _admin_connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT current_scn FROM v$database")
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+    except oracledb.Error as e:
+        logger.warning(
+            f"Cannot capture the SCN; MASTER tables will not be restored: {e}"
+        )
+        return None
+
+
+def written_table_candidates(data, mode="gold"):
+    """
+    Upper-cased names that may be MASTER tables the instance writes: words
+    of its SQL statements that write or change the schema, and every word
+    of its test cases (Python code, which cannot be classified).
+    """
+    fields = SQL_FIELDS + (("pred_sqls",) if mode == "pred" else ())
+    names = set()
+    for field in fields:
+        value = data.get(field) or []
+        if isinstance(value, str):
+            value = [value]
+        for sql in value:
+            if not isinstance(sql, str):
+                continue
+            for statement in sql_lexer.classify(sql, "oracle").statements:
+                if statement.kind in (sql_lexer.WRITE, sql_lexer.DDL):
+                    names.update(word.upper() for word in statement.words)
+    for test_case in data.get("test_cases") or []:
+        names.update(
+            word.upper() for word in re.findall(r"[A-Za-z_][A-Za-z0-9_$#]*", test_case)
+        )
+    return names
+
+
+def master_table_names(logger, host=None, port=None):
+    """Names of the MASTER tables on a host, or None if they cannot be read."""
+    try:
+        conn = _admin_connect(host, port)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT table_name FROM all_tables WHERE owner = 'MASTER'")
+            return {row[0] for row in cursor.fetchall()} - {DDL_LOG_TABLE}
+        finally:
+            conn.close()
+    except oracledb.Error as e:
+        logger.warning(f"Cannot list the MASTER tables: {e}")
+        return None
+
+
+def flashback_master_tables(names, scn, logger):
+    """
+    FLASHBACK TABLE the MASTER tables among names to scn, enabling row
+    movement where it is off. Returns the tables that could not be restored
+    (their structure changed since scn, or undo was too short).
+    """
+    conn = _admin_connect()
+    failed = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT table_name FROM all_tables WHERE owner = 'MASTER'")
+        tables = sorted(names & {row[0] for row in cursor.fetchall()} - {DDL_LOG_TABLE})
+        start = time.time()
+        for table in tables:
+            flashback_sql = f'FLASHBACK TABLE MASTER."{table}" TO SCN {int(scn)}'
+            try:
+                try:
+                    cursor.execute(flashback_sql)
+                except oracledb.DatabaseError as e:
+                    if ROW_MOVEMENT_ERROR not in str(e):
+                        raise
+                    cursor.execute(f'ALTER TABLE MASTER."{table}" ENABLE ROW MOVEMENT')
+                    cursor.execute(flashback_sql)
+            except oracledb.DatabaseError as e:
+                logger.warning(f"Cannot flash back MASTER.{table} to SCN {scn}: {e}")
+                failed.append(table)
+        logger.info(
+            f"Flashed back {len(tables) - len(failed)}/{len(tables)} MASTER tables "
+            f"to SCN {scn} in {time.time() - start:.2f}s"
+        )
+    finally:
+        conn.close()
+    return failed
+
+
+def _full_reset(db_name, logger):
+    """
+    Drop all user objects from the ephemeral schema as MASTER, recreate the
+    synonyms for the MASTER tables, (re)install the DDL tracking and clear
+    the schema's DDL log.
+    """
+    admin_conn = None
+    try:
+        # Connect as admin (MASTER)
+        admin_conn = _admin_connect()
         admin_conn.autocommit = True
         cursor = admin_conn.cursor()
 
@@ -287,9 +658,10 @@ def reset_and_restore_database(db_name, logger=None):
         user_cursor = user_conn.cursor()
 
         # Create synonyms for all MASTER tables
-        create_synonyms_sql = """
+        create_synonyms_sql = f"""
         BEGIN
-            FOR tab IN (SELECT table_name FROM all_tables WHERE owner = 'MASTER')
+            FOR tab IN (SELECT table_name FROM all_tables WHERE owner = 'MASTER'
+                        AND table_name <> '{DDL_LOG_TABLE}')
             LOOP
                 BEGIN
                     EXECUTE IMMEDIATE 'CREATE OR REPLACE SYNONYM "' || tab.table_name || '" FOR MASTER."' || tab.table_name || '"';
@@ -307,13 +679,61 @@ def reset_and_restore_database(db_name, logger=None):
         user_cursor.close()
         user_conn.close()
 
+        try:
+            _install_ddl_tracking(cursor)
+            _clear_ddl_log(cursor, db_name)
+        except oracledb.DatabaseError as e:
+            logger.warning(f"Cannot install DDL tracking for {db_name}: {e}")
+    finally:
+        if admin_conn:
+            admin_conn.close()
+
+
+def reset_and_restore_database(db_name, logger=None, scn=None, master_tables=()):
+    """
+    Reset and restore an Oracle database (ephemeral user) to a known initial state.
+    If scn is given, the MASTER tables among master_tables (see
+    written_table_candidates) are flashed back to it as well.
+
+    A MASTER trigger logs the DDL run in the schema, so normally only the
+    objects an instance created, altered or dropped are dropped, and only
+    their synonyms for MASTER tables are recreated. Without a trustworthy
+    log, the full reset runs instead:
+    1. Dropping all user objects from the ephemeral schema
+    2. Recreating synonyms for master tables
+    """
+    if logger is None:
+        logger = PrintLogger()
+
+    logger.info(f"Resetting database (user schema) [{db_name}] ...")
+
+    try:
+        user_conn = oracledb.connect(
+            user=db_name,
+            password=db_name,
+            host=DEFAULT_ORACLE_CONFIG["host"],
+            port=DEFAULT_ORACLE_CONFIG["port"],
+            service_name=DEFAULT_ORACLE_CONFIG["service_name"],
+        )
+        admin_conn = None
+        try:
+            admin_conn = _admin_connect()
+            reset = _targeted_reset(
+                user_conn.cursor(), admin_conn.cursor(), db_name, logger
+            )
+        finally:
+            user_conn.close()
+            if admin_conn:
+                admin_conn.close()
+        if not reset:
+            _full_reset(db_name, logger)
+        if scn is not None and master_tables:
+            flashback_master_tables(set(master_tables), scn, logger)
+
         logger.info(f"Database (user schema) {db_name} reset successfully.")
     except Exception as e:
         logger.error(f"Error resetting database (user schema) {db_name}: {e}")
         raise
-    finally:
-        if admin_conn:
-            admin_conn.close()
 
 
 def get_connection_for_phase(db_name, logger=None):
@@ -385,185 +805,254 @@ def run_preprocessing(preprocess_sql, db_name, logger, conn):
         execute_queries(preprocess_sql, db_name, conn, logger, "Preprocess SQL", False)
 
 
-def create_ephemeral_users(base_names, num_copies, logger):
+# Privileges every ephemeral user gets directly (Oracle ignores privileges
+# granted through a role inside stored procedures and views)
+EPHEMERAL_PRIVILEGES = (
+    "CREATE SESSION",
+    "UNLIMITED TABLESPACE",
+    "CREATE ANY TABLE",
+    "ALTER ANY TABLE",
+    "DROP ANY TABLE",
+    "SELECT ANY TABLE",
+    "INSERT ANY TABLE",
+    "UPDATE ANY TABLE",
+    "DELETE ANY TABLE",
+    "CREATE ANY INDEX",
+    "CREATE ANY SYNONYM",
+    "CREATE SYNONYM",
+    "CREATE PUBLIC SYNONYM",
+    "DROP ANY SYNONYM",
+    "LOCK ANY TABLE",
+    "EXECUTE ANY PROCEDURE",
+    "ALTER SESSION",
+)
+# Concurrent admin sessions used to create and drop ephemeral users
+ADMIN_SESSIONS = 4
+
+
+def _admin_sessions(items, work, host=None, port=None):
     """
-    Creates ephemeral Oracle users for each base database name with ALL privileges.
+    Run work(admin_cursor, item) for every item on up to ADMIN_SESSIONS
+    threads, each with its own admin connection. Returns {item: exception}
+    for the items that failed.
     """
-    ephemeral_pool = {}
-    admin_conn = None
-    try:
-        # Connect as admin user (MASTER)
-        admin_conn = oracledb.connect(
-            user=DEFAULT_ORACLE_CONFIG["user"],
-            password=DEFAULT_ORACLE_CONFIG["password"],
-            host=DEFAULT_ORACLE_CONFIG["host"],
-            port=DEFAULT_ORACLE_CONFIG["port"],
-            service_name=DEFAULT_ORACLE_CONFIG["service_name"],
-        )
-        admin_cursor = admin_conn.cursor()
+    local = threading.local()
+    sessions = []
+    sessions_lock = threading.Lock()
+
+    def run(item):
+        if not hasattr(local, "conn"):
+            local.conn = _admin_connect(host, port)
+            local.conn.autocommit = True
+            with sessions_lock:
+                sessions.append(local.conn)
+        cursor = local.conn.cursor()
+        try:
+            work(cursor, item)
+        finally:
+            cursor.close()
 
-        for base in base_names:
-            ephemeral_pool[base] = []
-            base_upper = base.upper()
+    failures = {}
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(ADMIN_SESSIONS, len(items)))
+        ) as executor:
+            futures = {executor.submit(run, item): item for item in items}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failures[futures[future]] = future.exception()
+    finally:
+        for conn in sessions:
+            try:
+                conn.close()
+            except oracledb.Error:
+                pass
+    return failures
 
-            for i in range(1, num_copies + 1):
-                ephemeral_user = f"{base_upper}_PROC_{i}"
 
-                # Try to drop the user if it exists
-                drop_sql = f"DROP USER {ephemeral_user} CASCADE"
-                try:
-                    admin_cursor.execute(drop_sql)
-                except oracledb.DatabaseError:
-                    pass  # User might not exist, which is fine
+def _setup_ephemeral_user(admin_cursor, ephemeral_user, logger, host, port):
+    """
+    (Re)create one ephemeral user with its grants and synonyms for the
+    MASTER tables, using an open admin cursor. The DDL tracking must be
+    installed already (see _install_ddl_tracking).
+    """
+    # Try to drop the user if it exists
+    drop_sql = f"DROP USER {ephemeral_user} CASCADE"
+    try:
+        admin_cursor.execute(drop_sql)
+    except oracledb.DatabaseError:
+        pass  # User might not exist, which is fine
 
-                # Create the user
-                create_sql = (
-                    f"CREATE USER {ephemeral_user} IDENTIFIED BY {ephemeral_user}"
-                )
-                logger.info(f"Creating user: {ephemeral_user}")
-                admin_cursor.execute(create_sql)
-
-                # Grant all powerful privileges to the ephemeral user
-                powerful_grants = [
-                    f"GRANT CONNECT, RESOURCE TO {ephemeral_user}",
-                    f"GRANT CREATE SESSION TO {ephemeral_user}",
-                    f"GRANT UNLIMITED TABLESPACE TO {ephemeral_user}",
-                    f"GRANT CREATE ANY TABLE TO {ephemeral_user}",
-                    f"GRANT ALTER ANY TABLE TO {ephemeral_user}",
-                    f"GRANT DROP ANY TABLE TO {ephemeral_user}",
-                    f"GRANT SELECT ANY TABLE TO {ephemeral_user}",
-                    f"GRANT INSERT ANY TABLE TO {ephemeral_user}",
-                    f"GRANT UPDATE ANY TABLE TO {ephemeral_user}",
-                    f"GRANT DELETE ANY TABLE TO {ephemeral_user}",
-                    f"GRANT CREATE ANY INDEX TO {ephemeral_user}",
-                    f"GRANT CREATE ANY SYNONYM TO {ephemeral_user}",
-                    f"GRANT CREATE SYNONYM TO {ephemeral_user}",
-                    f"GRANT CREATE PUBLIC SYNONYM TO {ephemeral_user}",
-                    f"GRANT DROP ANY SYNONYM TO {ephemeral_user}",
-                    f"GRANT LOCK ANY TABLE TO {ephemeral_user}",
-                    f"GRANT EXECUTE ANY PROCEDURE TO {ephemeral_user}",
-                    f"GRANT ALTER SESSION TO {ephemeral_user}",
-                ]
+    # Create the user
+    create_sql = f"CREATE USER {ephemeral_user} IDENTIFIED BY {ephemeral_user}"
+    logger.info(f"Creating user: {ephemeral_user}")
+    admin_cursor.execute(create_sql)
 
-                for grant_statement in powerful_grants:
-                    try:
-                        admin_cursor.execute(grant_statement)
-                        logger.info(f"Granted privilege: {grant_statement}")
-                    except oracledb.DatabaseError as e:
-                        logger.warning(f"Grant failed (continuing): {e}")
+    # Roles, then all system privileges in one statement
+    admin_cursor.execute(f"GRANT CONNECT, RESOURCE TO {ephemeral_user}")
+    try:
+        admin_cursor.execute(
+            f"GRANT {', '.join(EPHEMERAL_PRIVILEGES)} TO {ephemeral_user}"
+        )
+    except oracledb.DatabaseError as e:
+        # Grant what can be granted, one privilege at a time
+        logger.warning(f"Combined grant failed ({e}); granting one by one")
+        for privilege in EPHEMERAL_PRIVILEGES:
+            try:
+                admin_cursor.execute(f"GRANT {privilege} TO {ephemeral_user}")
+            except oracledb.DatabaseError as e:
+                logger.warning(f"Grant failed (continuing): {e}")
+    logger.info(f"Granted system privileges to {ephemeral_user}")
+
+    # Also grant specific privileges on MASTER tables, directly: REFERENCES
+    # (foreign keys to MASTER tables) cannot come through a role
+    grant_all_sql = f"""
+    BEGIN
+        FOR rec IN (SELECT table_name FROM all_tables WHERE owner = 'MASTER'
+                    AND table_name <> '{DDL_LOG_TABLE}') LOOP
+            BEGIN
+                EXECUTE IMMEDIATE 'GRANT ALL PRIVILEGES ON MASTER."' || rec.table_name || '" TO {ephemeral_user}';
+            EXCEPTION
+                WHEN OTHERS THEN NULL;
+            END;
+        END LOOP;
+    END;"""
+    logger.info(f"Granting ALL PRIVILEGES on MASTER tables to {ephemeral_user}")
+    admin_cursor.execute(grant_all_sql)
+
+    # Create a connection for the ephemeral user to create synonyms
+    ephemeral_cfg = DEFAULT_ORACLE_CONFIG.copy()
+    ephemeral_cfg["user"] = ephemeral_user
+    ephemeral_cfg["password"] = ephemeral_user
+
+    ephemeral_conn = oracledb.connect(
+        user=ephemeral_cfg["user"],
+        password=ephemeral_cfg["password"],
+        host=host,
+        port=port,
+        service_name=ephemeral_cfg["service_name"],
+    )
+    ephemeral_cursor = ephemeral_conn.cursor()
 
-                # Also grant specific privileges on MASTER tables
-                grant_all_sql = f"""
+    # Create synonyms for all MASTER tables
+    try:
+        synonym_block = f"""
+        BEGIN
+            FOR rec IN (
+                SELECT table_name
+                FROM all_tables
+                WHERE owner = 'MASTER'
+                AND table_name <> '{DDL_LOG_TABLE}'
+            )
+            LOOP
                 BEGIN
-                    FOR rec IN (SELECT table_name FROM all_tables WHERE owner = 'MASTER') LOOP
-                        BEGIN
-                            EXECUTE IMMEDIATE 'GRANT ALL PRIVILEGES ON MASTER."' || rec.table_name || '" TO {ephemeral_user}';
-                        EXCEPTION
-                            WHEN OTHERS THEN NULL;
-                        END;
-                    END LOOP;
-                END;"""
-                logger.info(
-                    f"Granting ALL PRIVILEGES on MASTER tables to {ephemeral_user}"
-                )
-                admin_cursor.execute(grant_all_sql)
-
-                # Add user to ephemeral pool
-                ephemeral_pool[base].append(ephemeral_user)
-
-                # Create a connection for the ephemeral user to create synonyms
-                ephemeral_cfg = DEFAULT_ORACLE_CONFIG.copy()
-                ephemeral_cfg["user"] = ephemeral_user
-                ephemeral_cfg["password"] = ephemeral_user
-
-                ephemeral_conn = oracledb.connect(
-                    user=ephemeral_cfg["user"],
-                    password=ephemeral_cfg["password"],
-                    host=ephemeral_cfg["host"],
-                    port=ephemeral_cfg["port"],
-                    service_name=ephemeral_cfg["service_name"],
-                )
-                ephemeral_cursor = ephemeral_conn.cursor()
+                    EXECUTE IMMEDIATE
+                    'CREATE OR REPLACE SYNONYM "' || rec.table_name ||
+                    '" FOR MASTER."' || rec.table_name || '"';
+                EXCEPTION
+                    WHEN OTHERS THEN NULL;
+                END;
+            END LOOP;
+        END;
+        """
+        logger.info(f"Creating synonyms for ephemeral user: {ephemeral_user}")
+        ephemeral_cursor.execute(synonym_block)
+        ephemeral_cursor.execute("SELECT COUNT(*) FROM user_synonyms")
+        count = ephemeral_cursor.fetchone()[0]
+        logger.info(f"User {ephemeral_user} has {count} synonyms.")
+        ephemeral_conn.commit()
+    finally:
+        ephemeral_cursor.close()
+        ephemeral_conn.close()
+
+    # Start from an empty DDL log (it holds the synonyms just created)
+    try:
+        _clear_ddl_log(admin_cursor, ephemeral_user)
+    except oracledb.DatabaseError as e:
+        logger.warning(f"Cannot clear the DDL log of {ephemeral_user}: {e}")
 
-                # Create synonyms for all MASTER tables
-                try:
-                    synonym_block = """
-                    BEGIN
-                        FOR rec IN (
-                            SELECT table_name
-                            FROM all_tables
-                            WHERE owner = 'MASTER'
-                        )
-                        LOOP
-                            BEGIN
-                                EXECUTE IMMEDIATE
-                                'CREATE OR REPLACE SYNONYM "' || rec.table_name ||
-                                '" FOR MASTER."' || rec.table_name || '"';
-                            EXCEPTION
-                                WHEN OTHERS THEN NULL;
-                            END;
-                        END LOOP;
-                    END;
-                    """
-                    logger.info(
-                        f"Creating synonyms for ephemeral user: {ephemeral_user}"
-                    )
-                    ephemeral_cursor.execute(synonym_block)
-                    ephemeral_cursor.execute("SELECT COUNT(*) FROM user_synonyms")
-                    count = ephemeral_cursor.fetchone()[0]
-                    logger.info(f"User {ephemeral_user} has {count} synonyms.")
-                    ephemeral_conn.commit()
-                finally:
-                    ephemeral_cursor.close()
-                    ephemeral_conn.close()
 
+def create_ephemeral_user(base, copy_index, logger, host=None, port=None):
+    """
+    Creates the single ephemeral user <BASE>_PROC_<copy_index> over its own
+    admin connection and returns its name.
+    """
+    host = host or DEFAULT_ORACLE_CONFIG["host"]
+    port = port or DEFAULT_ORACLE_CONFIG["port"]
+    ephemeral_user = f"{base.upper()}_PROC_{copy_index}"
+    admin_conn = _admin_connect(host, port)
+    try:
+        admin_cursor = admin_conn.cursor()
+        try:
+            _install_tracking_or_warn(admin_cursor, logger)
+            _setup_ephemeral_user(admin_cursor, ephemeral_user, logger, host, port)
+        finally:
+            admin_cursor.close()
         admin_conn.commit()
     except Exception as e:
-        logger.error(f"Error creating ephemeral Oracle users: {e}")
+        logger.error(f"Error creating ephemeral Oracle user {ephemeral_user}: {e}")
         raise
     finally:
-        if admin_conn:
-            admin_cursor.close()
-            admin_conn.close()
+        admin_conn.close()
+    return ephemeral_user
+
 
+def create_ephemeral_users(base_names, num_copies, logger, host=None, port=None):
+    """
+    Creates ephemeral Oracle users for each base database name with ALL privileges,
+    on ADMIN_SESSIONS concurrent admin sessions.
+    """
+    host = host or DEFAULT_ORACLE_CONFIG["host"]
+    port = port or DEFAULT_ORACLE_CONFIG["port"]
+    ephemeral_pool = {
+        base: [f"{base.upper()}_PROC_{i}" for i in range(1, num_copies + 1)]
+        for base in base_names
+    }
+    users = [user for user_list in ephemeral_pool.values() for user in user_list]
+    # Once, before the concurrent sessions use it
+    admin_conn = _admin_connect(host, port)
+    try:
+        _install_tracking_or_warn(admin_conn.cursor(), logger)
+    finally:
+        admin_conn.close()
+    failures = _admin_sessions(
+        users,
+        lambda cursor, user: _setup_ephemeral_user(cursor, user, logger, host, port),
+        host,
+        port,
+    )
+    if failures:
+        for user, e in failures.items():
+            logger.error(f"Error creating ephemeral Oracle user {user}: {e}")
+        raise next(iter(failures.values()))
     return ephemeral_pool
 
 
-def drop_ephemeral_users(ephemeral_pool, logger):
+def _drop_user(cursor, user, logger):
+    logger.info(f"Dropping ephemeral user: {user}")
+    try:
+        cursor.execute(f"DROP USER {user} CASCADE")
+    except oracledb.DatabaseError as e:
+        logger.warning(f"Failed to drop user {user}: {e}")
+
+
+def drop_ephemeral_users(ephemeral_pool, logger, host=None, port=None):
     """
-    Drop ephemeral users after testing is complete.
+    Drop ephemeral users after testing is complete, on ADMIN_SESSIONS
+    concurrent admin sessions.
 
     Args:
         ephemeral_pool (dict): Mapping from base names to lists of ephemeral user names
         logger: Logger object
+        host (str, optional): Oracle host holding the users (default: configured host)
+        port (int, optional): Oracle port (default: configured port)
     """
-    admin_conn = None
-    try:
-        admin_conn = oracledb.connect(
-            user=DEFAULT_ORACLE_CONFIG["user"],
-            password=DEFAULT_ORACLE_CONFIG["password"],
-            host=DEFAULT_ORACLE_CONFIG["host"],
-            port=DEFAULT_ORACLE_CONFIG["port"],
-            service_name=DEFAULT_ORACLE_CONFIG["service_name"],
-        )
-        admin_cursor = admin_conn.cursor()
-
-        for base, user_list in ephemeral_pool.items():
-            for user in user_list:
-                drop_sql = f"DROP USER {user} CASCADE"
-                logger.info(f"Dropping ephemeral user: {user}")
-                try:
-                    admin_cursor.execute(drop_sql)
-                except oracledb.DatabaseError as e:
-                    logger.warning(f"Failed to drop user {user}: {e}")
-
-        admin_conn.commit()
-    except Exception as e:
-        logger.error(f"Error dropping ephemeral users: {e}")
-    finally:
-        if admin_conn:
-            admin_cursor.close()
-            admin_conn.close()
+    users = [user for user_list in ephemeral_pool.values() for user in user_list]
+    failures = _admin_sessions(
+        users, lambda cursor, user: _drop_user(cursor, user, logger), host, port
+    )
+    for user, e in failures.items():
+        logger.error(f"Error dropping ephemeral user {user}: {e}")
 
 
 def generate_category_report(
@@ -801,7 +1290,42 @@ def generate_report_and_output(
             print(f"Failed to save status: {e}")
 
 
-def cleanup_all_ephemeral_users(logger, force=False):
+def _cleanup_user(cursor, username, logger, force):
+    """Drop one leftover ephemeral user, killing its sessions first if force."""
+    try:
+        # Kill all sessions for this user
+        if force:
+            cursor.execute(
+                f"SELECT sid, serial# FROM v$session WHERE username = '{username}'"
+            )
+            sessions = cursor.fetchall()
+            for sid, serial in sessions:
+                try:
+                    logger.info(f"Killing session {sid},{serial} for user {username}")
+                    cursor.execute(
+                        f"ALTER SYSTEM KILL SESSION '{sid},{serial}' IMMEDIATE"
+                    )
+                except Exception as e:
+                    logger.error(f"Error killing session for {username}: {e}")
+
+        # Wait for the killed sessions to go away
+        wait_until(_no_sessions(cursor, username), timeout=5)
+
+        # Drop the user with CASCADE
+        logger.info(f"Dropping ephemeral user {username}")
+        cursor.execute(f"DROP USER {username} CASCADE")
+
+    except Exception as e:
+        logger.error(f"Error dropping ephemeral user {username}: {e}")
+        if force:
+            try:
+                # Try with FORCE option if available
+                cursor.execute(f"DROP USER {username} CASCADE")
+            except Exception as force_error:
+                logger.error(f"Force drop also failed for {username}: {force_error}")
+
+
+def cleanup_all_ephemeral_users(logger, force=False, host=None, port=None):
     """
     Find and drop all ephemeral users that might have been created during evaluation.
     This is a safety measure to ensure no leftover users remain.
@@ -809,14 +1333,16 @@ def cleanup_all_ephemeral_users(logger, force=False):
     Args:
         logger: Logger instance
         force: If True, attempt more aggressive cleanup methods
+        host (str, optional): Oracle host to clean (default: configured host)
+        port (int, optional): Oracle port (default: configured port)
     """
     try:
         # Connect as MASTER user (admin)
         conn = oracledb.connect(
             user=DEFAULT_ORACLE_CONFIG["user"],
             password=DEFAULT_ORACLE_CONFIG["password"],
-            host=DEFAULT_ORACLE_CONFIG["host"],
-            port=DEFAULT_ORACLE_CONFIG["port"],
+            host=host or DEFAULT_ORACLE_CONFIG["host"],
+            port=port or DEFAULT_ORACLE_CONFIG["port"],
             service_name=DEFAULT_ORACLE_CONFIG["service_name"],
         )
         conn.autocommit = True
@@ -828,55 +1354,25 @@ def cleanup_all_ephemeral_users(logger, force=False):
         )
         ephemeral_users = [row[0] for row in cursor.fetchall()]
 
+        cursor.close()
+        conn.close()
+
         if ephemeral_users:
             logger.info(
                 f"Found {len(ephemeral_users)} leftover ephemeral users: {ephemeral_users}"
             )
-
-            for username in ephemeral_users:
-                try:
-                    # Kill all sessions for this user
-                    if force:
-                        cursor.execute(
-                            f"SELECT sid, serial# FROM v$session WHERE username = '{username}'"
-                        )
-                        sessions = cursor.fetchall()
-                        for sid, serial in sessions:
-                            try:
-                                logger.info(
-                                    f"Killing session {sid},{serial} for user {username}"
-                                )
-                                cursor.execute(
-                                    f"ALTER SYSTEM KILL SESSION '{sid},{serial}' IMMEDIATE"
-                                )
-                            except Exception as e:
-                                logger.error(
-                                    f"Error killing session for {username}: {e}"
-                                )
-
-                    # Wait a moment for sessions to be terminated
-                    time.sleep(0.5)
-
-                    # Drop the user with CASCADE
-                    logger.info(f"Dropping ephemeral user {username}")
-                    cursor.execute(f"DROP USER {username} CASCADE")
-
-                except Exception as e:
-                    logger.error(f"Error dropping ephemeral user {username}: {e}")
-                    if force:
-                        try:
-                            # Try with FORCE option if available
-                            cursor.execute(f"DROP USER {username} CASCADE")
-                        except Exception as force_error:
-                            logger.error(
-                                f"Force drop also failed for {username}: {force_error}"
-                            )
+            failures = _admin_sessions(
+                ephemeral_users,
+                lambda cursor, username: _cleanup_user(cursor, username, logger, force),
+                host,
+                port,
+            )
+            if failures:
+                # Only a lost admin session gets here; _cleanup_user logs the rest
+                raise next(iter(failures.values()))
         else:
             logger.info("No leftover ephemeral users found.")
 
-        cursor.close()
-        conn.close()
-
     except Exception as e:
         logger.error(f"Error during comprehensive cleanup: {e}")
 
@@ -4,7 +4,11 @@ import psycopg2
 from psycopg2 import OperationalError
 from psycopg2.pool import SimpleConnectionPool
 from logger import log_section_header, log_section_footer, PrintLogger
-import time
+import deadline
+import read_only
+import reset_ledger
+import sql_lexer
+from quiescence import QUIESCE_TIMEOUT_SECONDS, wait_until
 import sys
 import json
 import re
@@ -22,6 +26,18 @@ DEFAULT_DB_CONFIG = {
 }
 
 
+def configure_db_host(host=None, port=None):
+    """
+    Point this process at a specific PostgreSQL server (used when a run is
+    sharded across several hosts). Existing pools are closed.
+    """
+    if host:
+        DEFAULT_DB_CONFIG["host"] = host
+    if port:
+        DEFAULT_DB_CONFIG["port"] = int(port)
+    close_all_postgresql_pools()
+
+
 def _get_or_init_pool(db_name):
     """
     Returns a connection pool for the given database name, creating one if it does not exist.
@@ -41,6 +57,16 @@ def _get_or_init_pool(db_name):
     return _postgresql_pools[db_name]
 
 
+def _statement_timeout(seconds):
+    """statement_timeout value capped at the instance's remaining budget."""
+    return f"SET statement_timeout = {int(deadline.cap(seconds) * 1000)};"
+
+
+def _cancel_backend(conn):
+    """Send a cancel request for the statement running on conn's backend."""
+    conn.cancel()
+
+
 def perform_query_on_postgresql_databases(query, db_name, conn=None):
     """
     Executes the given query on the specified database, returns (result, conn).
@@ -53,19 +79,24 @@ def perform_query_on_postgresql_databases(query, db_name, conn=None):
     if conn is None:
         conn = pool.getconn()
         need_to_put_back = True
+    deadline.watch(conn, _cancel_backend)
+    if read_only.active() and not conn.readonly:
+        # Read-only instance: a write fails instead of changing the database
+        conn.rollback()
+        conn.set_session(readonly=True)
 
     cursor = conn.cursor()
 
-    upper_query = query.upper()
-    if "WITH RECURSIVE" in upper_query:
+    recursive = "recursive" in sql_lexer.classify(query, "postgresql").words
+    if recursive:
         try:
             cursor.execute("SET max_recursive_iterations = 100;")
-            cursor.execute("SET statement_timeout = '15s';")
+            cursor.execute(_statement_timeout(15))
         except Exception as e:
             conn.rollback()
-            cursor.execute("SET statement_timeout = '15s';")
+            cursor.execute(_statement_timeout(15))
     else:
-        cursor.execute("SET statement_timeout = '60s';")  # 标准查询超时
+        cursor.execute(_statement_timeout(60))  # 标准查询超时
 
     try:
         cursor.execute(query)
@@ -83,11 +114,12 @@ def perform_query_on_postgresql_databases(query, db_name, conn=None):
 
     except Exception as e:
         conn.rollback()
+        read_only.check_error(e, query)
         raise e
     finally:
         try:
-            cursor.execute("SET statement_timeout = '60s';")
-            if "WITH RECURSIVE" in upper_query:
+            cursor.execute(_statement_timeout(60))
+            if recursive:
                 # cursor.execute("RESET max_recursive_iterations;")
                 pass
         except:
@@ -133,7 +165,89 @@ def get_connection_for_phase(db_name, logger):
     return conn
 
 
-def reset_and_restore_database(db_name, pg_password, logger):
+def cancel_backend_queries(db_name, pg_password, pg_host=None, pg_port=None):
+    """
+    pg_cancel_backend every running statement on db_name. Used by the wrapper
+    when it had to kill an evaluator, so the server stops its work at once.
+    """
+    pg_host = pg_host or DEFAULT_DB_CONFIG["host"]
+    pg_port = pg_port or DEFAULT_DB_CONFIG["port"]
+    env_vars = os.environ.copy()
+    env_vars["PGPASSWORD"] = pg_password
+    cancel_command = [
+        "psql",
+        "-h",
+        pg_host,
+        "-p",
+        str(pg_port),
+        "-U",
+        DEFAULT_DB_CONFIG["user"],
+        "-d",
+        "postgres",
+        "-c",
+        f"""
+        SELECT pg_cancel_backend(pid)
+        FROM pg_stat_activity
+        WHERE datname = '{db_name}' AND state = 'active' AND pid <> pg_backend_pid();
+        """,
+    ]
+    subprocess.run(
+        cancel_command,
+        check=False,
+        env=env_vars,
+        timeout=30,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_for_quiescence(
+    db_name,
+    pg_password,
+    pg_host=None,
+    pg_port=None,
+    timeout=QUIESCE_TIMEOUT_SECONDS,
+    logger=None,
+):
+    """
+    Wait until no other session is connected to db_name, polling
+    pg_stat_activity with exponential backoff. Returns True once it is idle.
+    """
+    logger = logger or PrintLogger()
+    try:
+        conn = psycopg2.connect(
+            dbname="postgres",
+            user=DEFAULT_DB_CONFIG["user"],
+            password=pg_password,
+            host=pg_host or DEFAULT_DB_CONFIG["host"],
+            port=pg_port or DEFAULT_DB_CONFIG["port"],
+            connect_timeout=10,
+        )
+    except OperationalError as e:
+        logger.error(f"Cannot check sessions on {db_name}: {e}")
+        return False
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+
+            def idle():
+                cursor.execute(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE datname = %s AND pid <> pg_backend_pid();",
+                    (db_name,),
+                )
+                return cursor.fetchone()[0] == 0
+
+            return bool(
+                wait_until(idle, timeout, logger, what=f"sessions on {db_name} to end")
+            )
+    finally:
+        conn.close()
+
+
+def reset_and_restore_database(
+    db_name, pg_password, logger, pg_host=None, pg_port=None
+):
     """
     Resets the database by dropping it and re-creating it from its template.
     1) close pool
@@ -141,9 +255,9 @@ def reset_and_restore_database(db_name, pg_password, logger):
     3) dropdb
     4) createdb --template ...
     """
-    pg_host = "bird_critic_postgresql"
-    pg_port = 5432
-    pg_user = "root"
+    pg_host = pg_host or DEFAULT_DB_CONFIG["host"]
+    pg_port = pg_port or DEFAULT_DB_CONFIG["port"]
+    pg_user = DEFAULT_DB_CONFIG["user"]
 
     env_vars = os.environ.copy()
     env_vars["PGPASSWORD"] = pg_password
@@ -232,12 +346,55 @@ def reset_and_restore_database(db_name, pg_password, logger):
     )
 
 
+def create_read_only_replica(db_name, pg_password, logger, pg_host=None, pg_port=None):
+    """
+    Create <db_name>_process_readonly from the template, with
+    default_transaction_read_only on, so every session on it is read-only.
+    Returns the replica's name.
+    """
+    replica_db = f"{db_name}_process_readonly"
+    pg_host = pg_host or DEFAULT_DB_CONFIG["host"]
+    pg_port = pg_port or DEFAULT_DB_CONFIG["port"]
+    env_vars = os.environ.copy()
+    env_vars["PGPASSWORD"] = pg_password
+
+    reset_and_restore_database(replica_db, pg_password, logger, pg_host, pg_port)
+    subprocess.run(
+        [
+            "psql",
+            "-h",
+            pg_host,
+            "-p",
+            str(pg_port),
+            "-U",
+            DEFAULT_DB_CONFIG["user"],
+            "-d",
+            "postgres",
+            "-c",
+            f'ALTER DATABASE "{replica_db}" SET default_transaction_read_only = on;',
+        ],
+        check=True,
+        env=env_vars,
+        timeout=60,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    logger.info(f"Read-only replica {replica_db} created from the template.")
+    return replica_db
+
+
 def create_ephemeral_db_copies(
-    base_db_names, num_copies, pg_password, logger, max_retries=3
+    base_db_names,
+    num_copies,
+    pg_password,
+    logger,
+    max_retries=3,
+    pg_host=None,
+    pg_port=None,
 ):
-    pg_host = "bird_critic_postgresql"
-    pg_port = 5432
-    pg_user = "root"
+    pg_host = pg_host or DEFAULT_DB_CONFIG["host"]
+    pg_port = pg_port or DEFAULT_DB_CONFIG["port"]
+    pg_user = DEFAULT_DB_CONFIG["user"]
     env_vars = os.environ.copy()
     env_vars["PGPASSWORD"] = pg_password
 
@@ -312,8 +469,16 @@ def create_ephemeral_db_copies(
                             f"Failed to create {ephemeral_name} after {max_retries} attempts"
                         )
                     else:
-                        logger.info(f"Waiting before retry...")
-                        time.sleep(5)
+                        # Usually the template still had a session on it
+                        logger.info(f"Waiting for {base_template} to be idle...")
+                        wait_for_quiescence(
+                            base_template,
+                            pg_password,
+                            pg_host,
+                            pg_port,
+                            timeout=5,
+                            logger=logger,
+                        )
             if success:
                 ephemeral_db_pool[base_db].append(ephemeral_name)
 
@@ -329,13 +494,15 @@ def create_ephemeral_db_copies(
     return ephemeral_db_pool
 
 
-def drop_ephemeral_dbs(ephemeral_db_pool_dict, pg_password, logger):
+def drop_ephemeral_dbs(
+    ephemeral_db_pool_dict, pg_password, logger, pg_host=None, pg_port=None
+):
     """
     Delete all ephemeral databases created during the script execution.
     """
-    pg_host = "bird_critic_postgresql"
-    pg_port = 5432
-    pg_user = "root"
+    pg_host = pg_host or DEFAULT_DB_CONFIG["host"]
+    pg_port = pg_port or DEFAULT_DB_CONFIG["port"]
+    pg_user = DEFAULT_DB_CONFIG["user"]
     env_vars = os.environ.copy()
     env_vars["PGPASSWORD"] = pg_password
 
@@ -375,6 +542,8 @@ def execute_queries(queries, db_name, conn, logger=None, section_title=""):
     if logger is None:
         logger = PrintLogger()
 
+    if not all(sql_lexer.is_read_only(query, "postgresql") for query in queries):
+        reset_ledger.mark_dirty(db_name, section_title or "queries")
     log_section_header(section_title, logger)
     query_result = None
     execution_error = False
@@ -382,14 +551,15 @@ def execute_queries(queries, db_name, conn, logger=None, section_title=""):
 
     for i, query in enumerate(queries):
         try:
+            deadline.check()
             logger.info(f"Executing query {i+1}/{len(queries)}: {query}")
             query_result, conn = perform_query_on_postgresql_databases(
                 query, db_name, conn=conn
             )
             # logger.info(f"Query result: {query_result}")
 
-        except psycopg2.errors.QueryCanceled as e:
-            # Timeout error
+        except (psycopg2.errors.QueryCanceled, deadline.DeadlineExceeded) as e:
+            # Timeout error (statement_timeout or instance deadline)
             logger.error(f"Timeout error executing query {i+1}: {e}")
             timeout_error = True
             break
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Readiness and quiescence probes with exponential backoff.
+
+The wrappers used to sleep a fixed second after every instance (and three
+more before retrying a reset), and the evaluators slept three seconds
+between connection attempts. Instead, a probe is polled starting a few
+milliseconds apart and backing off exponentially, so the caller moves on
+the moment the database is actually free (no sessions left on it) or
+reachable (a connection succeeds), and only waits longer when it is not.
+
+The per-dialect session probes live next to the other server helpers
+(wait_for_quiescence in postgresql_utils, mysql_utils, oracle_utils and
+mssql_utils); this module only provides the polling loop.
+
+Waits are not capped at the instance deadline: they come before the
+instance's first query or belong to a reset or cleanup, which must still
+run after the instance has used up its budget.
+"""
+
+import time
+
+INITIAL_DELAY_SECONDS = 0.005
+MAX_DELAY_SECONDS = 0.5
+# How long a database may take to drop its last session after an instance
+QUIESCE_TIMEOUT_SECONDS = 10.0
+# How long an evaluator keeps retrying its first connection (the old three
+# attempts three seconds apart)
+CONNECT_TIMEOUT_SECONDS = 6.0
+
+
+def backoff_delays(timeout, initial=INITIAL_DELAY_SECONDS, max_delay=MAX_DELAY_SECONDS):
+    """Yield exponentially growing delays until timeout seconds have passed."""
+    stop_at = time.time() + timeout
+    delay = initial
+    while True:
+        left = stop_at - time.time()
+        if left <= 0:
+            return
+        yield min(delay, left)
+        delay = min(delay * 2, max_delay)
+
+
+def wait_until(
+    probe,
+    timeout,
+    logger=None,
+    what="condition",
+    initial=INITIAL_DELAY_SECONDS,
+    max_delay=MAX_DELAY_SECONDS,
+):
+    """
+    Call probe() until it returns a truthy value and return that value, or
+    None once timeout seconds have passed.
+    An exception raised by the probe counts as "not ready yet"; the last one
+    is logged if the wait gives up.
+    """
+    attempts = 0
+    last_error = None
+    delays = backoff_delays(timeout, initial, max_delay)
+    while True:
+        attempts += 1
+        try:
+            value = probe()
+            if value:
+                return value
+        except Exception as e:
+            last_error = e
+        delay = next(delays, None)
+        if delay is None:
+            break
+        time.sleep(delay)
+
+    if logger is not None:
+        message = f"Gave up waiting for {what} after {attempts} attempts"
+        if last_error is not None:
+            message += f": {last_error}"
+        logger.error(message)
+    return None
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read-only instances: prove an instance did not change its database, so the
+reset after it can be skipped.
+
+An instance is a read-only candidate when every SQL statement it lists
+(preprocess_sql, issue_sql, sol_sql, pred_sqls, clean_up_sql) is classified
+as read-only by sql_lexer. Test cases are Python code and cannot be classified, so the
+evaluator also checks at run time:
+
+    PostgreSQL, MySQL  sessions run in read-only transaction mode; a write
+                       fails with a read-only error, is recorded as a
+                       violation, and the evaluator runs the instance again
+                       in normal mode (nothing was written, so no reset is
+                       needed before the re-run)
+    SQLite             every statement's effect is checked with the
+                       connection's total_changes and PRAGMA schema_version;
+                       a change marks the database dirty
+
+Statements that are not read-only mark the database dirty in the reset
+ledger; a read-only run leaves its state untouched, so the ledger skips the
+reset when the database was clean before the instance.
+
+In the read-only lane, the wrappers run read-only candidates concurrently
+on one shared replica per database that cannot be written at all
+(default_transaction_read_only on PostgreSQL, a mode=ro&immutable=1 URI on
+SQLite). A write attempt there is not re-run in place: the result carries
+"read_only_violation" and the wrapper re-queues the instance on the normal
+clone path.
+"""
+
+import threading
+
+import sql_lexer
+
+# PostgreSQL SQLSTATE / MySQL error code / SQLite message for a write to a
+# read-only transaction or database
+PG_READ_ONLY_SQLSTATE = "25006"
+MYSQL_READ_ONLY_ERRNO = 1792
+SQLITE_READ_ONLY_MESSAGE = "attempt to write a readonly database"
+
+SQL_FIELDS = ("preprocess_sql", "issue_sql", "sol_sql", "clean_up_sql")
+
+
+def instance_is_read_only(data, mode="gold", dialect="generic"):
+    """
+    True if every SQL statement the instance lists is read-only, lexing the
+    statements as dialect (a sql_lexer dialect).
+    """
+    fields = SQL_FIELDS + (("pred_sqls",) if mode == "pred" else ())
+    for field in fields:
+        value = data.get(field) or []
+        if isinstance(value, str):
+            value = [value]
+        if not all(
+            sql_lexer.is_read_only(sql, dialect)
+            for sql in value
+            if isinstance(sql, str)
+        ):
+            return False
+    return True
+
+
+def is_violation(e):
+    """True if e is the error of a write attempted in a read-only transaction."""
+    if getattr(e, "pgcode", None) == PG_READ_ONLY_SQLSTATE:
+        return True
+    if SQLITE_READ_ONLY_MESSAGE in str(e):
+        return True
+    args = getattr(e, "args", ())
+    return bool(args) and args[0] == MYSQL_READ_ONLY_ERRNO
+
+
+_lock = threading.Lock()
+_active = False
+_violation = None
+
+
+def enable():
+    """Start a read-only run of the current instance."""
+    global _active, _violation
+    with _lock:
+        _active = True
+        _violation = None
+
+
+def disable():
+    global _active
+    with _lock:
+        _active = False
+
+
+def active():
+    return _active
+
+
+def note_violation(what):
+    """Record that the read-only run attempted a write (first one wins)."""
+    global _violation
+    with _lock:
+        if _active and _violation is None:
+            _violation = str(what)[:200]
+
+
+def check_error(e, what):
+    """Record e as a violation if it is a read-only error."""
+    if _active and is_violation(e):
+        note_violation(f"{what}: {e}")
+
+
+def violation():
+    """What the read-only run tried to write, or None."""
+    return _violation
+
+
+def evaluate(
+    data, mode, evaluate_fn, logger, reopen=None, lane=False, dialect="generic"
+):
+    """
+    Run evaluate_fn() as a read-only run if every SQL statement of data is
+    read-only (in the given sql_lexer dialect), otherwise as a normal run, and return its result. If the
+    read-only run attempted a write, reopen() is called (to drop connections
+    in read-only mode) and evaluate_fn() runs again normally.
+
+    In the read-only lane the run is always read-only, and a write attempt
+    is reported under "read_only_violation" instead of being re-run.
+    """
+    if not lane and not instance_is_read_only(data, mode, dialect):
+        return evaluate_fn()
+    logger.info("All SQL of this instance is read-only; running it read-only")
+    enable()
+    try:
+        result = evaluate_fn()
+    finally:
+        disable()
+    if _violation is None:
+        return result
+    if lane:
+        logger.info(f"Write attempted in the read-only lane: {_violation}")
+        result["read_only_violation"] = _violation
+        return result
+
+    logger.info(f"Read-only run attempted a write ({_violation}); running again")
+    if reopen is not None:
+        reopen()
+    return evaluate_fn()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ledger of database clean/dirty state, used to skip redundant resets.
+
+Resets are issued defensively in several places: the SQL Server wrapper
+resets after every instance although the evaluator has just reset the
+database, and the SQLite evaluator resets a freshly copied database before
+its first phase. The ledger records for each database whether it is known
+to be clean (nothing ran on it since it was created or reset), dirty (and
+what made it dirty), or unknown, and a reset of a database known to be clean
+becomes a no-op. A shared database (a read-only replica other evaluators are
+using at the same time) is never reset.
+
+Each process has one ledger. The wrapper passes the state of a database to
+the evaluator with --db_state, and the evaluator returns its ledger under
+the "reset_ledger" key of its result, so the wrapper knows what state the
+database was left in and can count the resets avoided in both processes.
+"""
+
+import json
+import threading
+
+CLEAN = "clean"
+DIRTY = "dirty"
+UNKNOWN = "unknown"
+SHARED = "shared"
+STATES = (CLEAN, DIRTY, UNKNOWN, SHARED)
+
+
+class ResetLedger:
+    def __init__(self):
+        self.performed = 0
+        self.avoided = 0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def state(self, db):
+        with self._lock:
+            return self._states.get(db, (UNKNOWN, "never seen"))[0]
+
+    def reason(self, db):
+        with self._lock:
+            return self._states.get(db, (UNKNOWN, "never seen"))[1]
+
+    def set_state(self, db, state, reason=""):
+        with self._lock:
+            self._states[db] = (state, reason)
+
+    def mark_clean(self, db, reason="reset"):
+        self.set_state(db, CLEAN, reason)
+
+    def mark_dirty(self, db, reason):
+        with self._lock:
+            # Keep the first cause; later statements add nothing useful. A
+            # shared database is read-only, so nothing was written to it
+            if self._states.get(db, (UNKNOWN,))[0] not in (DIRTY, SHARED):
+                self._states[db] = (DIRTY, reason)
+
+    def mark_unknown(self, db, reason):
+        self.set_state(db, UNKNOWN, reason)
+
+    def reset(self, db, reset_fn, logger=None):
+        """
+        Call reset_fn() unless db is known to be clean or is shared. Returns
+        True if the reset was performed. A failed reset leaves the state
+        unknown.
+        """
+        with self._lock:
+            state, reason = self._states.get(db, (UNKNOWN, "never seen"))
+            if state in (CLEAN, SHARED):
+                self.avoided += 1
+        if state in (CLEAN, SHARED):
+            if logger is not None:
+                since = "clean since" if state == CLEAN else "shared:"
+                logger.info(f"Skipping reset of {db}: {since} {reason}")
+            return False
+        if logger is not None:
+            logger.info(f"Resetting {db} ({state}: {reason})")
+        try:
+            reset_fn()
+        except Exception as e:
+            self.mark_unknown(db, f"reset failed: {e}")
+            raise
+        with self._lock:
+            self.performed += 1
+            self._states[db] = (CLEAN, "reset")
+        return True
+
+    def report(self):
+        """Summary for the evaluator's result (JSON serialisable)."""
+        with self._lock:
+            return {
+                "states": {db: list(entry) for db, entry in self._states.items()},
+                "performed": self.performed,
+                "avoided": self.avoided,
+            }
+
+    def absorb(self, report):
+        """Take over the states and counts an evaluator reported."""
+        with self._lock:
+            for db, (state, reason) in report.get("states", {}).items():
+                self._states[db] = (state, reason)
+            self.performed += report.get("performed", 0)
+            self.avoided += report.get("avoided", 0)
+
+    def summary(self):
+        return (
+            f"Database resets: {self.performed} performed, "
+            f"{self.avoided} avoided (database already clean)"
+        )
+
+
+def absorb_output(output_path, db):
+    """
+    Take over the ledger an evaluator wrote into its result file. Without one
+    (the evaluator crashed or was killed) the database's state is unknown.
+    """
+    try:
+        with open(output_path, "r") as f:
+            ledger.absorb(json.load(f)["reset_ledger"])
+    except (OSError, ValueError, KeyError, TypeError):
+        ledger.mark_unknown(db, "evaluator did not report")
+
+
+# The ledger of this process
+ledger = ResetLedger()
+state = ledger.state
+reason = ledger.reason
+set_state = ledger.set_state
+mark_clean = ledger.mark_clean
+mark_dirty = ledger.mark_dirty
+mark_unknown = ledger.mark_unknown
+reset = ledger.reset
+report = ledger.report
+summary = ledger.summary
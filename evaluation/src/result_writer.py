@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming writer for <base>_output_with_status.jsonl.
+
+Results reach the wrappers in completion order. The writer looks each one up
+through an instance_id -> position index, parks it in a reorder buffer and
+writes every record whose predecessors are all written, so the file is
+produced incrementally but keeps the input order. Error/pass counters are
+updated as results arrive, so the final report needs no extra passes over
+the result list.
+
+The writer behaves like the dict the wrappers used to collect results in
+(results_dict[instance_id] = result, len(results_dict), instance_id in
+results_dict), so it can be handed to the existing worker loops unchanged.
+"""
+
+import json
+import threading
+
+
+class StreamingResultWriter:
+    def __init__(
+        self,
+        output_path,
+        data_list,
+        phase="evaluation",
+        copy_fields=(),
+        drop_fields=(),
+        logger=None,
+    ):
+        """
+        Args:
+            output_path: Path of the status JSONL file (None to skip writing).
+            data_list: Input instances, in the order the file must follow.
+            phase: "evaluation" or "solution"; selects which
+                <phase>_phase_*_error flags are counted.
+            copy_fields: Extra result fields copied onto each output record.
+            drop_fields: Input fields removed from each output record.
+        """
+        self.data_list = data_list
+        self.phase = phase
+        self.copy_fields = tuple(copy_fields)
+        self.drop_fields = tuple(drop_fields)
+        self.logger = logger
+
+        self.index = {
+            data.get("instance_id", f"instance_{i}"): i
+            for i, data in enumerate(data_list)
+        }
+        self.results = [None] * len(data_list)
+
+        self.received = 0
+        self.written = 0
+        self.number_of_execution_errors = 0
+        self.number_of_timeouts = 0
+        self.number_of_assertion_errors = 0
+        self.total_passed_instances = 0
+
+        self._lock = threading.Lock()
+        self._file = open(output_path, "w", encoding="utf-8") if output_path else None
+
+    # ------------------------------------------------------------------
+    # dict-like interface used by the wrappers' worker loops
+    # ------------------------------------------------------------------
+    def __setitem__(self, instance_id, result):
+        self.add(instance_id, result)
+
+    def __getitem__(self, instance_id):
+        result = self.get(instance_id)
+        if result is None:
+            raise KeyError(instance_id)
+        return result
+
+    def __contains__(self, instance_id):
+        return self.get(instance_id) is not None
+
+    def __len__(self):
+        return self.received
+
+    def get(self, instance_id, default=None):
+        pos = self.index.get(instance_id)
+        if pos is None or self.results[pos] is None:
+            return default
+        return self.results[pos]
+
+    def update(self, results_by_instance_id):
+        for instance_id, result in results_by_instance_id.items():
+            self.add(instance_id, result)
+
+    # ------------------------------------------------------------------
+    def add(self, instance_id, result):
+        """Record a result and write every record that is now in order."""
+        pos = self.index.get(instance_id)
+        if pos is None:
+            self._warn(f"Ignoring result for unknown instance {instance_id}")
+            return
+
+        with self._lock:
+            if self.results[pos] is not None:
+                self._warn(f"Ignoring duplicate result for instance {instance_id}")
+                return
+            self.results[pos] = result
+            self.received += 1
+            self._count(result)
+            self._flush()
+
+    def _count(self, result):
+        prefix = f"{self.phase}_phase"
+        if result.get(f"{prefix}_execution_error", False):
+            self.number_of_execution_errors += 1
+        if result.get(f"{prefix}_timeout_error", False):
+            self.number_of_timeouts += 1
+        if result.get(f"{prefix}_assertion_error", False):
+            self.number_of_assertion_errors += 1
+        if result.get("status") == "success":
+            self.total_passed_instances += 1
+
+    def _flush(self):
+        while (
+            self.written < len(self.results) and self.results[self.written] is not None
+        ):
+            if self._file is not None:
+                record = self._record(
+                    self.data_list[self.written], self.results[self.written]
+                )
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.written += 1
+        if self._file is not None:
+            self._file.flush()
+
+    def _record(self, data, result):
+        data["status"] = result.get("status")
+        data["error_message"] = result.get("error_message")
+        for field in self.copy_fields:
+            if field in result:
+                data[field] = result[field]
+        for field in self.drop_fields:
+            data.pop(field, None)
+        return data
+
+    def _warn(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
+        else:
+            print(message)
+
+    @property
+    def total_errors(self):
+        return (
+            self.number_of_execution_errors
+            + self.number_of_timeouts
+            + self.number_of_assertion_errors
+        )
+
+    def finish(self, missing_result=None):
+        """
+        Fill in instances that never produced a result, write the remaining
+        records and close the file. missing_result(data, instance_id) builds
+        the placeholder result. Returns the results in input order.
+        """
+        for pos, result in enumerate(self.results):
+            if result is not None:
+                continue
+            data = self.data_list[pos]
+            instance_id = data.get("instance_id", f"instance_{pos}")
+            self._warn(f"Missing result for instance {instance_id}")
+            if missing_result is not None:
+                placeholder = missing_result(data, instance_id)
+            else:
+                placeholder = {
+                    "instance_id": instance_id,
+                    "status": "failed",
+                    "error_message": "Result missing from processing",
+                    f"{self.phase}_phase_execution_error": True,
+                    "total_test_cases": len(data.get("test_cases", [])),
+                    "passed_test_cases": 0,
+                    "failed_test_cases": [],
+                }
+            self.add(instance_id, placeholder)
+
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        return list(self.results)
@@ -12,18 +12,26 @@ import sys
 import os
 import io
 import traceback
-import time
 import gc
 from datetime import date
 
 # Local imports
 from logger import configure_logger, NullLogger
+import deadline
+import fetch_limits
+import reset_ledger
+from quiescence import CONNECT_TIMEOUT_SECONDS, wait_until
 from mssql_utils import (
+    configure_db_host,
+    configure_reset_strategy,
+    RESET_STRATEGIES,
     perform_query_on_sqlserver_databases,
     close_sqlserver_connection,
     execute_queries,
     get_connection_for_phase,
     reset_and_restore_database,
+    resetter,
+    wait_for_quiescence,
     load_jsonl,
     split_field,
     run_preprocessing,
@@ -41,11 +49,15 @@ from mssql_test_utils import (
 from datetime import date
 
 
-def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
+def run_test_case(
+    test_code, result, logger, conn, issue_sql, sol_sql, db_name, truncated=False
+):
     """
     Execute a single test case, capturing AssertionError or other exceptions.
     Returns True if test passed, False otherwise, and an error message.
     """
+    # Test code gets the connection and may run anything on it
+    reset_ledger.mark_dirty(db_name, "test case")
     global_env = {
         "perform_query_on_sqlserver_databases": perform_query_on_sqlserver_databases,
         "execute_queries": execute_queries,
@@ -57,6 +69,7 @@ def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
         "preprocess_results": preprocess_results,
         "preprocess_results_dict": preprocess_results_dict,
         "pred_query_result": result,
+        "result_truncated": truncated,
         "date": date,
     }
     local_env = {
@@ -110,6 +123,10 @@ def execute_test_cases(
     Execute test cases sequentially.
     Returns (passed_count, failed_tests, error_messages).
     """
+    # Whether sql_result was cut at the fetch caps
+    truncated = fetch_limits.truncated()
+    if truncated:
+        logger.warning(f"Result passed to the test cases is truncated: {truncated}")
     passed_count = 0
     failed_tests = []
     test_error_messages = ""
@@ -119,7 +136,14 @@ def execute_test_cases(
 
         try:
             test_passed, error_message = run_test_case(
-                test_case, sql_result, logger, conn, issue_sql, sol_sql, db_name
+                test_case,
+                sql_result,
+                logger,
+                conn,
+                issue_sql,
+                sol_sql,
+                db_name,
+                truncated is not None,
             )
 
             if test_passed:
@@ -143,6 +167,7 @@ def run_solution_phase(
     Execute sol_sql and validate its results using test cases.
     If efficiency=True, there may be additional performance comparisons.
     """
+    fetch_limits.clear()
     sol_sql_result, exec_error_flag, timeout_flag = execute_queries(
         sol_sql, db_name, conn, logger, "LLM Generated SQL", is_solution=True
     )
@@ -164,7 +189,11 @@ def run_solution_phase(
                 test_cases, sol_sql_result, logger, conn, issue_sql, sol_sql, db_name
             )
         if failed_tests:
-            instance_assertion_error = True
+            if deadline.expired():
+                # Test queries were cancelled when the instance ran out of time
+                instance_timeout_error = True
+            else:
+                instance_assertion_error = True
             error_msg = test_error_messages
 
     return (
@@ -204,7 +233,9 @@ def ensure_safe_database_reset(db_name, logger, max_retries=3):
             logger.info(
                 f"Resetting database {db_name} (attempt {attempt+1}/{max_retries})"
             )
-            reset_and_restore_database(db_name, logger)
+            reset_ledger.reset(
+                db_name, lambda: reset_and_restore_database(db_name, logger), logger
+            )
             logger.info(f"Database {db_name} reset successfully")
             return True
         except Exception as e:
@@ -212,7 +243,8 @@ def ensure_safe_database_reset(db_name, logger, max_retries=3):
                 f"Error resetting database {db_name} (attempt {attempt+1}): {e}"
             )
             if attempt < max_retries - 1:
-                time.sleep(3)  # Wait before retry
+                # Usually the database still had a session on it
+                wait_for_quiescence(db_name, timeout=3, logger=logger)
             else:
                 logger.error(
                     f"Failed to reset database {db_name} after {max_retries} attempts"
@@ -280,55 +312,48 @@ def evaluate_instance(data, args, logger):
     solution_conn = None
 
     try:
-        # Get connection with retry
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                error_conn = get_connection_for_phase(db_name, logger)
-                if error_conn:
-                    break
-            except Exception as e:
-                logger.error(f"Failed to get connection on attempt {attempt+1}: {e}")
-                if attempt == max_retries - 1:
-                    return {
-                        "instance_id": instance_id,
-                        "status": "failed",
-                        "error_message": f"Failed to get database connection after {max_retries} attempts",
-                        "total_test_cases": total_test_cases,
-                        "passed_test_cases": 0,
-                        "failed_test_cases": [],
-                        "solution_phase_execution_error": True,
-                        "solution_phase_timeout_error": False,
-                        "solution_phase_assertion_error": False,
-                    }
-                time.sleep(3)  # Wait before retry
+        # Get connection, retrying with backoff until the server accepts it
+        error_conn = wait_until(
+            lambda: get_connection_for_phase(db_name, logger),
+            CONNECT_TIMEOUT_SECONDS,
+            logger,
+            what=f"a connection to {db_name}",
+        )
+        if not error_conn:
+            return {
+                "instance_id": instance_id,
+                "status": "failed",
+                "error_message": f"Failed to get database connection within {CONNECT_TIMEOUT_SECONDS}s",
+                "total_test_cases": total_test_cases,
+                "passed_test_cases": 0,
+                "failed_test_cases": [],
+                "solution_phase_execution_error": True,
+                "solution_phase_timeout_error": False,
+                "solution_phase_assertion_error": False,
+            }
 
         # ---------- Solution Phase ----------
         logger.info("=== Starting Solution Phase ===")
 
-        # Get new connection for solution phase with retries
-        for attempt in range(max_retries):
-            try:
-                solution_conn = get_connection_for_phase(db_name, logger)
-                if solution_conn:
-                    break
-            except Exception as e:
-                logger.error(
-                    f"Failed to get solution phase connection on attempt {attempt+1}: {e}"
-                )
-                if attempt == max_retries - 1:
-                    return {
-                        "instance_id": instance_id,
-                        "status": "failed",
-                        "error_message": f"Failed to get solution phase database connection after {max_retries} attempts",
-                        "total_test_cases": total_test_cases,
-                        "passed_test_cases": 0,
-                        "failed_test_cases": [],
-                        "solution_phase_execution_error": True,
-                        "solution_phase_timeout_error": False,
-                        "solution_phase_assertion_error": False,
-                    }
-                time.sleep(3)  # Wait before retry
+        # Get solution phase connection, retrying with backoff
+        solution_conn = wait_until(
+            lambda: get_connection_for_phase(db_name, logger),
+            CONNECT_TIMEOUT_SECONDS,
+            logger,
+            what=f"a connection to {db_name}",
+        )
+        if not solution_conn:
+            return {
+                "instance_id": instance_id,
+                "status": "failed",
+                "error_message": f"Failed to get solution phase database connection within {CONNECT_TIMEOUT_SECONDS}s",
+                "total_test_cases": total_test_cases,
+                "passed_test_cases": 0,
+                "failed_test_cases": [],
+                "solution_phase_execution_error": True,
+                "solution_phase_timeout_error": False,
+                "solution_phase_assertion_error": False,
+            }
 
         # Run preprocessing SQL again
         run_preprocessing(preprocess_sql, db_name, logger, solution_conn)
@@ -483,8 +508,56 @@ def main():
         type=str,
         help="Specific path for the log file.",
     )
+    parser.add_argument(
+        "--db_host",
+        default=None,
+        help="SQL Server host holding the database (default: bird_critic_sqlserver).",
+    )
+    parser.add_argument(
+        "--db_port",
+        type=int,
+        default=None,
+        help="Port of the SQL Server given by --db_host.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Absolute deadline (epoch seconds) for this instance's queries; running queries are cancelled when it passes.",
+    )
+
+    parser.add_argument(
+        "--db_state",
+        choices=reset_ledger.STATES,
+        default=reset_ledger.UNKNOWN,
+        help="State of the database as known to the wrapper; resets of a "
+        "clean database are skipped.",
+    )
+    parser.add_argument(
+        "--reset_strategy",
+        choices=RESET_STRATEGIES,
+        default="snapshot",
+        help="snapshot: revert databases to a snapshot taken after the first "
+        "restore; backup: always restore them from their .bak file.",
+    )
+    parser.add_argument(
+        "--max_rows",
+        type=int,
+        default=fetch_limits.MAX_ROWS,
+        help="Most rows fetched per query result; the rest is not fetched.",
+    )
+    parser.add_argument(
+        "--max_result_bytes",
+        type=int,
+        default=fetch_limits.MAX_BYTES,
+        help="Most bytes of values fetched per query result (approximate).",
+    )
 
     args = parser.parse_args()
+    configure_db_host(args.db_host, args.db_port)
+    configure_reset_strategy(args.reset_strategy)
+    deadline.set_deadline(args.deadline)
+    fetch_limits.configure(args.max_rows, args.max_result_bytes)
 
     try:
         # Load the data (expecting only one instance)
@@ -494,6 +567,7 @@ def main():
             sys.exit(1)
 
         data = data_list[0]  # Get the single instance
+        reset_ledger.set_state(data.get("db_id"), args.db_state, "wrapper")
         instance_id = data.get("instance_id", 0)
 
         # Configure logger
@@ -515,7 +589,9 @@ def main():
         # Evaluate the instance
         evaluation_result = evaluate_instance(data, args, logger)
 
-        # Write the output
+        # Write the output, with the state the database was left in
+        evaluation_result["reset_ledger"] = reset_ledger.report()
+        evaluation_result["reset_timings"] = resetter.report()
         with open(args.output_file, "w") as f:
             json.dump(evaluation_result, f)
 
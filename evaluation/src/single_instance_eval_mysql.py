@@ -11,17 +11,26 @@ import sys
 import os
 import io
 import traceback
-import time
 import gc
 from datetime import date
 
 # Local imports
 from logger import configure_logger, NullLogger
+import deadline
+import read_only
+import reset_ledger
+import transaction_sandbox
+from quiescence import CONNECT_TIMEOUT_SECONDS, wait_until
 from mysql_utils import (
+    DEFAULT_DB_CONFIG,
+    configure_db_host,
     perform_query_on_mysql_databases,
     close_mysql_connection,
+    close_all_mysql_pools,
     execute_queries,
+    non_transactional_tables,
     reset_and_restore_database,
+    base_db_name,
     load_jsonl,
     split_field,
 )
@@ -39,6 +48,10 @@ def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
     Execute a single test case, capturing AssertionError or other exceptions.
     Returns True if test passed, False otherwise, and an error message.
     """
+    # Test code gets the connection and may run anything on it (unless the
+    # connection is read-only)
+    if not read_only.active():
+        reset_ledger.mark_dirty(db_name, "test case")
     global_env = {
         "perform_query_on_mysql_databases": perform_query_on_mysql_databases,
         "execute_queries": execute_queries,
@@ -83,6 +96,7 @@ def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
         error_message = f"Test case failed due to assertion error: {e}\n"
         test_passed = False
     except Exception as e:
+        read_only.check_error(e, "test case")
         logger.error(f"Test case failed due to error: {e}")
         error_message = f"Test case failed due to error: {e}\n"
         test_passed = False
@@ -190,7 +204,11 @@ def run_evaluation_phase(
             )
 
         if failed_tests:
-            instance_assertion_error = True
+            if deadline.expired():
+                # Test queries were cancelled when the instance ran out of time
+                instance_timeout_error = True
+            else:
+                instance_assertion_error = True
 
     return (
         instance_execution_error,
@@ -214,6 +232,26 @@ def get_mysql_connection(
         return None
 
 
+def start_sandbox(data, args, db_name, conn, logger):
+    """
+    Start the transaction sandbox for this instance if its changes can be
+    rolled back, and return the connection to run it on. Otherwise log why
+    the database will be reset by cloning and return conn unchanged.
+    """
+    if args.reset_strategy != "auto" or read_only.active():
+        return conn
+    reason = transaction_sandbox.instance_reason(data, args.mode)
+    if reason is None:
+        tables = non_transactional_tables(db_name, conn)
+        if tables:
+            reason = f"non-transactional tables {', '.join(tables)}"
+    if reason is not None:
+        logger.info(f"Reset strategy: clone ({reason})")
+        return conn
+    logger.info("Reset strategy: transaction rollback (no implicit commits)")
+    return transaction_sandbox.begin(conn, db_name)
+
+
 def evaluate_instance(data, args, logger):
     """Evaluate a single instance and return the results."""
     # Initialize result values
@@ -257,9 +295,9 @@ def evaluate_instance(data, args, logger):
     total_test_cases = len(test_cases)
 
     # MySQL connection parameters
-    mysql_host = "bird_critic_mysql"
-    mysql_port = 3306
-    mysql_user = "root"
+    mysql_host = DEFAULT_DB_CONFIG["host"]
+    mysql_port = DEFAULT_DB_CONFIG["port"]
+    mysql_user = DEFAULT_DB_CONFIG["user"]
     mysql_pass = args.mysql_password
 
     # Which solution field to use depends on --mode
@@ -270,40 +308,37 @@ def evaluate_instance(data, args, logger):
         sol_sqls = split_field(data, "pred_sqls")
         gold_sqls = split_field(data, "sol_sql")
 
-    # Get connection with retry
-    db_connection = None
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            db_connection = get_mysql_connection(
-                db_name, logger, mysql_host, mysql_port, mysql_user, mysql_pass
-            )
-            if db_connection:
-                break
-        except Exception as e:
-            logger.error(f"Failed to get connection on attempt {attempt+1}: {e}")
-            if attempt == max_retries - 1:
-                return {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": f"Failed to get database connection after {max_retries} attempts",
-                    "total_test_cases": total_test_cases,
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                    "evaluation_phase_execution_error": True,
-                    "evaluation_phase_timeout_error": False,
-                    "evaluation_phase_assertion_error": False,
-                }
-            time.sleep(3)  # Wait before retry
+    # Get connection, retrying with backoff until the server accepts it
+    db_connection = wait_until(
+        lambda: get_mysql_connection(
+            db_name, logger, mysql_host, mysql_port, mysql_user, mysql_pass
+        ),
+        CONNECT_TIMEOUT_SECONDS,
+        logger,
+        what=f"a connection to {db_name}",
+    )
+    if not db_connection:
+        return {
+            "instance_id": instance_id,
+            "status": "failed",
+            "error_message": f"Failed to get database connection within {CONNECT_TIMEOUT_SECONDS}s",
+            "total_test_cases": total_test_cases,
+            "passed_test_cases": 0,
+            "failed_test_cases": [],
+            "evaluation_phase_execution_error": True,
+            "evaluation_phase_timeout_error": False,
+            "evaluation_phase_assertion_error": False,
+        }
 
     try:
         _, db_connection = perform_query_on_mysql_databases("SELECT 1", db_name)
+        sandbox_connection = start_sandbox(data, args, db_name, db_connection, logger)
 
         # ---------- Evaluation Phase ----------
         logger.info("=== Starting Evaluation Phase ===")
 
         # Run preprocessing SQL again
-        run_preprocessing(preprocess_sql, db_name, logger, db_connection)
+        run_preprocessing(preprocess_sql, db_name, logger, sandbox_connection)
 
         # Run evaluation phase tests
         (
@@ -321,7 +356,7 @@ def evaluate_instance(data, args, logger):
             test_cases,
             logger,
             efficiency,
-            db_connection,
+            sandbox_connection,
         )
 
         passed_test_cases_count = passed_count
@@ -333,7 +368,7 @@ def evaluate_instance(data, args, logger):
             execute_queries(
                 clean_up_sql,
                 db_name,
-                db_connection,
+                sandbox_connection,
                 logger,
                 section_title="Clean Up SQL",
                 is_solution=False,
@@ -357,6 +392,10 @@ def evaluate_instance(data, args, logger):
             "evaluation_phase_assertion_error": False,
         }
     finally:
+        # Roll back the sandbox transaction (if it holds, no reset is needed)
+        if transaction_sandbox.active():
+            transaction_sandbox.finish(logger)
+
         # Close connection
         if db_connection:
             try:
@@ -365,15 +404,19 @@ def evaluate_instance(data, args, logger):
             except Exception as e:
                 logger.error(f"Error closing connection: {e}")
 
-        # Reset database one last time
+        # Reset database one last time (unless nothing ran on it)
         try:
-            reset_and_restore_database(
+            reset_ledger.reset(
                 db_name,
-                f"{db_name}_template",
-                mysql_user,
-                mysql_pass,
-                mysql_host,
-                mysql_port,
+                lambda: reset_and_restore_database(
+                    db_name,
+                    f"{base_db_name(db_name)}_template",
+                    mysql_user,
+                    mysql_pass,
+                    mysql_host,
+                    mysql_port,
+                    logger,
+                ),
                 logger,
             )
         except Exception as e:
@@ -438,8 +481,49 @@ def main():
         default="123123",
         help="MySQL root password for resetting the database.",
     )
+    parser.add_argument(
+        "--db_host",
+        default=None,
+        help="MySQL server holding this instance's database (default: bird_critic_mysql).",
+    )
+    parser.add_argument(
+        "--db_port",
+        type=int,
+        default=None,
+        help="Port of the MySQL server given by --db_host.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Absolute deadline (epoch seconds) for this instance's queries; running queries are cancelled when it passes.",
+    )
+    parser.add_argument(
+        "--db_state",
+        choices=reset_ledger.STATES,
+        default=reset_ledger.UNKNOWN,
+        help="State of the database as known to the wrapper; resets of a "
+        "clean database are skipped.",
+    )
+    parser.add_argument(
+        "--read_only",
+        choices=["auto", "off"],
+        default="auto",
+        help="auto: run instances whose SQL is all read-only in read-only "
+        "transactions, so no reset is needed after them.",
+    )
+    parser.add_argument(
+        "--reset_strategy",
+        choices=["auto", "clone"],
+        default="auto",
+        help="auto: run instances without implicit-commit statements in one "
+        "transaction and roll it back instead of re-cloning the database; "
+        "clone: always re-clone.",
+    )
 
     args = parser.parse_args()
+    configure_db_host(args.db_host, args.db_port)
+    deadline.set_deadline(args.deadline)
 
     try:
         # Load the data (expecting only one instance)
@@ -449,6 +533,7 @@ def main():
             sys.exit(1)
 
         data = data_list[0]  # Get the single instance
+        reset_ledger.set_state(data.get("db_id"), args.db_state, "wrapper")
         instance_id = data.get("instance_id", 0)
 
         # Configure logger
@@ -468,9 +553,20 @@ def main():
         logger.info(f"Evaluating instance {instance_id}")
 
         # Evaluate the instance
-        evaluation_result = evaluate_instance(data, args, logger)
+        if args.read_only == "auto":
+            evaluation_result = read_only.evaluate(
+                data,
+                args.mode,
+                lambda: evaluate_instance(data, args, logger),
+                logger,
+                reopen=close_all_mysql_pools,
+                dialect="mysql",
+            )
+        else:
+            evaluation_result = evaluate_instance(data, args, logger)
 
-        # Write the output
+        # Write the output, with the state the database was left in
+        evaluation_result["reset_ledger"] = reset_ledger.report()
         with open(args.output_file, "w") as f:
             json.dump(evaluation_result, f)
 
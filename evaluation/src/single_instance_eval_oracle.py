@@ -16,8 +16,15 @@ from datetime import date
 
 # Local imports
 from logger import configure_logger, NullLogger
+import deadline
+import fetch_limits
 from oracle_utils import (
+    FLASHBACK,
+    MASTER_RESET_STRATEGIES,
+    capture_scn,
+    configure_db_host,
     reset_and_restore_database,
+    written_table_candidates,
     get_connection_for_phase,
     execute_queries,
     execute_issue_sql,
@@ -40,7 +47,9 @@ from oracle_test_utils import (
 )
 
 
-def run_test_case(test_code, result, logger, idx, conn, issue_sql, sol_sql, db_name):
+def run_test_case(
+    test_code, result, logger, idx, conn, issue_sql, sol_sql, db_name, truncated=False
+):
     """
     Execute a single test case, capturing AssertionError or other exceptions,
     and record the result.
@@ -57,6 +66,7 @@ def run_test_case(test_code, result, logger, idx, conn, issue_sql, sol_sql, db_n
         "preprocess_results": preprocess_results,
         "preprocess_results_dict": preprocess_results_dict,
         "pred_query_result": result,
+        "result_truncated": truncated,
         "date": date,
         "conn": conn,
     }
@@ -106,13 +116,25 @@ def execute_test_cases(
     """
     Execute the list of test cases in sequence.
     """
+    # Whether sql_result was cut at the fetch caps
+    truncated = fetch_limits.truncated()
+    if truncated:
+        logger.warning(f"Result passed to the test cases is truncated: {truncated}")
     passed_count = 0
     failed_tests = []
 
     for i, test_case in enumerate(test_cases, start=1):
         logger.info(f"Starting test case {i}/{len(test_cases)}")
         test_passed = run_test_case(
-            test_case, sql_result, logger, i, conn, issue_sql, sol_sql, db_name
+            test_case,
+            sql_result,
+            logger,
+            i,
+            conn,
+            issue_sql,
+            sol_sql,
+            db_name,
+            truncated is not None,
         )
 
         if test_passed:
@@ -128,6 +150,7 @@ def run_error_phase(issue_sql, sol_sql, db_name, test_cases, logger, conn, effic
     1. Execute issue_sql (which is expected to fail).
     2. If it does not fail and there are test_cases, execute them and expect them to fail.
     """
+    fetch_limits.clear()
     error_message, issue_sql_result = execute_issue_sql(
         issue_sql, db_name, logger, conn
     )
@@ -151,6 +174,7 @@ def run_solution_phase(
     Execute sol_sql and validate its results using test cases.
     If efficiency=True, there may be additional performance comparisons.
     """
+    fetch_limits.clear()
     sol_sql_result, exec_error_flag, timeout_flag, error_msg = execute_queries(
         sol_sql, db_name, conn, logger, "LLM Generated SQL", is_solution=True
     )
@@ -171,7 +195,11 @@ def run_solution_phase(
                 test_cases, sol_sql_result, logger, conn, issue_sql, sol_sql, db_name
             )
         if failed_tests:
-            instance_assertion_error = True
+            if deadline.expired():
+                # Test queries were cancelled when the instance ran out of time
+                instance_timeout_error = True
+            else:
+                instance_assertion_error = True
 
     return (
         instance_execution_error,
@@ -277,6 +305,13 @@ def evaluate_instance(data, ephemeral_user, args, logger):
             "solution_phase_assertion_error": False,
         }
 
+    # The MASTER tables the instance may write are flashed back to this SCN
+    scn = None
+    master_tables = ()
+    if args.master_reset == FLASHBACK:
+        master_tables = written_table_candidates(data, args.mode)
+        scn = capture_scn(logger)
+
     # Attempt to process the instance
     try:
 
@@ -362,14 +397,18 @@ def evaluate_instance(data, ephemeral_user, args, logger):
 
         # Reset database after solution phase
         logger.info(f"Resetting ephemeral user {ephemeral_user} after solution phase.")
-        reset_and_restore_database(ephemeral_user, logger)
+        reset_and_restore_database(
+            ephemeral_user, logger, scn=scn, master_tables=master_tables
+        )
 
     except Exception as e:
         logger.error(f"Unexpected error evaluating instance: {e}")
         logger.error(traceback.format_exc())
         try:
             # Try to reset the database in case of error
-            reset_and_restore_database(ephemeral_user, logger)
+            reset_and_restore_database(
+                ephemeral_user, logger, scn=scn, master_tables=master_tables
+            )
         except Exception as reset_error:
             logger.error(f"Error resetting database after failure: {reset_error}")
 
@@ -444,8 +483,48 @@ def main():
         required=True,
         help="The ephemeral Oracle user to use for this evaluation.",
     )
+    parser.add_argument(
+        "--db_host",
+        default=None,
+        help="Oracle server holding the ephemeral user (default: oracle19).",
+    )
+    parser.add_argument(
+        "--db_port",
+        type=int,
+        default=None,
+        help="Port of the Oracle server given by --db_host.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Absolute deadline (epoch seconds) for this instance's queries; running queries are cancelled when it passes.",
+    )
+
+    parser.add_argument(
+        "--master_reset",
+        choices=MASTER_RESET_STRATEGIES,
+        default=FLASHBACK,
+        help="How MASTER tables changed by the instance are restored: flashback "
+        "(FLASHBACK TABLE to the SCN captured before it) or none.",
+    )
+    parser.add_argument(
+        "--max_rows",
+        type=int,
+        default=fetch_limits.MAX_ROWS,
+        help="Most rows fetched per query result; the rest is not fetched.",
+    )
+    parser.add_argument(
+        "--max_result_bytes",
+        type=int,
+        default=fetch_limits.MAX_BYTES,
+        help="Most bytes of values fetched per query result (approximate).",
+    )
 
     args = parser.parse_args()
+    configure_db_host(args.db_host, args.db_port)
+    deadline.set_deadline(args.deadline)
+    fetch_limits.configure(args.max_rows, args.max_result_bytes)
 
     try:
         # Load the data (expecting only one instance)
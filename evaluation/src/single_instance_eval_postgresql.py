@@ -11,15 +11,20 @@ import sys
 import os
 import io
 import traceback
-import time
 import gc
 from datetime import date
 
 # Local imports
 from logger import configure_logger, NullLogger
+import deadline
+import read_only
+import reset_ledger
+from quiescence import CONNECT_TIMEOUT_SECONDS, wait_until
 from postgresql_utils import (
+    configure_db_host,
     perform_query_on_postgresql_databases,
     close_postgresql_connection,
+    close_all_postgresql_pools,
     execute_queries,
     get_connection_for_phase,
     reset_and_restore_database,
@@ -40,6 +45,10 @@ def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
     Execute a single test case, capturing AssertionError or other exceptions.
     Returns True if test passed, False otherwise, and an error message.
     """
+    # Test code gets the connection and may run anything on it (unless the
+    # connection is read-only)
+    if not read_only.active():
+        reset_ledger.mark_dirty(db_name, "test case")
     global_env = {
         "perform_query_on_postgresql_databases": perform_query_on_postgresql_databases,
         "execute_queries": execute_queries,
@@ -79,6 +88,7 @@ def run_test_case(test_code, result, logger, conn, issue_sql, sol_sql, db_name):
         error_message = f"Test case failed due to assertion error: {e}\n"
         test_passed = False
     except Exception as e:
+        read_only.check_error(e, "test case")
         logger.error(f"Test case failed due to error: {e}")
         error_message = f"Test case failed due to error: {e}\n"
         test_passed = False
@@ -166,7 +176,11 @@ def run_evaluation_phase(
             )
 
         if failed_tests:
-            instance_assertion_error = True
+            if deadline.expired():
+                # Test queries were cancelled when the instance ran out of time
+                instance_timeout_error = True
+            else:
+                instance_assertion_error = True
 
     return (
         instance_execution_error,
@@ -235,29 +249,25 @@ def evaluate_instance(data, args, logger):
         sol_sqls = split_field(data, "pred_sqls")
         gold_sqls = split_field(data, "sol_sql")
 
-    # Get connection with retry
-    db_connection = None
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            db_connection = get_connection_for_phase(db_name, logger)
-            if db_connection:
-                break
-        except Exception as e:
-            logger.error(f"Failed to get connection on attempt {attempt+1}: {e}")
-            if attempt == max_retries - 1:
-                return {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": f"Failed to get database connection after {max_retries} attempts",
-                    "total_test_cases": total_test_cases,
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                    "evaluation_phase_execution_error": True,
-                    "evaluation_phase_timeout_error": False,
-                    "evaluation_phase_assertion_error": False,
-                }
-            time.sleep(3)  # Wait before retry
+    # Get connection, retrying with backoff until the server accepts it
+    db_connection = wait_until(
+        lambda: get_connection_for_phase(db_name, logger),
+        CONNECT_TIMEOUT_SECONDS,
+        logger,
+        what=f"a connection to {db_name}",
+    )
+    if not db_connection:
+        return {
+            "instance_id": instance_id,
+            "status": "failed",
+            "error_message": f"Failed to get database connection within {CONNECT_TIMEOUT_SECONDS}s",
+            "total_test_cases": total_test_cases,
+            "passed_test_cases": 0,
+            "failed_test_cases": [],
+            "evaluation_phase_execution_error": True,
+            "evaluation_phase_timeout_error": False,
+            "evaluation_phase_assertion_error": False,
+        }
 
     try:
 
@@ -327,9 +337,13 @@ def evaluate_instance(data, args, logger):
             except Exception as e:
                 logger.error(f"Error closing connection: {e}")
 
-        # Reset database one last time
+        # Reset database one last time (unless nothing ran on it)
         try:
-            reset_and_restore_database(db_name, "123123", logger)
+            reset_ledger.reset(
+                db_name,
+                lambda: reset_and_restore_database(db_name, "123123", logger),
+                logger,
+            )
         except Exception as e:
             logger.error(f"Error during final database reset: {e}")
 
@@ -387,8 +401,44 @@ def main():
         type=str,
         help="Specific path for the log file.",
     )
+    parser.add_argument(
+        "--db_host",
+        default=None,
+        help="PostgreSQL server holding this instance's database (default: bird_critic_postgresql).",
+    )
+    parser.add_argument(
+        "--db_port",
+        type=int,
+        default=None,
+        help="Port of the PostgreSQL server given by --db_host.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Absolute deadline (epoch seconds) for this instance's queries; running queries are cancelled when it passes.",
+    )
+
+    parser.add_argument(
+        "--db_state",
+        choices=reset_ledger.STATES,
+        default=reset_ledger.UNKNOWN,
+        help="State of the database as known to the wrapper; resets of a "
+        "clean database are skipped.",
+    )
+    parser.add_argument(
+        "--read_only",
+        choices=["auto", "off", "lane"],
+        default="auto",
+        help="auto: run instances whose SQL is all read-only in read-only "
+        "transactions, so no reset is needed after them. lane: the database "
+        "is a shared read-only replica; a write attempt is reported instead "
+        "of re-run.",
+    )
 
     args = parser.parse_args()
+    configure_db_host(args.db_host, args.db_port)
+    deadline.set_deadline(args.deadline)
 
     try:
         # Load the data (expecting only one instance)
@@ -398,6 +448,7 @@ def main():
             sys.exit(1)
 
         data = data_list[0]  # Get the single instance
+        reset_ledger.set_state(data.get("db_id"), args.db_state, "wrapper")
         instance_id = data.get("instance_id", 0)
 
         # Configure logger
@@ -417,9 +468,21 @@ def main():
         logger.info(f"Evaluating instance {instance_id}")
 
         # Evaluate the instance
-        evaluation_result = evaluate_instance(data, args, logger)
+        if args.read_only != "off":
+            evaluation_result = read_only.evaluate(
+                data,
+                args.mode,
+                lambda: evaluate_instance(data, args, logger),
+                logger,
+                reopen=close_all_postgresql_pools,
+                lane=args.read_only == "lane",
+                dialect="postgresql",
+            )
+        else:
+            evaluation_result = evaluate_instance(data, args, logger)
 
-        # Write the output
+        # Write the output, with the state the database was left in
+        evaluation_result["reset_ledger"] = reset_ledger.report()
         with open(args.output_file, "w") as f:
             json.dump(evaluation_result, f)
 
@@ -10,12 +10,15 @@ import sys
 import os
 import io
 import traceback
-import time
 import gc
 from datetime import date
 
 # Local imports
 from logger import configure_logger, NullLogger
+import deadline
+import read_only
+import reset_ledger
+from quiescence import CONNECT_TIMEOUT_SECONDS, wait_until
 from utils import load_jsonl, split_field
 from sqlite_utils import (
     perform_query_on_sqlite_databases,
@@ -23,6 +26,8 @@ from sqlite_utils import (
     execute_queries,
     get_connection_for_phase,
     reset_and_restore_database,
+    share_read_only,
+    write_fingerprint,
 )
 from sqlite_test_utils import (
     check_sql_function_usage,
@@ -40,6 +45,13 @@ def run_test_case(
     test_code, result, logger, conn, pred_sqls, sol_sqls, db_path, kwargs
 ):
     """Execute a single test case"""
+    # Test code gets the connection and may run anything on it; in a
+    # read-only run, check what it did instead
+    fingerprint = None
+    if read_only.active() and conn is not None:
+        fingerprint = write_fingerprint(conn)
+    else:
+        reset_ledger.mark_dirty(db_path, "test case")
     global_env = {
         "perform_query_on_sqlite_databases": perform_query_on_sqlite_databases,
         "execute_queries": execute_queries,
@@ -81,6 +93,7 @@ def run_test_case(
         test_passed = False
 
     except Exception as e:
+        read_only.check_error(e, "test case")
         logger.error(f"Test case failed due to error: {e}")
         error_message = f"Test case failed due to error: {e}\n"
         test_passed = False
@@ -88,6 +101,9 @@ def run_test_case(
     finally:
         sys.stdout = old_stdout
 
+    if fingerprint is not None and write_fingerprint(conn) != fingerprint:
+        reset_ledger.mark_dirty(db_path, "read-only run wrote in a test case")
+
     captured_output = mystdout.getvalue()
     if captured_output.strip():
         logger.info(f"Captured output from test_code:\n{captured_output}")
@@ -166,7 +182,11 @@ def run_evaluation_phase(
         )
 
         if failed_tests:
-            instance_assertion_error = True
+            if deadline.expired():
+                # Test queries were cancelled when the instance ran out of time
+                instance_timeout_error = True
+            else:
+                instance_assertion_error = True
         if test_case_error_message:
             error_message += f"\nTest case errors: {test_case_error_message}\n"
 
@@ -247,36 +267,36 @@ def evaluate_instance(data, args, logger):
         db_path = f"./sqlite_databases_test/{db_name}/{db_name}.sqlite"
         logger.info(f"Using main database: {db_path}")
 
-    # Get connection with retry
-    db_connection = None
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            db_connection = get_connection_for_phase(db_path, logger)
-            if db_connection:
-                break
-        except Exception as e:
-            logger.error(f"Failed to get connection on attempt {attempt+1}: {e}")
-            if attempt == max_retries - 1:
-                return {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": f"Failed to get database connection after {max_retries} attempts",
-                    "total_test_cases": total_test_cases,
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                    "evaluation_phase_execution_error": True,
-                    "evaluation_phase_timeout_error": False,
-                    "evaluation_phase_assertion_error": False,
-                }
-            time.sleep(1)  # Reduced wait time
+    # Get connection, retrying with backoff until the database opens
+    db_connection = wait_until(
+        lambda: get_connection_for_phase(db_path, logger),
+        CONNECT_TIMEOUT_SECONDS,
+        logger,
+        what=f"a connection to {db_path}",
+    )
+    if not db_connection:
+        return {
+            "instance_id": instance_id,
+            "status": "failed",
+            "error_message": f"Failed to get database connection within {CONNECT_TIMEOUT_SECONDS}s",
+            "total_test_cases": total_test_cases,
+            "passed_test_cases": 0,
+            "failed_test_cases": [],
+            "evaluation_phase_execution_error": True,
+            "evaluation_phase_timeout_error": False,
+            "evaluation_phase_assertion_error": False,
+        }
 
     try:
         logger.info("=== Starting Evaluation Phase ===")
 
         # Initial database reset
         logger.info("Initial database reset")
-        reset_and_restore_database(db_path, db_name, logger)
+        reset_ledger.reset(
+            db_path,
+            lambda: reset_and_restore_database(db_path, db_name, logger),
+            logger,
+        )
 
         # ==== PHASE 1: Test issue_sql (Problem Demonstration) ====
         # Test issue_sql (expected to FAIL)
@@ -320,7 +340,11 @@ def evaluate_instance(data, args, logger):
 
         # Reset database after issue_sql test
         logger.info("Resetting database after issue_sql test")
-        reset_and_restore_database(db_path, db_name, logger)
+        reset_ledger.reset(
+            db_path,
+            lambda: reset_and_restore_database(db_path, db_name, logger),
+            logger,
+        )
 
         # Reconnect after reset
         db_connection = get_connection_for_phase(db_path, logger)
@@ -414,7 +438,11 @@ def evaluate_instance(data, args, logger):
         # Reset database only if using ephemeral
         if ephemeral_db_path and os.path.exists(ephemeral_db_path):
             try:
-                reset_and_restore_database(db_path, "123123", logger)
+                reset_ledger.reset(
+                    db_path,
+                    lambda: reset_and_restore_database(db_path, "123123", logger),
+                    logger,
+                )
             except Exception as e:
                 logger.error(f"Error during database reset: {e}")
 
@@ -445,8 +473,32 @@ def main():
         help="Enable or disable logging ('true' or 'false').",
     )
     parser.add_argument("--log_file", type=str, help="Specific path for the log file.")
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="Absolute deadline (epoch seconds) for this instance's queries; running queries are cancelled when it passes.",
+    )
+
+    parser.add_argument(
+        "--db_state",
+        choices=reset_ledger.STATES,
+        default=reset_ledger.UNKNOWN,
+        help="State of the database as known to the wrapper; resets of a "
+        "clean database are skipped.",
+    )
+    parser.add_argument(
+        "--read_only",
+        choices=["auto", "off", "lane"],
+        default="auto",
+        help="auto: check that instances whose SQL is all read-only did not "
+        "write, so no reset is needed after them. lane: EPHEMERAL_DB_PATH is "
+        "shared by the read-only lane and opened read-only; a write attempt "
+        "is reported instead of re-run.",
+    )
 
     args = parser.parse_args()
+    deadline.set_deadline(args.deadline)
 
     try:
         # Load the data (expecting only one instance)
@@ -456,6 +508,10 @@ def main():
             sys.exit(1)
 
         data = data_list[0]  # Get the single instance
+        if os.environ.get("EPHEMERAL_DB_PATH"):
+            reset_ledger.set_state(
+                os.environ["EPHEMERAL_DB_PATH"], args.db_state, "wrapper"
+            )
         instance_id = data.get("instance_id", 0)
 
         # Configure logger
@@ -475,9 +531,22 @@ def main():
         logger.info(f"Starting evaluation for instance {instance_id}")
 
         # Evaluate the instance
-        evaluation_result = evaluate_instance(data, args, logger)
+        if args.read_only == "lane" and os.environ.get("EPHEMERAL_DB_PATH"):
+            share_read_only(os.environ["EPHEMERAL_DB_PATH"])
+        if args.read_only != "off":
+            evaluation_result = read_only.evaluate(
+                data,
+                args.mode,
+                lambda: evaluate_instance(data, args, logger),
+                logger,
+                lane=args.read_only == "lane",
+                dialect="sqlite",
+            )
+        else:
+            evaluation_result = evaluate_instance(data, args, logger)
 
-        # Write the output
+        # Write the output, with the state the database was left in
+        evaluation_result["reset_ledger"] = reset_ledger.report()
         with open(args.output_file, "w") as f:
             json.dump(evaluation_result, f)
 
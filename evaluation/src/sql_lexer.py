@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Comment- and string-literal-aware SQL lexer and statement classifier.
+
+The utils used to decide whether to commit, fetch or roll back by substring
+matching on keyword lists ("set" matched inside "offset", "do" inside
+"order", a keyword inside a string literal or a comment counted too). Here a
+query is tokenized per dialect, split into statements at top-level
+semicolons, and each statement is classified by its first keyword:
+
+    read         select, with, show, explain, describe, values, ...
+    write        insert, update, delete, merge, call, exec, do, PL/SQL or
+                 T-SQL blocks, ...
+    ddl          create, drop, alter, truncate, rename, grant, ...
+    transaction  begin / start transaction, commit, rollback, savepoint
+    session      set, use, pragma assignments, ...
+
+A statement is escalated to write (or ddl) if a DML (or DDL) keyword appears
+anywhere in it, which catches data-modifying CTEs, SELECT ... INTO and T-SQL
+batches without semicolons. Classifications are memoized on the SQL text,
+since test cases run the same statements over and over.
+"""
+
+import functools
+import re
+from collections import namedtuple
+
+READ = "read"
+WRITE = "write"
+DDL = "ddl"
+TRANSACTION = "transaction"
+SESSION = "session"
+
+DIALECTS = ("generic", "postgresql", "mysql", "sqlite", "oracle", "sqlserver")
+
+READ_KEYWORDS = {
+    "select",
+    "with",
+    "show",
+    "explain",
+    "describe",
+    "desc",
+    "values",
+    "table",
+}
+WRITE_KEYWORDS = {
+    "insert",
+    "update",
+    "delete",
+    "merge",
+    "replace",
+    "upsert",
+    "copy",
+    "load",
+    "import",
+    "call",
+    "exec",
+    "execute",
+    "do",
+    "handler",
+}
+DDL_KEYWORDS = {
+    "create",
+    "drop",
+    "alter",
+    "truncate",
+    "rename",
+    "grant",
+    "revoke",
+    "comment",
+    "analyze",
+    "vacuum",
+    "reindex",
+    "cluster",
+    "refresh",
+    "optimize",
+    "repair",
+    "backup",
+    "restore",
+    "dbcc",
+    "purge",
+    "flashback",
+    "audit",
+}
+TRANSACTION_KEYWORDS = {
+    "begin",
+    "start",
+    "commit",
+    "rollback",
+    "savepoint",
+    "release",
+    "end",
+    "abort",
+}
+SESSION_KEYWORDS = {
+    "set",
+    "use",
+    "reset",
+    "discard",
+    "prepare",
+    "deallocate",
+    "declare",
+    "lock",
+    "unlock",
+    "listen",
+    "unlisten",
+    "pragma",
+}
+# Keywords that make any statement a write / a DDL statement wherever they
+# appear ("into": SELECT ... INTO creates a table or assigns variables)
+ESCALATE_TO_WRITE = {"insert", "update", "delete", "merge", "into"}
+ESCALATE_TO_DDL = {"create", "drop", "alter", "truncate"}
+# Statements that return rows even though they write
+RETURNING_KEYWORDS = {"returning", "output"}
+
+# Token patterns shared by every dialect, then dialect-specific extras
+_COMMON_PATTERNS = [
+    ("comment", r"--[^\n]*|/\*.*?(?:\*/|\Z)"),
+    ("string", r"'(?:[^']|'')*(?:'|\Z)"),
+    ("ident", r"\"(?:[^\"]|\"\")*(?:\"|\Z)|`(?:[^`]|``)*(?:`|\Z)"),
+]
+_DIALECT_PATTERNS = {
+    "generic": [("string", r"\$(?P<tag>[A-Za-z_]*)\$.*?(?:\$(?P=tag)\$|\Z)")],
+    "postgresql": [("string", r"\$(?P<tag>[A-Za-z_]*)\$.*?(?:\$(?P=tag)\$|\Z)")],
+    # MySQL strings take backslash escapes, and # starts a comment
+    "mysql": [
+        ("comment", r"\#[^\n]*"),
+        ("string", r"'(?:[^'\\]|\\.|'')*(?:'|\Z)"),
+    ],
+    "sqlite": [("ident", r"\[[^\]]*(?:\]|\Z)")],
+    # Alternative quoting: q'[...]', q'{...}', q'!...!', ...
+    "oracle": [
+        (
+            "string",
+            r"[qQ]'(?:\[.*?\]|\(.*?\)|\{.*?\}|<.*?>|(?P<open>\S).*?(?P=open))'",
+        )
+    ],
+    "sqlserver": [("ident", r"\[[^\]]*(?:\]|\Z)")],
+}
+_TAIL_PATTERNS = [
+    ("var", r"[@:][A-Za-z0-9_@$#]+"),
+    ("word", r"[A-Za-z_][A-Za-z0-9_$#]*"),
+    ("semicolon", r";"),
+    ("space", r"\s+"),
+    ("other", r"."),
+]
+
+Token = namedtuple("Token", "kind text")
+StatementInfo = namedtuple("StatementInfo", "keyword kind returns_rows words")
+QueryInfo = namedtuple(
+    "QueryInfo", "statements keyword read_only needs_commit returns_rows words"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _token_regex(dialect):
+    # Dialect patterns go first: they refine the common ones (MySQL strings)
+    patterns = _DIALECT_PATTERNS.get(dialect, []) + _COMMON_PATTERNS + _TAIL_PATTERNS
+    parts = []
+    for i, (kind, pattern) in enumerate(patterns):
+        # Named groups inside patterns must be unique across the alternation
+        pattern = pattern.replace("?P<tag>", f"?P<tag{i}>").replace(
+            "(?P=tag)", f"(?P=tag{i})"
+        )
+        pattern = pattern.replace("?P<open>", f"?P<open{i}>").replace(
+            "(?P=open)", f"(?P=open{i})"
+        )
+        parts.append(f"(?P<{kind}_{i}>{pattern})")
+    return re.compile("|".join(parts), re.S)
+
+
+def tokenize(sql, dialect="generic"):
+    """Yield the Tokens of sql; comments and whitespace are dropped."""
+    for match in _token_regex(dialect).finditer(sql):
+        kind = match.lastgroup.rsplit("_", 1)[0]
+        if kind in ("comment", "space"):
+            continue
+        text = match.group(match.lastgroup)
+        yield Token(kind, text.lower() if kind == "word" else text)
+
+
+def split_statements(sql, dialect="generic"):
+    """Return the statements of sql as lists of Tokens (empty ones dropped)."""
+    statements = [[]]
+    for token in tokenize(sql, dialect):
+        if token.kind == "semicolon":
+            statements.append([])
+        else:
+            statements[-1].append(token)
+    return [tokens for tokens in statements if tokens]
+
+
+def _classify_statement(tokens, dialect):
+    words = [t.text for t in tokens if t.kind == "word"]
+    word_set = frozenset(words)
+    keyword = words[0] if words else ""
+    second = words[1] if len(words) > 1 else ""
+
+    if keyword in READ_KEYWORDS:
+        kind = READ
+    elif keyword in WRITE_KEYWORDS:
+        kind = WRITE
+    elif keyword in DDL_KEYWORDS:
+        kind = DDL
+    elif keyword == "begin":
+        # BEGIN opens a PL/SQL block on Oracle and a T-SQL block on SQL
+        # Server (unless it is BEGIN TRAN[SACTION]); elsewhere a transaction
+        if dialect == "oracle":
+            kind = WRITE
+        elif dialect == "sqlserver" and second not in (
+            "tran",
+            "transaction",
+            "distributed",
+        ):
+            kind = WRITE
+        else:
+            kind = TRANSACTION
+    elif keyword == "declare":
+        # A PL/SQL block on Oracle; a variable or cursor elsewhere
+        kind = WRITE if dialect == "oracle" else SESSION
+    elif keyword == "end" and dialect in ("oracle", "sqlserver"):
+        kind = WRITE
+    elif keyword in TRANSACTION_KEYWORDS:
+        kind = TRANSACTION
+    elif keyword in SESSION_KEYWORDS:
+        kind = SESSION
+        if keyword == "pragma" and not any(t.text == "=" for t in tokens):
+            # PRAGMA table_info(t) and friends only report
+            kind = READ
+    else:
+        # Unknown statements are assumed to write
+        kind = WRITE
+
+    # SHOW CREATE TABLE, DESCRIBE and plain EXPLAIN never run what they name
+    escalate = keyword not in ("show", "describe", "desc") and (
+        keyword != "explain" or "analyze" in word_set
+    )
+    if escalate and ESCALATE_TO_DDL & word_set and kind in (READ, WRITE, SESSION):
+        kind = DDL
+    elif escalate and ESCALATE_TO_WRITE & word_set and kind in (READ, SESSION):
+        kind = WRITE
+
+    returns_rows = (
+        keyword in READ_KEYWORDS or (keyword == "pragma" and kind == READ)
+    ) and "into" not in word_set
+    if kind == WRITE and RETURNING_KEYWORDS & word_set:
+        returns_rows = True
+    return StatementInfo(keyword, kind, returns_rows, word_set)
+
+
+@functools.lru_cache(maxsize=8192)
+def classify(sql, dialect="generic"):
+    """
+    Classify the query sql (one or more statements) as QueryInfo:
+
+        statements    StatementInfo per statement
+        keyword       first keyword of the first statement
+        read_only     every statement only reads
+        needs_commit  some statement writes or changes the schema
+        returns_rows  the last statement returns a result set
+        words         every keyword/identifier outside literals and comments
+    """
+    statements = tuple(
+        _classify_statement(tokens, dialect)
+        for tokens in split_statements(sql, dialect)
+    )
+    words = frozenset().union(*(s.words for s in statements))
+    return QueryInfo(
+        statements=statements,
+        keyword=statements[0].keyword if statements else "",
+        read_only=all(s.kind == READ for s in statements),
+        needs_commit=any(s.kind in (WRITE, DDL) for s in statements),
+        returns_rows=bool(statements) and statements[-1].returns_rows,
+        words=words,
+    )
+
+
+def is_read_only(sql, dialect="generic"):
+    return classify(sql, dialect).read_only
+
+
+def needs_commit(sql, dialect="generic"):
+    return classify(sql, dialect).needs_commit
+
+
+def returns_rows(sql, dialect="generic"):
+    return classify(sql, dialect).returns_rows
@@ -9,8 +9,42 @@ import time
 
 try:
     from .logger import log_section_header, log_section_footer, PrintLogger, NullLogger
+    from . import deadline
+    from . import read_only
+    from . import reset_ledger
+    from . import sql_lexer
 except ImportError:
     from logger import log_section_header, log_section_footer, PrintLogger, NullLogger
+    import deadline
+    import read_only
+    import reset_ledger
+    import sql_lexer
+
+# Optional VM-step budget per statement (None: limited by time only)
+MAX_VM_STEPS = None
+
+# Databases shared by the read-only lane: opened mode=ro&immutable=1, so
+# nothing can write them and SQLite skips locking and change detection
+READ_ONLY_PATHS = set()
+
+
+def share_read_only(db_path):
+    """Open db_path read-only and immutable from now on."""
+    READ_ONLY_PATHS.add(db_path)
+
+
+def _interrupt(conn):
+    """Abort the statement running on conn."""
+    conn.interrupt()
+
+
+def write_fingerprint(conn):
+    """
+    (rows changed on conn, schema version): differs between two calls if
+    anything was written through conn in between.
+    """
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    return conn.total_changes, schema_version
 
 
 def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=30):
@@ -24,8 +58,7 @@ def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=3
     MAX_ROWS = 10000
     need_to_close = False
 
-    # Check query complexity, skip complex queries directly
-    lower_q = query.strip().lower()
+    info = sql_lexer.classify(query, "sqlite")
     if conn is None:
         # CRITICAL: Check file exists before connecting!
         # sqlite3.connect() will CREATE an empty database if file doesn't exist!
@@ -33,21 +66,36 @@ def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=3
             raise FileNotFoundError(f"Database not found: {db_path}")
 
         # Use URI mode to prevent accidental database creation
-        conn = sqlite3.connect(f"file:{db_path}?mode=rw", uri=True, timeout=query_timeout)
+        if db_path in READ_ONLY_PATHS:
+            conn = sqlite3.connect(
+                f"file:{db_path}?mode=ro&immutable=1", uri=True, timeout=query_timeout
+            )
+        else:
+            conn = sqlite3.connect(f"file:{db_path}?mode=rw", uri=True, timeout=query_timeout)
         conn.execute(f"PRAGMA busy_timeout = {query_timeout * 1000}")  # Set busy wait timeout to query_timeout seconds
         need_to_close = True
+    deadline.watch(conn, _interrupt)
 
-    conn.execute("PRAGMA journal_mode = WAL")
-    conn.execute("PRAGMA synchronous = OFF")
+    if db_path not in READ_ONLY_PATHS:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
     
     cursor = conn.cursor()
+    # Read-only instance: check that the statement really did not write
+    fingerprint = write_fingerprint(conn) if read_only.active() else None
 
     try:
         
         start_time = time.time()
+        # Abort the statement after query_timeout seconds, MAX_VM_STEPS steps
+        # or at the instance deadline, whichever comes first
+        conn.set_progress_handler(
+            deadline.sqlite_progress_handler(MAX_VM_STEPS, deadline.cap(query_timeout)),
+            deadline.SQLITE_PROGRESS_INTERVAL,
+        )
         cursor.execute(query)
         
-        if lower_q.startswith(('select', 'with')):
+        if info.returns_rows and not info.needs_commit:
             result = cursor.fetchall()
             if result and len(result) > MAX_ROWS:
                 result = result[:MAX_ROWS]
@@ -64,13 +112,22 @@ def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=3
     except sqlite3.OperationalError as e:
         # print(f"[ERROR] SQLite OperationalError: {e}")
         conn.rollback()
+        read_only.check_error(e, query)
         raise e
     except Exception as e:
         # print(f"[ERROR] Query failed: {e}")
         conn.rollback()
+        read_only.check_error(e, query)
         raise e
     finally:
         cursor.close()
+        if fingerprint is not None:
+            try:
+                unchanged = write_fingerprint(conn) == fingerprint
+            except sqlite3.Error:
+                unchanged = False
+            if not unchanged:
+                reset_ledger.mark_dirty(db_path, f"read-only run wrote: {query[:80]}")
         if need_to_close:
             pass
 
@@ -84,6 +141,8 @@ def execute_queries(
     if logger is None:
         logger = NullLogger()
 
+    if not all(sql_lexer.is_read_only(query, "sqlite") for query in queries):
+        reset_ledger.mark_dirty(db_path, section_title or "queries")
     log_section_header(section_title, logger)
     query_result = None
     execution_error = False
@@ -95,6 +154,7 @@ def execute_queries(
 
     for i, query in enumerate(queries):
         try:
+            deadline.check()
             logger.info(f"Executing query {i+1}/{len(queries)}: {query[:100]}... on {db_path}")
             
             query_result, conn = perform_query_on_sqlite_databases(
@@ -103,7 +163,7 @@ def execute_queries(
 
         except sqlite3.OperationalError as e:
             error_str = str(e).lower()
-            if "database is locked" in error_str or "timeout" in error_str or "complex query skipped" in error_str:
+            if "database is locked" in error_str or "timeout" in error_str or "complex query skipped" in error_str or "interrupted" in error_str:
                 logger.error(f"Timeout/Skip error executing query {i+1}: {e}")
                 error_message += f"Timeout/Skip error executing query {i+1}: {e}\n"
                 timeout_error = True
@@ -113,6 +173,12 @@ def execute_queries(
                 execution_error = True
             break
 
+        except deadline.DeadlineExceeded as e:
+            logger.error(f"Timeout before query {i+1}: {e}")
+            error_message += f"Timeout before query {i+1}: {e}\n"
+            timeout_error = True
+            break
+
         except sqlite3.Error as e:
             logger.error(f"SQLite Error executing query {i+1}: {e}")
             error_message += f"SQLite Error executing query {i+1}: {e}\n"
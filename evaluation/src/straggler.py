@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Speculative re-execution of straggler instances.
+
+Near the end of a run most workers are idle while one or two instances sit
+in a lock wait or on a cold cache. Once the work queue is drained, an idle
+worker looks for an instance that has run far beyond its expected duration
+and launches a second attempt on a spare clone of its database. Whichever
+attempt finishes first wins; the other evaluator process is killed and the
+database it was using is reset by the thread that ran it.
+
+Expected durations come from the durations recorded by earlier runs of the
+same file, falling back to the median of the instance's category in this
+run (and then to the median of everything finished so far).
+"""
+
+import json
+import os
+import statistics
+import threading
+import time
+
+
+class DurationModel:
+    """Expected per-instance durations, from history and this run's medians."""
+
+    def __init__(self, history_path=None):
+        self.history_path = history_path
+        self.history = {}
+        if history_path and os.path.exists(history_path):
+            try:
+                with open(history_path, "r") as f:
+                    self.history = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable duration history {history_path}: {e}")
+        self._by_category = {}
+        self._all = []
+        self._lock = threading.Lock()
+
+    def expected(self, instance_id, category):
+        """Expected duration in seconds, or None if nothing is known yet."""
+        with self._lock:
+            if str(instance_id) in self.history:
+                return self.history[str(instance_id)]
+            samples = self._by_category.get(category) or self._all
+            return statistics.median(samples) if samples else None
+
+    def record(self, instance_id, category, seconds):
+        with self._lock:
+            self.history[str(instance_id)] = round(seconds, 3)
+            self._by_category.setdefault(category, []).append(seconds)
+            self._all.append(seconds)
+
+    def save(self):
+        if not self.history_path:
+            return
+        with self._lock:
+            with open(self.history_path, "w") as f:
+                json.dump(self.history, f, indent=0, sort_keys=True)
+
+
+class InstanceRace:
+    """
+    The attempts at one instance. The first attempt to call finish() wins;
+    the evaluator processes of the other attempts are killed.
+    """
+
+    def __init__(self, instance_id, instance_data, expected):
+        self.instance_id = instance_id
+        self.instance_data = instance_data
+        self.expected = expected
+        self.started = time.time()
+        self.speculated = False
+        self.winner = None
+        self._procs = {}
+        self._lock = threading.Lock()
+
+    def register(self, attempt, proc):
+        """
+        Register the evaluator process of an attempt. Returns False if the
+        race is already decided, in which case the caller should kill it.
+        """
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self._procs[attempt] = proc
+            return True
+
+    def finish(self, attempt):
+        """Claim the win for attempt; returns True if it won."""
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self.winner = attempt
+            losers = [p for a, p in self._procs.items() if a != attempt]
+        for proc in losers:
+            if proc.poll() is None:
+                proc.kill()
+        return True
+
+    def lost(self, attempt):
+        with self._lock:
+            return self.winner is not None and self.winner != attempt
+
+
+class StragglerTracker:
+    """Running instances, and the choice of which one to speculate on."""
+
+    def __init__(self, durations, slowdown=2.0, min_seconds=30.0):
+        """
+        Args:
+            durations: DurationModel used for expected durations.
+            slowdown: An instance is a straggler once it has run slowdown
+                times its expected duration (0 disables speculation).
+            min_seconds: ... and at least this many seconds.
+        """
+        self.durations = durations
+        self.slowdown = slowdown
+        self.min_seconds = min_seconds
+        self.speculated = 0
+        self.backup_wins = 0
+        self._running = {}
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.slowdown > 0
+
+    def start(self, instance_id, instance_data):
+        category = instance_data.get("category", "Personalization")
+        race = InstanceRace(
+            instance_id, instance_data, self.durations.expected(instance_id, category)
+        )
+        with self._cond:
+            self._running[instance_id] = race
+        return race
+
+    def done(self, race):
+        """Called once the race's primary attempt has returned."""
+        if race.winner == "primary":
+            category = race.instance_data.get("category", "Personalization")
+            self.durations.record(
+                race.instance_id, category, time.time() - race.started
+            )
+        with self._cond:
+            self._running.pop(race.instance_id, None)
+            self._cond.notify_all()
+
+    def _threshold(self, race):
+        if race.expected is None:
+            return None
+        return max(self.slowdown * race.expected, self.min_seconds)
+
+    def claim_straggler(self):
+        """
+        Return the most overdue running instance that has no backup attempt
+        yet and mark it as speculated, or None if there is none right now.
+        """
+        now = time.time()
+        with self._cond:
+            best, best_ratio = None, 1.0
+            for race in self._running.values():
+                threshold = self._threshold(race)
+                if race.speculated or race.winner is not None or threshold is None:
+                    continue
+                ratio = (now - race.started) / threshold
+                if ratio >= best_ratio:
+                    best, best_ratio = race, ratio
+            if best is not None:
+                best.speculated = True
+                self.speculated += 1
+            return best
+
+    def wait(self, timeout):
+        """
+        Wait until an instance finishes or timeout passes. Returns False once
+        nothing is running any more.
+        """
+        with self._cond:
+            if not self._running:
+                return False
+            self._cond.wait(timeout)
+            return bool(self._running)
+
+    def record_backup_win(self):
+        with self._cond:
+            self.backup_wins += 1
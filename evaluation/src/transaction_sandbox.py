@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Transaction sandbox: run a MySQL instance that only reads and writes rows in
+one InnoDB transaction and roll it back, instead of re-cloning its database.
+
+An instance runs in the sandbox when no SQL statement it lists
+(preprocess_sql, issue_sql, sol_sql, pred_sqls, clean_up_sql) commits
+implicitly, as classified by sql_lexer:
+
+    DDL                  create, drop, alter, truncate, rename, analyze, ...
+    transaction control  begin / start transaction, commit, rollback, ...
+    other                LOCK / UNLOCK TABLES, SET autocommit,
+                         SET TRANSACTION, CALL (a procedure may commit),
+                         FLUSH, ...
+
+and every table of its database is transactional (the evaluator checks the
+engines). Otherwise the database is reset by cloning it, and the reason is
+logged.
+
+In the sandbox every statement of the instance runs on one connection,
+wrapped in SandboxConnection: commit() only sets a savepoint and rollback()
+returns to it, so the instance sees the same commit/rollback behaviour as
+outside the sandbox. Test cases are Python code and are checked at run time:
+a statement that commits implicitly (or switching autocommit on) breaks the
+sandbox. The statement still runs normally, and the database falls back to
+the clone reset. Otherwise the transaction is rolled back at the end, and
+the database (and its reset-ledger state) is back to what it was before the
+instance.
+
+InnoDB does not roll back AUTO_INCREMENT counters, so the sandbox records
+them before the transaction and, after the rollback, sets the ones that
+moved back with ALTER TABLE ... AUTO_INCREMENT. If that fails the database
+stays dirty and is cloned.
+"""
+
+import threading
+
+import reset_ledger
+import sql_lexer
+
+SAVEPOINT = "bird_sandbox_commit"
+
+# Statements that commit the current transaction implicitly on MySQL, besides
+# DDL and transaction control
+IMPLICIT_COMMIT_KEYWORDS = {
+    "lock",
+    "unlock",
+    "call",
+    "flush",
+    "cache",
+    "check",
+    "checksum",
+    "install",
+    "uninstall",
+    "reset",
+}
+SQL_FIELDS = ("preprocess_sql", "issue_sql", "sol_sql", "clean_up_sql")
+
+
+def implicit_commit_reason(sql, dialect="mysql"):
+    """Why sql cannot run in the sandbox (it commits implicitly), or None."""
+    for statement in sql_lexer.classify(sql, dialect).statements:
+        keyword = statement.keyword.upper()
+        if statement.kind == sql_lexer.DDL:
+            return f"DDL statement ({keyword})"
+        if statement.kind == sql_lexer.TRANSACTION:
+            return f"transaction control ({keyword})"
+        if statement.keyword in IMPLICIT_COMMIT_KEYWORDS:
+            return f"{keyword} statement"
+        if statement.keyword == "set":
+            for word in ("autocommit", "transaction"):
+                if word in statement.words:
+                    return f"SET {word.upper()} statement"
+    return None
+
+
+def instance_reason(data, mode="gold"):
+    """Why the instance cannot run in the sandbox, or None if it can."""
+    fields = SQL_FIELDS + (("pred_sqls",) if mode == "pred" else ())
+    for field in fields:
+        value = data.get(field) or []
+        if isinstance(value, str):
+            value = [value]
+        for sql in value:
+            reason = isinstance(sql, str) and implicit_commit_reason(sql)
+            if reason:
+                return f"{reason} in {field}"
+    return None
+
+
+class SandboxConnection:
+    """
+    A connection whose commit() only sets a savepoint and whose rollback()
+    returns to it, so nothing the instance does is committed. Everything
+    else is passed on to the wrapped connection.
+    """
+
+    def __init__(self, conn):
+        self.raw = conn
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def _execute(self, sql):
+        with self.raw.cursor() as cursor:
+            cursor.execute(sql)
+
+    def commit(self):
+        self._execute(f"SAVEPOINT {SAVEPOINT}")
+
+    def rollback(self):
+        try:
+            self._execute(f"ROLLBACK TO SAVEPOINT {SAVEPOINT}")
+        except Exception as e:
+            # The server rolled the whole transaction back (a deadlock)
+            note_break(f"transaction rolled back by the server: {e}")
+            self.raw.rollback()
+
+    def begin(self):
+        note_break("the instance started a transaction")
+        return self.raw.begin()
+
+    def autocommit(self, value):
+        if value:
+            note_break("the instance switched autocommit on")
+        return self.raw.autocommit(value)
+
+
+_lock = threading.Lock()
+_connection = None
+_db_name = None
+_state_before = None
+_broken = None
+_auto_increments = None
+
+
+def auto_increments(conn, db_name):
+    """The next AUTO_INCREMENT value of each table of db_name that has one."""
+    with conn.cursor() as cursor:
+        try:
+            # MySQL 8 caches these statistics for a day by default
+            cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+        except Exception:
+            pass
+        cursor.execute(
+            "SELECT TABLE_NAME, AUTO_INCREMENT FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE' "
+            "AND AUTO_INCREMENT IS NOT NULL",
+            (db_name,),
+        )
+        return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+
+def restore_auto_increments(conn, db_name, before, logger):
+    """Set the AUTO_INCREMENT counters of db_name that moved back to before."""
+    after = auto_increments(conn, db_name)
+    with conn.cursor() as cursor:
+        for table, value in sorted(before.items()):
+            if after.get(table, value) != value:
+                name = ".".join(
+                    "`" + part.replace("`", "``") + "`" for part in (db_name, table)
+                )
+                cursor.execute(f"ALTER TABLE {name} AUTO_INCREMENT = {value}")
+                logger.info(
+                    f"Restored AUTO_INCREMENT of {table}: {after[table]} -> {value}"
+                )
+
+
+def begin(conn, db_name):
+    """
+    Start the sandbox transaction on conn (the connection of db_name) and
+    return the SandboxConnection to run the instance on.
+    """
+    global _connection, _db_name, _state_before, _broken, _auto_increments
+    counters = auto_increments(conn, db_name)
+    conn.begin()
+    sandbox = SandboxConnection(conn)
+    sandbox.commit()
+    with _lock:
+        _connection = sandbox
+        _db_name = db_name
+        _state_before = (reset_ledger.state(db_name), reset_ledger.reason(db_name))
+        _broken = None
+        _auto_increments = counters
+    return sandbox
+
+
+def active():
+    return _connection is not None
+
+
+def connection():
+    """The SandboxConnection of the running sandbox, or None."""
+    return _connection
+
+
+def note_break(what):
+    """Record that the sandbox transaction was committed (first cause wins)."""
+    global _broken
+    with _lock:
+        if _connection is not None and _broken is None:
+            _broken = str(what)[:200]
+
+
+def check_statement(sql, dialect="mysql"):
+    """Record sql as breaking the sandbox if it commits implicitly."""
+    if _connection is not None:
+        reason = implicit_commit_reason(sql, dialect)
+        if reason:
+            note_break(f"{reason}: {sql}")
+
+
+def broken():
+    """What committed the sandbox transaction, or None."""
+    return _broken
+
+
+def finish(logger):
+    """
+    Roll the sandbox transaction back and end the sandbox. Returns True if
+    the database is back to its state before begin(); otherwise its ledger
+    state stays dirty and the clone reset runs.
+    """
+    global _connection
+    if _connection is None:
+        return False
+    conn = _connection.raw
+    try:
+        conn.rollback()
+    except Exception as e:
+        note_break(f"rollback failed: {e}")
+    if _broken is None:
+        try:
+            restore_auto_increments(conn, _db_name, _auto_increments, logger)
+        except Exception as e:
+            note_break(f"restoring AUTO_INCREMENT counters failed: {e}")
+    with _lock:
+        _connection = None
+    if _broken is not None:
+        logger.info(f"Transaction sandbox broken ({_broken}); using the clone reset")
+        reset_ledger.mark_dirty(_db_name, f"transaction sandbox broken: {_broken}")
+        return False
+
+    state, reason = _state_before
+    if state == reset_ledger.CLEAN:
+        reason = "transaction sandbox rolled back"
+    reset_ledger.set_state(_db_name, state, reason)
+    logger.info(f"Rolled back the transaction sandbox; {_db_name} is {state} again")
+    return True
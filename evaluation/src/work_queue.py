@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared work queue for running one evaluation across several machines.
+
+The queue is a single SQLite file on a volume every node can reach (for
+example NFS). There is no broker: wrapper processes on any node claim
+instances from the file, hold them under a time-limited lease that a
+background heartbeat keeps renewing, and write each result back when it is
+finished. If a node dies its heartbeats stop, the lease expires and another
+node re-claims the instance. Once the queue is drained one node merges the
+results and writes the usual _report.txt and _output_with_status.jsonl.
+
+Every node evaluates against its own database containers; only the queue
+file is shared. Lease expiry compares wall clocks, so node clocks should be
+kept in sync (NTP).
+
+Usage:
+    python wrapper_evaluation_postgresql.py --jsonl_file X --queue_db /nfs/run.sqlite
+    python work_queue.py --queue_db /nfs/run.sqlite      # show progress
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    seq INTEGER PRIMARY KEY,
+    instance_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_instances_state ON instances (state, seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_node_id():
+    """Identify this wrapper process as <hostname>:<pid>."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedWorkQueue:
+    """
+    SQLite-backed work queue with leases, heartbeats and lease expiry.
+
+    get() and task_done() mirror queue.Queue so the object can be handed to
+    the wrappers' worker loops in place of a local queue. get() returns
+    (seq, instance_data), where seq is the instance's position in the
+    original input, and raises queue.Empty once no work is left anywhere.
+    """
+
+    def __init__(
+        self,
+        path,
+        node_id=None,
+        lease_seconds=900,
+        max_attempts=3,
+        poll_interval=5.0,
+        execution_error_key="evaluation_phase_execution_error",
+    ):
+        self.path = path
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.execution_error_key = execution_error_key
+
+        self._heartbeat_thread = None
+        self._stop_event = threading.Event()
+        self._done_count_cache = (0.0, 0)
+
+        conn = sqlite3.connect(self.path, timeout=120)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Open a short-lived connection and hold the write lock for the block.
+        WAL is not used because it needs shared memory, which network
+        filesystems do not provide.
+        """
+        conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+    def enqueue(self, data_list, source=None):
+        """
+        Add instances to the queue. Safe to call from every node: instances
+        that are already queued (same position) are left untouched.
+        Returns the number of newly added instances.
+        """
+        rows = [
+            (seq, data.get("instance_id", f"instance_{seq}"), json.dumps(data))
+            for seq, data in enumerate(data_list)
+        ]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO instances (seq, instance_id, payload) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            added = conn.total_changes - before
+            if source is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES ('source', ?)",
+                    (source,),
+                )
+        return added
+
+    def load_instances(self):
+        """Return every queued instance in its original order."""
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT payload FROM instances ORDER BY seq").fetchall()
+        return [json.loads(payload) for (payload,) in rows]
+
+    # ------------------------------------------------------------------
+    # Claiming work
+    # ------------------------------------------------------------------
+    def _lost_result(self, instance_id, payload, attempts):
+        data = json.loads(payload)
+        return {
+            "instance_id": instance_id,
+            "status": "failed",
+            "error_message": f"Lease expired {attempts} times (evaluating node lost)",
+            "total_test_cases": len(data.get("test_cases", [])),
+            "passed_test_cases": 0,
+            "failed_test_cases": [],
+            self.execution_error_key: True,
+        }
+
+    def claim(self):
+        """
+        Lease the next pending instance, or one whose lease has expired.
+        Returns (seq, instance_data) or None when nothing can be claimed now.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT seq, instance_id, payload, state, attempts FROM instances "
+                    "WHERE state = 'pending' "
+                    "OR (state = 'leased' AND lease_expires < ?) "
+                    "ORDER BY seq LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+
+                seq, instance_id, payload, state, attempts = row
+                if state == "leased" and attempts >= self.max_attempts:
+                    # Give up on instances that keep taking their node down
+                    result = self._lost_result(instance_id, payload, attempts)
+                    conn.execute(
+                        "UPDATE instances SET state = 'done', result = ?, "
+                        "owner = NULL, lease_expires = NULL WHERE seq = ?",
+                        (json.dumps(result), seq),
+                    )
+                    continue
+
+                conn.execute(
+                    "UPDATE instances SET state = 'leased', owner = ?, "
+                    "lease_expires = ?, attempts = attempts + 1 WHERE seq = ?",
+                    (self.node_id, now + self.lease_seconds, seq),
+                )
+                break
+
+        self._start_heartbeat()
+        return seq, json.loads(payload)
+
+    def get(self, block=True, timeout=None):
+        """
+        queue.Queue-style get. Waits while other nodes still hold leases
+        (their work may come back if they die) and raises queue.Empty once
+        every instance is done.
+        """
+        while True:
+            item = self.claim()
+            if item is not None:
+                return item
+            if not block or self.is_drained():
+                raise queue.Empty
+            time.sleep(timeout or self.poll_interval)
+
+    def task_done(self):
+        """Completion is recorded by complete(); kept for queue.Queue parity."""
+
+    def join(self):
+        """Worker loops only exit once the queue is drained; nothing to wait for."""
+
+    def complete(self, seq, result):
+        """Store the result for an instance. The first completion wins."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE instances SET state = 'done', result = ?, owner = ?, "
+                "lease_expires = NULL WHERE seq = ? AND state != 'done'",
+                (json.dumps(result, default=str), self.node_id, seq),
+            )
+
+    def release_all(self):
+        """Hand this node's leased instances back so other nodes can take them."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE instances SET state = 'pending', owner = NULL, "
+                "lease_expires = NULL, attempts = MAX(attempts - 1, 0) "
+                "WHERE state = 'leased' AND owner = ?",
+                (self.node_id,),
+            )
+
+    # ------------------------------------------------------------------
+    # Heartbeats
+    # ------------------------------------------------------------------
+    def heartbeat(self):
+        """Extend the lease of every instance this node is holding."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE instances SET lease_expires = ? "
+                "WHERE state = 'leased' AND owner = ?",
+                (time.time() + self.lease_seconds, self.node_id),
+            )
+
+    def _heartbeat_loop(self):
+        interval = max(1.0, self.lease_seconds / 3)
+        while not self._stop_event.wait(interval):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                print(f"[WorkQueue] Heartbeat failed: {e}")
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is None:
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat_loop, daemon=True
+            )
+            self._heartbeat_thread.start()
+
+    def close(self):
+        """Stop the heartbeat thread."""
+        self._stop_event.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join(timeout=5)
+            self._heartbeat_thread = None
+
+    # ------------------------------------------------------------------
+    # Progress and merging
+    # ------------------------------------------------------------------
+    def counts(self):
+        """Return {state: count} across all nodes."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT state, COUNT(*) FROM instances GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+    def done_count(self, max_age=2.0):
+        """Number of finished instances, cached briefly for progress bars."""
+        checked_at, count = self._done_count_cache
+        if time.time() - checked_at >= max_age:
+            count = self.counts().get("done", 0)
+            self._done_count_cache = (time.time(), count)
+        return count
+
+    def is_drained(self):
+        counts = self.counts()
+        return counts.get("pending", 0) == 0 and counts.get("leased", 0) == 0
+
+    def claim_merge(self):
+        """
+        Elect the node that writes the final reports. Succeeds only when the
+        queue is drained and no other live node has claimed (or finished)
+        the merge.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            unfinished = conn.execute(
+                "SELECT COUNT(*) FROM instances WHERE state != 'done'"
+            ).fetchone()[0]
+            if unfinished:
+                return False
+            meta = dict(
+                conn.execute(
+                    "SELECT key, value FROM meta WHERE key LIKE 'merge_%'"
+                ).fetchall()
+            )
+            if meta.get("merge_done"):
+                return False
+            owner = meta.get("merge_owner")
+            started = float(meta.get("merge_started", 0))
+            if owner and owner != self.node_id and now - started < self.lease_seconds:
+                return False
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("merge_owner", self.node_id), ("merge_started", str(now))],
+            )
+        return True
+
+    def finish_merge(self):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('merge_done', ?)",
+                (str(time.time()),),
+            )
+
+    def results_by_instance_id(self):
+        """Return {instance_id: result} for every finished instance."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT instance_id, result FROM instances WHERE state = 'done'"
+            ).fetchall()
+        return {instance_id: json.loads(result) for instance_id, result in rows}
+
+    def leases(self):
+        """Return {owner: number of leased instances}."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT owner, COUNT(*) FROM instances "
+                "WHERE state = 'leased' GROUP BY owner"
+            ).fetchall()
+        return dict(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the progress of a shared evaluation work queue."
+    )
+    parser.add_argument("--queue_db", required=True, help="Path to the queue file.")
+    parser.add_argument(
+        "--release_node",
+        default=None,
+        help="Return the leases held by this node id to the queue.",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.queue_db):
+        print(f"Queue file not found: {args.queue_db}")
+        return
+
+    shared_queue = SharedWorkQueue(args.queue_db, node_id=args.release_node)
+    if args.release_node:
+        shared_queue.release_all()
+        print(f"Released leases held by {args.release_node}")
+
+    counts = shared_queue.counts()
+    total = sum(counts.values())
+    print(f"Total instances: {total}")
+    for state in ("pending", "leased", "done"):
+        print(f"  {state}: {counts.get(state, 0)}")
+    for owner, n in sorted(shared_queue.leases().items()):
+        print(f"  leased by {owner}: {n}")
+
+
+if __name__ == "__main__":
+    main()
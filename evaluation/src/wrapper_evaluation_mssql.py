@@ -17,14 +17,29 @@ import time
 import threading
 import signal
 import queue
+from collections import Counter
 from tqdm import tqdm
 from mssql_utils import (
+    DEFAULT_SQLSERVER_CONFIG,
+    RESET_STRATEGIES,
+    configure_reset_strategy,
     load_jsonl,
     generate_report_and_output,
     generate_category_report,
     reset_and_restore_database,
+    resetter,
+    create_ephemeral_db_copy,
+    drop_ephemeral_dbs,
+    wait_for_quiescence,
 )
 from logger import configure_logger
+from host_router import HostRouter, parse_db_hosts
+from work_queue import SharedWorkQueue
+from result_writer import StreamingResultWriter
+from deadline import DEADLINE_GRACE_SECONDS
+from ephemeral_pool import DatabaseDispatcher, LazyEphemeralPool
+import fetch_limits
+import reset_ledger
 
 # Create a dictionary to store database locks
 db_locks = {}
@@ -43,7 +58,15 @@ def get_db_lock(db_name):
         return db_locks[db_name]
 
 
-def comprehensive_database_cleanup(db_names, logger):
+def _routed_host(db_name, router):
+    """Return (server, port) for db_name, or (None, None) for the default host"""
+    if router is None:
+        return None, None
+    host = router.route(db_name)
+    return host["host"], host["port"]
+
+
+def comprehensive_database_cleanup(db_names, logger, router=None):
     """Performs a comprehensive cleanup of all databases used in the evaluation"""
     logger.info("Starting comprehensive database cleanup...")
     cleanup_failures = []
@@ -51,7 +74,8 @@ def comprehensive_database_cleanup(db_names, logger):
     for db_name in db_names:
         try:
             logger.info(f"Resetting and restoring database {db_name}")
-            reset_and_restore_database(db_name, logger)
+            server, port = _routed_host(db_name, router)
+            reset_and_restore_database(db_name, logger, server=server, port=port)
             logger.info(f"Successfully reset database {db_name}")
         except Exception as e:
             error_msg = f"Failed to clean up database {db_name}: {str(e)}"
@@ -66,7 +90,7 @@ def comprehensive_database_cleanup(db_names, logger):
         return True
 
 
-def emergency_cleanup(db_names, logger):
+def emergency_cleanup(db_names, logger, router=None):
     """Last resort cleanup procedure for databases"""
     logger.info("Performing emergency cleanup...")
 
@@ -74,26 +98,50 @@ def emergency_cleanup(db_names, logger):
         try:
             # Force cleaning by running simpler SQL commands directly
             logger.info(f"Attempting emergency reset of {db_name}")
-            reset_and_restore_database(db_name, logger, emergency=True)
+            server, port = _routed_host(db_name, router)
+            reset_and_restore_database(db_name, logger, server=server, port=port)
         except Exception as e:
             logger.error(f"Emergency cleanup failed for {db_name}: {str(e)}")
 
     logger.info("Emergency cleanup completed")
 
 
-def run_instance(instance_data, instance_id, args, idx):
-    """Run a single evaluation instance in a separate process"""
+def drop_copies(db_pool, logger, router):
+    """Drop every ephemeral copy the pool created, host by host"""
+    created = db_pool.created_copies()
+    logger.info(f"Dropping ephemeral databases: {db_pool.describe()}")
+    failed = []
+    for host, host_db_names in router.group_by_host(sorted(created)):
+        failed += drop_ephemeral_dbs(
+            [copy for db_name in host_db_names for copy in created[db_name]],
+            logger,
+            server=host["host"],
+            port=host["port"],
+        )
+    if failed:
+        logger.warning(f"Could not drop ephemeral databases: {failed}")
+        return False
+    return True
+
+
+def run_instance(instance_data, instance_id, args, idx, router=None, ephemeral_db=None):
+    """
+    Run a single evaluation instance in a separate process, on the ephemeral
+    copy ephemeral_db of its database if one was leased to it
+    """
 
     # Get the database name for this instance
-    db_name = instance_data.get("db_id", "")
-    if not db_name:
+    base_db = instance_data.get("db_id", "")
+    if not base_db:
         print(f"Warning: Instance {instance_id} has no database specified.")
-        db_name = "unknown_db"
+        base_db = "unknown_db"
+    db_name = ephemeral_db or base_db
 
-    # Create temporary files for input and output
+    # Create temporary files for input and output; the evaluator works on
+    # the copy
     with tempfile.NamedTemporaryFile(mode="w", suffix=".jsonl", delete=False) as tmp:
         tmp_input = tmp.name
-        json.dump(instance_data, tmp)
+        json.dump(dict(instance_data, db_id=db_name), tmp)
 
     # Create temporary output file
     tmp_output = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
@@ -116,25 +164,44 @@ def run_instance(instance_data, instance_id, args, idx):
         args.logging,
         "--log_file",
         instance_log_file,  # Pass the full log file path
+        "--reset_strategy",
+        args.reset_strategy,
+        "--max_rows",
+        str(args.max_rows),
+        "--max_result_bytes",
+        str(args.max_result_bytes),
     ]
 
+    # Route the instance to the server that holds its database
+    server, port = _routed_host(base_db, router)
+    lock_name = db_name
+    if server is not None:
+        lock_name = f"{server}:{port}/{db_name}"
+        cmd += ["--db_host", server, "--db_port", str(port)]
+
     # Get the lock for this database
-    db_lock = get_db_lock(db_name)
+    db_lock = get_db_lock(lock_name)
 
-    print(f"[Thread {idx}] Running instance {instance_id} with database {db_name}...")
+    print(f"[Thread {idx}] Running instance {instance_id} with database {lock_name}...")
 
     # Use the lock to ensure the same database isn't used concurrently
     with db_lock:
         print(
             f"[Thread {idx}] Acquired lock for database {db_name}, running process..."
         )
+        # The evaluator cancels its own queries at the deadline; the process
+        # is only killed if it has not finished after the grace period
+        timed_out = False
+        instance_deadline = time.time() + args.instance_timeout
         try:
             result = subprocess.run(
-                cmd,
+                cmd
+                + ["--deadline", f"{instance_deadline:.3f}"]
+                + ["--db_state", reset_ledger.state(db_name)],
                 capture_output=True,
                 text=True,
                 check=False,
-                timeout=300,  # 5 minute timeout per instance
+                timeout=args.instance_timeout + DEADLINE_GRACE_SECONDS,
             )
             success = result.returncode == 0
             if not success:
@@ -144,23 +211,35 @@ def run_instance(instance_data, instance_id, args, idx):
                 print(f"[Thread {idx}] STDOUT: {result.stdout[:500]}...")
                 print(f"[Thread {idx}] STDERR: {result.stderr[:500]}...")
         except subprocess.TimeoutExpired:
-            print(f"[Thread {idx}] Instance {instance_id} timed out after 300 seconds")
+            print(
+                f"[Thread {idx}] Instance {instance_id} timed out after {args.instance_timeout + DEADLINE_GRACE_SECONDS} seconds"
+            )
             success = False
+            timed_out = True
 
-        # Add a short delay to ensure database operations are fully completed
-        time.sleep(1)
+        # Let the evaluator's sessions end before resetting
+        wait_for_quiescence(db_name, server=server, port=port)
 
-        # Ensure the database is reset before releasing the lock
+        # Ensure the database is reset before releasing the lock; a no-op if
+        # the evaluator already left it clean
+        reset_ledger.absorb_output(tmp_output, db_name)
         try:
-            reset_and_restore_database(db_name, logger=None)
+            reset_ledger.reset(
+                db_name,
+                lambda: reset_and_restore_database(
+                    db_name, logger=None, server=server, port=port
+                ),
+            )
         except Exception as e:
             print(
                 f"[Thread {idx}] Error resetting database after instance {instance_id}: {e}"
             )
-            # Try one more time with a delay
-            time.sleep(3)
+            # Try one more time once the database has no sessions left
+            wait_for_quiescence(db_name, server=server, port=port, timeout=3)
             try:
-                reset_and_restore_database(db_name, logger=None)
+                reset_and_restore_database(
+                    db_name, logger=None, server=server, port=port
+                )
             except Exception as e2:
                 print(f"[Thread {idx}] Second attempt to reset database failed: {e2}")
 
@@ -172,6 +251,8 @@ def run_instance(instance_data, instance_id, args, idx):
         try:
             with open(tmp_output, "r") as f:
                 evaluation_result = json.load(f)
+                evaluation_result.pop("reset_ledger", None)
+                resetter.absorb(evaluation_result.pop("reset_timings", None))
                 # Add instance_id to ensure correct sorting later
                 evaluation_result["instance_id"] = instance_id
                 # Clean up temporary files
@@ -195,29 +276,56 @@ def run_instance(instance_data, instance_id, args, idx):
     return {
         "instance_id": instance_id,
         "status": "failed",
-        "error_message": "Failed to evaluate instance (process error)",
+        "error_message": (
+            "Instance exceeded its time budget"
+            if timed_out
+            else "Failed to evaluate instance (process error)"
+        ),
         "total_test_cases": len(instance_data.get("test_cases", [])),
         "passed_test_cases": 0,
         "failed_test_cases": [],
-        "solution_phase_execution_error": True,
-        "solution_phase_timeout_error": False,
+        "solution_phase_execution_error": not timed_out,
+        "solution_phase_timeout_error": timed_out,
         "solution_phase_assertion_error": False,
     }
 
 
-def process_queue(work_queue, results_dict, global_stats_lock, args, thread_idx):
+def process_queue(
+    work_queue,
+    results_dict,
+    global_stats_lock,
+    args,
+    thread_idx,
+    router=None,
+    db_pool=None,
+):
     """Worker function to process items from the queue"""
     while True:
         try:
-            # Get the next item from the queue with a timeout
-            original_idx, instance_data = work_queue.get(timeout=1)
+            # Get the next item: from a plain or shared queue in its order, or
+            # from the dispatcher, which only hands out instances whose
+            # database has a free copy and reserves that copy
+            reservation = None
+            if isinstance(work_queue, DatabaseDispatcher):
+                original_idx, instance_data, reservation = work_queue.get()
+            else:
+                original_idx, instance_data = work_queue.get(timeout=1)
             instance_id = instance_data.get("instance_id", f"instance_{original_idx}")
+            db_id = instance_data.get("db_id", "unknown_db")
 
-            # Process the instance
+            # Process the instance (on a copy of its database, created on
+            # first demand and returned to the pool afterwards)
+            ephemeral_db = None
             try:
-                result = run_instance(instance_data, instance_id, args, thread_idx)
+                if db_pool is not None:
+                    ephemeral_db = db_pool.get(db_id, reservation=reservation)
+                result = run_instance(
+                    instance_data, instance_id, args, thread_idx, router, ephemeral_db
+                )
                 with global_stats_lock:
                     results_dict[instance_id] = result
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, result)
             except Exception as e:
                 print(
                     f"[Thread {thread_idx}] Error processing instance {instance_id}: {e}"
@@ -234,6 +342,11 @@ def process_queue(work_queue, results_dict, global_stats_lock, args, thread_idx)
                         "solution_phase_timeout_error": False,
                         "solution_phase_assertion_error": False,
                     }
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, results_dict[instance_id])
+            finally:
+                if ephemeral_db is not None:
+                    db_pool.put(db_id, ephemeral_db)
 
             # Mark the task as done
             work_queue.task_done()
@@ -295,8 +408,71 @@ def main():
         default="true",
         help="If 'true', generates an additional difficulty-level performance report.",
     )
+    parser.add_argument(
+        "--db_hosts",
+        type=str,
+        default=None,
+        help="Comma-separated SQL Server hosts 'host[:port][@weight]' to shard "
+        "databases across (default: the single configured host).",
+    )
+    parser.add_argument(
+        "--queue_db",
+        type=str,
+        default=None,
+        help="Shared SQLite work queue (e.g. on NFS). When set, instances are "
+        "claimed from the queue so several nodes can split one evaluation.",
+    )
+    parser.add_argument(
+        "--node_id",
+        type=str,
+        default=None,
+        help="Name of this node in the shared queue (default: hostname:pid).",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=900,
+        help="Seconds before work held by an unresponsive node is re-leased.",
+    )
+    parser.add_argument(
+        "--instance_timeout",
+        type=int,
+        default=300,
+        help="Time budget per instance in seconds. Queries still running when "
+        "it runs out are cancelled on the server.",
+    )
+    parser.add_argument(
+        "--reset_strategy",
+        choices=RESET_STRATEGIES,
+        default="snapshot",
+        help="snapshot: revert databases to a snapshot taken after the first "
+        "restore; backup: always restore them from their .bak file.",
+    )
+    parser.add_argument(
+        "--max_copies",
+        type=int,
+        default=None,
+        help="Most ephemeral copies (<db>_process_<i>) of one database, so "
+        "instances of the same database run in parallel (default: "
+        "--num_threads). 0 runs every instance on its base database, one at "
+        "a time per database.",
+    )
+    parser.add_argument(
+        "--max_rows",
+        type=int,
+        default=fetch_limits.MAX_ROWS,
+        help="Most rows fetched per query result; results past it are cut and "
+        "the test cases see result_truncated.",
+    )
+    parser.add_argument(
+        "--max_result_bytes",
+        type=int,
+        default=fetch_limits.MAX_BYTES,
+        help="Most bytes of values fetched per query result (approximate).",
+    )
 
     args = parser.parse_args()
+    configure_reset_strategy(args.reset_strategy)
 
     # Load data
     data_list = load_jsonl(args.jsonl_file)
@@ -321,12 +497,65 @@ def main():
         f"Processing {len(data_list)} instances from {args.jsonl_file} using {args.num_threads} threads"
     )
 
+    # Claim work from a shared queue when several nodes split one evaluation
+    shared_queue = None
+    if args.queue_db:
+        shared_queue = SharedWorkQueue(
+            args.queue_db,
+            node_id=args.node_id,
+            lease_seconds=args.lease_seconds,
+            execution_error_key="solution_phase_execution_error",
+        )
+        added = shared_queue.enqueue(data_list, source=args.jsonl_file)
+        data_list = shared_queue.load_instances()
+        logger.info(
+            f"Using shared queue {args.queue_db} as node {shared_queue.node_id} "
+            f"({added} instances added, {len(data_list)} total)"
+        )
+
     # Collect all database names
     all_db_names = set()
     for data in data_list:
         if "db_id" in data:
             all_db_names.add(data["db_id"])
 
+    # Place each database on one host, weighted by its number of instances
+    router = HostRouter(
+        parse_db_hosts(
+            args.db_hosts,
+            DEFAULT_SQLSERVER_CONFIG["SERVER"],
+            DEFAULT_SQLSERVER_CONFIG["PORT"],
+        )
+    )
+    router.place(Counter(data.get("db_id", "unknown_db") for data in data_list))
+    logger.info(f"Database placement across hosts:\n{router.describe()}")
+
+    # Ephemeral copies are restored on first demand, on the host that holds
+    # the database; each database gets copies in proportion to its instances
+    max_copies = args.num_threads if args.max_copies is None else args.max_copies
+    db_pool = None
+    if max_copies > 0:
+
+        def create_copy(db_id, copy_index):
+            server, port = _routed_host(db_id, router)
+            return create_ephemeral_db_copy(
+                db_id, copy_index, logger, server=server, port=port
+            )
+
+        db_pool = LazyEphemeralPool(
+            Counter(data.get("db_id", "unknown_db") for data in data_list),
+            max_copies,
+            create_copy,
+            logger=logger,
+        )
+        logger.info(f"Ephemeral database quotas: {db_pool.describe()}")
+
+    def cleanup_databases():
+        # Instances ran on copies, so the base databases were not touched
+        if db_pool is not None:
+            return drop_copies(db_pool, logger, router)
+        return comprehensive_database_cleanup(all_db_names, logger, router)
+
     # Add signal handler for graceful termination
     def cleanup_handler(signum, frame):
         global cleanup_in_progress
@@ -337,11 +566,13 @@ def main():
         cleanup_in_progress = True
         logger.info(f"Received signal {signum}. Starting emergency cleanup...")
         try:
-            comprehensive_database_cleanup(all_db_names, logger)
+            if shared_queue is not None:
+                shared_queue.release_all()
+            cleanup_databases()
         except Exception as e:
             logger.error(f"Error during signal handler cleanup: {e}")
             try:
-                emergency_cleanup(all_db_names, logger)
+                emergency_cleanup(all_db_names, logger, router)
             except:
                 pass
         finally:
@@ -354,22 +585,51 @@ def main():
     # Ensure num_threads is at least 1 and not more than the number of instances
     num_threads = max(1, min(args.num_threads, len(data_list)))
 
-    # Create a dictionary to store results, using instance_id as the key
-    results_dict = {}
+    # Status records are streamed to the output JSONL as results arrive
+    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
+
+    def open_result_writer():
+        return StreamingResultWriter(
+            output_jsonl_file, data_list, phase="solution", logger=logger
+        )
+
+    # Collect results keyed by instance_id. A node sharing a queue only sees
+    # part of the run, so its status file is written at merge time.
+    if shared_queue is not None:
+        results_dict = {}
+    else:
+        results_dict = open_result_writer()
     global_stats_lock = threading.Lock()
 
     try:
-        # Create a work queue
-        work_queue = queue.Queue()
-        for i, data in enumerate(data_list):
-            work_queue.put((i, data))
+        # Create a work queue (or claim from the shared one)
+        if shared_queue is not None:
+            work_queue = shared_queue
+        elif db_pool is not None:
+            work_queue = DatabaseDispatcher(
+                enumerate(data_list),
+                db_pool,
+                lambda data: data.get("db_id", "unknown_db"),
+            )
+        else:
+            work_queue = queue.Queue()
+            for i, data in enumerate(data_list):
+                work_queue.put((i, data))
 
         # Start worker threads
         threads = []
         for i in range(num_threads):
             thread = threading.Thread(
                 target=process_queue,
-                args=(work_queue, results_dict, global_stats_lock, args, i),
+                args=(
+                    work_queue,
+                    results_dict,
+                    global_stats_lock,
+                    args,
+                    i,
+                    router,
+                    db_pool,
+                ),
             )
             thread.daemon = True
             thread.start()
@@ -379,8 +639,11 @@ def main():
         with tqdm(total=len(data_list), desc="Evaluating instances") as pbar:
             completed = 0
             while completed < len(data_list):
-                with global_stats_lock:
-                    current_completed = len(results_dict)
+                if shared_queue is not None:
+                    current_completed = shared_queue.done_count()
+                else:
+                    with global_stats_lock:
+                        current_completed = len(results_dict)
 
                 if current_completed > completed:
                     pbar.update(current_completed - completed)
@@ -404,55 +667,25 @@ def main():
         for thread in threads:
             thread.join(timeout=1)
 
-        # Ensure all instances have results
-        for data in data_list:
-            instance_id = data.get("instance_id", f"instance_{data_list.index(data)}")
-            if instance_id not in results_dict:
-                logger.error(f"Missing result for instance {instance_id}")
-                results_dict[instance_id] = {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": "Result missing from processing",
-                    "solution_phase_execution_error": True,
-                    "total_test_cases": len(data.get("test_cases", [])),
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                }
-
-        # Sort results in original order
-        results = []
-        for data in data_list:
-            instance_id = data.get("instance_id", f"instance_{data_list.index(data)}")
-            if instance_id in results_dict:
-                results.append(results_dict[instance_id])
-            else:
-                # This should not happen due to the check above, but adding fallback
-                logger.error(
-                    f"Missing result for instance {instance_id} (after final check)"
-                )
-                results.append(
-                    {
-                        "instance_id": instance_id,
-                        "status": "failed",
-                        "error_message": "Result missing from processing",
-                        "solution_phase_execution_error": True,
-                        "total_test_cases": len(data.get("test_cases", [])),
-                        "passed_test_cases": 0,
-                        "failed_test_cases": [],
-                    }
-                )
-
-        # Count statistics
-        number_of_execution_errors = sum(
-            1 for r in results if r.get("solution_phase_execution_error", False)
-        )
-        number_of_timeouts = sum(
-            1 for r in results if r.get("solution_phase_timeout_error", False)
-        )
-        number_of_assertion_errors = sum(
-            1 for r in results if r.get("solution_phase_assertion_error", False)
-        )
-        total_passed_instances = sum(1 for r in results if r.get("status") == "success")
+        # Only one node merges the results of a shared queue
+        if shared_queue is not None:
+            shared_queue.close()
+            if not shared_queue.claim_merge():
+                logger.info("Queue drained; results are merged by another node.")
+                return
+            logger.info("Queue drained, merging results from all nodes")
+            merged_results = shared_queue.results_by_instance_id()
+            results_dict = open_result_writer()
+            results_dict.update(merged_results)
+
+        # Results in original order; instances without a result are marked failed
+        results = results_dict.finish()
+
+        # Statistics come from the writer's running counters
+        number_of_execution_errors = results_dict.number_of_execution_errors
+        number_of_timeouts = results_dict.number_of_timeouts
+        number_of_assertion_errors = results_dict.number_of_assertion_errors
+        total_passed_instances = results_dict.total_passed_instances
 
         # Generate report and output files
         generate_report_and_output(
@@ -464,11 +697,19 @@ def main():
             number_of_timeouts,
             number_of_assertion_errors,
             total_passed_instances,
+            save_status_file=False,  # already streamed by results_dict
         )
 
         # Generate category report if requested
         base_output_folder = os.path.splitext(args.jsonl_file)[0]
         report_file_path = f"{base_output_folder}_report.txt"
+
+        # Resets skipped because the database was known to be clean, and the
+        # time restores took per strategy
+        with open(report_file_path, "a") as f:
+            f.write(f"\n{reset_ledger.summary()}\n{resetter.summary()}\n")
+        logger.info(reset_ledger.summary())
+        logger.info(resetter.summary())
         if args.report == "true":
             model_name = (
                 args.jsonl_file.split("/")[-1]
@@ -485,6 +726,9 @@ def main():
             )
             print(f"Difficulty report generated: {report_file_path}")
 
+        if shared_queue is not None:
+            shared_queue.finish_merge()
+
         # Print summary to console
         print("\nEvaluation Summary:")
         print(f"Total instances: {len(results)}")
@@ -497,16 +741,18 @@ def main():
         if len(results) > 0:
             overall_accuracy = (total_passed_instances / len(results)) * 100
             print(f"Overall accuracy: {overall_accuracy:.2f}%")
+        print(reset_ledger.summary())
+        print(resetter.summary())
 
     except Exception as e:
         logger.error(f"Error in main execution: {e}")
         # Try to clean up in case of error
         try:
-            comprehensive_database_cleanup(all_db_names, logger)
+            cleanup_databases()
         except Exception as cleanup_error:
             logger.error(f"Cleanup after error failed: {cleanup_error}")
             try:
-                emergency_cleanup(all_db_names, logger)
+                emergency_cleanup(all_db_names, logger, router)
             except:
                 pass
 
@@ -517,11 +763,11 @@ def main():
             cleanup_in_progress = True
             logger.info("Performing final cleanup of all databases")
             try:
-                comprehensive_database_cleanup(all_db_names, logger)
+                cleanup_databases()
             except Exception as e:
                 logger.error(f"Final cleanup failed: {e}")
                 try:
-                    emergency_cleanup(all_db_names, logger)
+                    emergency_cleanup(all_db_names, logger, router)
                 except:
                     pass
 
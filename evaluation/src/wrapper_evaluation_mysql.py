@@ -17,18 +17,27 @@ import gc
 import concurrent.futures
 import threading
 import queue
+from collections import Counter
 from datetime import datetime
 from tqdm import tqdm
 from mysql_utils import (
+    DEFAULT_DB_CONFIG,
     load_jsonl,
     save_report_and_status,
     generate_category_report,
-    create_ephemeral_db_copies,
+    create_ephemeral_db_copy,
     drop_ephemeral_dbs,
     cleanup_ephemeral_databases,
     enhanced_cleanup,
+    wait_for_quiescence,
 )
 from logger import configure_logger
+import reset_ledger
+from host_router import HostRouter, host_key, parse_db_hosts
+from work_queue import SharedWorkQueue
+from result_writer import StreamingResultWriter
+from deadline import DEADLINE_GRACE_SECONDS
+from ephemeral_pool import DatabaseDispatcher, LazyEphemeralPool
 
 # Create a dictionary to store database locks
 db_template_locks = {}
@@ -36,20 +45,21 @@ db_template_locks = {}
 template_locks_lock = threading.Lock()
 
 
-def get_db_lock(db_name):
-    """Get a lock for the specified database, create one if it doesn't exist"""
+def get_db_lock(db_name, host_label=""):
+    """
+    Get a lock for the specified database (an ephemeral copy has its own, so
+    copies of one database run in parallel), create one if it doesn't exist
+    """
     with template_locks_lock:
-        # Extract base database name (remove possible suffix)
-        base_db_name = db_name.split("_process_")[0]
-        template_db_name = f"{base_db_name}_template"
+        lock_name = f"{host_label}/{db_name}"
 
-        if template_db_name not in db_template_locks:
-            db_template_locks[template_db_name] = threading.Lock()
+        if lock_name not in db_template_locks:
+            db_template_locks[lock_name] = threading.Lock()
 
-        return db_template_locks[template_db_name]
+        return db_template_locks[lock_name]
 
 
-def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
+def run_instance(instance_data, instance_id, args, idx, ephemeral_db, router=None):
     """Run a single evaluation instance in a separate process"""
     tmp_input = None
     tmp_output = None
@@ -68,7 +78,7 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
             mode="w", suffix=".jsonl", delete=False
         ) as tmp:
             tmp_input = tmp.name
-            json.dump(instance_data, tmp)
+            json.dump(dict(instance_data, db_id=db_name), tmp)
 
         # Create temporary output file
         tmp_output = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
@@ -94,26 +104,43 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
             "--mysql_password",
             args.mysql_password,
         ]
+        # The evaluator works on the ephemeral copy; while it runs, the
+        # state of that copy is unknown to other instances
+        ledger_db = db_name
+        cmd += ["--db_state", reset_ledger.state(ledger_db)]
+        reset_ledger.mark_unknown(ledger_db, f"instance {instance_id} running")
+
+        # Route the instance to the host that holds its database
+        host = None
+        host_label = ""
+        if router is not None:
+            host = router.route(instance_data.get("db_id", "unknown_db"))
+            host_label = host_key(host)
+            cmd += ["--db_host", host["host"], "--db_port", str(host["port"])]
 
         # Get the corresponding database template lock
-        db_lock = get_db_lock(db_name)
+        db_lock = get_db_lock(db_name, host_label)
 
         print(
-            f"[Thread {idx}] Running instance {instance_id} with database {db_name}..."
+            f"[Thread {idx}] Running instance {instance_id} with database {db_name} {host_label}..."
         )
 
-        # Use lock to ensure the same template is not used to create multiple databases simultaneously
+        # Use lock to ensure no two instances run on the same copy at once
         with db_lock:
             print(
                 f"[Thread {idx}] Acquired lock for database {db_name}, running process..."
             )
+            # The evaluator cancels its own queries at the deadline; the process
+            # is only killed if it has not finished after the grace period
+            timed_out = False
+            instance_deadline = time.time() + args.instance_timeout
             try:
                 result = subprocess.run(
-                    cmd,
+                    cmd + ["--deadline", f"{instance_deadline:.3f}"],
                     capture_output=True,
                     text=True,
                     check=False,
-                    timeout=300,  # 5 minute timeout per instance
+                    timeout=args.instance_timeout + DEADLINE_GRACE_SECONDS,
                 )
                 success = result.returncode == 0
                 if not success:
@@ -124,12 +151,19 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
                     print(f"[Thread {idx}] STDERR: {result.stderr[:500]}...")
             except subprocess.TimeoutExpired:
                 print(
-                    f"[Thread {idx}] Instance {instance_id} timed out after 300 seconds"
+                    f"[Thread {idx}] Instance {instance_id} timed out after {args.instance_timeout + DEADLINE_GRACE_SECONDS} seconds"
                 )
                 success = False
-
-            # Add a short delay to ensure database operations are completely finished
-            time.sleep(1)
+                timed_out = True
+
+            # Hand the copy over as soon as the evaluator's connections are gone
+            wait_for_quiescence(
+                db_name,
+                args.mysql_password,
+                mysql_host=host["host"] if host else None,
+                mysql_port=host["port"] if host else None,
+            )
+        reset_ledger.absorb_output(tmp_output, ledger_db)
 
         # Lock has been released, process results
         print(
@@ -141,6 +175,7 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
             try:
                 with open(tmp_output, "r") as f:
                     evaluation_result = json.load(f)
+                    evaluation_result.pop("reset_ledger", None)
                     # Add instance_id to ensure correct sorting later
                     evaluation_result["instance_id"] = instance_id
                     return evaluation_result
@@ -153,12 +188,16 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
         return {
             "instance_id": instance_id,
             "status": "failed",
-            "error_message": "Failed to evaluate instance (process error)",
+            "error_message": (
+                "Instance exceeded its time budget"
+                if timed_out
+                else "Failed to evaluate instance (process error)"
+            ),
             "total_test_cases": len(instance_data.get("test_cases", [])),
             "passed_test_cases": 0,
             "failed_test_cases": [],
-            "evaluation_phase_execution_error": True,
-            "evaluation_phase_timeout_error": False,
+            "evaluation_phase_execution_error": not timed_out,
+            "evaluation_phase_timeout_error": timed_out,
             "evaluation_phase_assertion_error": False,
         }
     except Exception as e:
@@ -190,27 +229,35 @@ def run_instance(instance_data, instance_id, args, idx, ephemeral_db):
 
 
 def process_queue(
-    work_queue, db_queue, results_dict, global_stats_lock, args, thread_idx
+    work_queue, db_pool, results_dict, global_stats_lock, args, thread_idx, router
 ):
     """Worker function to process items from the queue"""
     while True:
         try:
-            # Get the next item from the queue
-            original_idx, instance_data = work_queue.get(timeout=1)
+            # Get the next item: from the shared queue in its order, or from the
+            # dispatcher, which only hands out instances whose database has a
+            # free copy and reserves that copy
+            if isinstance(work_queue, SharedWorkQueue):
+                original_idx, instance_data = work_queue.get(timeout=1)
+                reservation = None
+            else:
+                original_idx, instance_data, reservation = work_queue.get()
             instance_id = instance_data.get("instance_id", f"instance_{original_idx}")
 
-            # Get an ephemeral database from the database queue
+            # Get an ephemeral database from the pool (created on first demand)
             db_name = instance_data.get("db_id", "unknown_db")
 
             try:
-                ephemeral_db = db_queue[db_name].get(timeout=60)
-            except queue.Empty:
-                # No database available, store error result and continue
+                # Waits for a free copy instead of failing the instance
+                ephemeral_db = db_pool.get(db_name, reservation=reservation)
+            except Exception as e:
+                # The copy could not be created, store error result and continue
+                error_message = f"Failed to create ephemeral database: {e}"
                 with global_stats_lock:
                     results_dict[instance_id] = {
                         "instance_id": instance_id,
                         "status": "failed",
-                        "error_message": "No ephemeral database available",
+                        "error_message": error_message,
                         "total_test_cases": len(instance_data.get("test_cases", [])),
                         "passed_test_cases": 0,
                         "failed_test_cases": [],
@@ -218,19 +265,23 @@ def process_queue(
                         "evaluation_phase_timeout_error": False,
                         "evaluation_phase_assertion_error": False,
                     }
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, results_dict[instance_id])
                 work_queue.task_done()
                 continue
 
             # Process the instance
             try:
                 result = run_instance(
-                    instance_data, instance_id, args, thread_idx, ephemeral_db
+                    instance_data, instance_id, args, thread_idx, ephemeral_db, router
                 )
                 with global_stats_lock:
                     results_dict[instance_id] = result
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, result)
             finally:
-                # Always return the database to the queue
-                db_queue[db_name].put(ephemeral_db)
+                # Always return the database to the pool
+                db_pool.put(db_name, ephemeral_db)
 
             # Mark the task as done
             work_queue.task_done()
@@ -297,6 +348,39 @@ def main():
         default="123123",
         help="MySQL root password for resetting the database.",
     )
+    parser.add_argument(
+        "--db_hosts",
+        type=str,
+        default=None,
+        help="Comma-separated MySQL hosts 'host[:port][@weight]' to shard "
+        "databases across (default: the single configured host).",
+    )
+    parser.add_argument(
+        "--queue_db",
+        type=str,
+        default=None,
+        help="Shared SQLite work queue (e.g. on NFS). When set, instances are "
+        "claimed from the queue so several nodes can split one evaluation.",
+    )
+    parser.add_argument(
+        "--node_id",
+        type=str,
+        default=None,
+        help="Name of this node in the shared queue (default: hostname:pid).",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=900,
+        help="Seconds before work held by an unresponsive node is re-leased.",
+    )
+    parser.add_argument(
+        "--instance_timeout",
+        type=int,
+        default=300,
+        help="Time budget per instance in seconds. Queries still running when "
+        "it runs out are cancelled on the server.",
+    )
 
     args = parser.parse_args()
 
@@ -323,13 +407,41 @@ def main():
         f"Processing {len(data_list)} instances from {args.jsonl_file} using {args.num_threads} threads"
     )
 
+    # Claim work from a shared queue when several nodes split one evaluation
+    shared_queue = None
+    if args.queue_db:
+        shared_queue = SharedWorkQueue(
+            args.queue_db,
+            node_id=args.node_id,
+            lease_seconds=args.lease_seconds,
+            execution_error_key="evaluation_phase_execution_error",
+        )
+        added = shared_queue.enqueue(data_list, source=args.jsonl_file)
+        data_list = shared_queue.load_instances()
+        logger.info(
+            f"Using shared queue {args.queue_db} as node {shared_queue.node_id} "
+            f"({added} instances added, {len(data_list)} total)"
+        )
+
+    # Place each database on one host, weighted by its number of instances
+    router = HostRouter(
+        parse_db_hosts(
+            args.db_hosts, DEFAULT_DB_CONFIG["host"], DEFAULT_DB_CONFIG["port"]
+        )
+    )
+    router.place(Counter(data.get("db_id", "unknown_db") for data in data_list))
+    logger.info(f"Database placement across hosts:\n{router.describe()}")
+
     # Add signal handler for graceful cleanup
     def cleanup_handler(signum, frame):
         logger.info("Received termination signal. Starting cleanup...")
         try:
-            cleanup_ephemeral_databases(
-                "root", args.mysql_password, "bird_critic_mysql", 3306, logger
-            )
+            if shared_queue is not None:
+                shared_queue.release_all()
+            for host in router.hosts:
+                cleanup_ephemeral_databases(
+                    "root", args.mysql_password, host["host"], host["port"], logger
+                )
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
         finally:
@@ -338,44 +450,61 @@ def main():
     signal.signal(signal.SIGINT, cleanup_handler)
     signal.signal(signal.SIGTERM, cleanup_handler)
 
+    # Status records are streamed to the output JSONL as results arrive
+    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
+
+    def open_result_writer():
+        return StreamingResultWriter(
+            output_jsonl_file,
+            data_list,
+            phase="evaluation",
+            copy_fields=("original_schema", "preprocess_schema"),
+            logger=logger,
+        )
+
     try:
         # Ensure num_threads is at least 1
         num_threads = max(1, min(args.num_threads, len(data_list)))
 
-        # Collect all required database names
-        all_db_names = set()
-        for data in data_list:
-            if "db_id" in data:
-                all_db_names.add(data["db_id"])
+        # Ephemeral copies are created on first demand, on the host that holds
+        # the database; each database gets copies in proportion to its instances
+        def create_copy(db_id, copy_index):
+            host = router.route(db_id)
+            return create_ephemeral_db_copy(
+                db_id,
+                copy_index,
+                args.mysql_password,
+                logger,
+                mysql_host=host["host"],
+                mysql_port=host["port"],
+            )
 
-        # Create temporary copies for each database
-        logger.info(
-            f"Creating ephemeral database copies for {len(all_db_names)} databases"
-        )
-        ephemeral_db_pool_dict = create_ephemeral_db_copies(
-            base_db_names=all_db_names,
-            num_copies=args.num_threads,
-            mysql_password=args.mysql_password,
+        db_pool = LazyEphemeralPool(
+            Counter(data.get("db_id", "unknown_db") for data in data_list),
+            args.num_threads,
+            create_copy,
             logger=logger,
         )
-
-        # Create database queues for parallel processing allocation
-        db_queues = {}
-        for base_db, ephemeral_list in ephemeral_db_pool_dict.items():
-            q = queue.Queue()
-            for ep_db in ephemeral_list:
-                q.put(ep_db)
-            db_queues[base_db] = q
+        logger.info(f"Ephemeral database quotas: {db_pool.describe()}")
 
         try:
-            # Create dictionary to store results, using instance_id as key to ensure correct sorting
-            results_dict = {}
+            # Collect results keyed by instance_id. A node sharing a queue only
+            # sees part of the run, so its status file is written at merge time.
+            if shared_queue is not None:
+                results_dict = {}
+            else:
+                results_dict = open_result_writer()
             global_stats_lock = threading.Lock()
 
-            # Create work queue
-            work_queue = queue.Queue()
-            for i, data in enumerate(data_list):
-                work_queue.put((i, data))
+            # Create work queue (or claim from the shared one)
+            if shared_queue is not None:
+                work_queue = shared_queue
+            else:
+                work_queue = DatabaseDispatcher(
+                    enumerate(data_list),
+                    db_pool,
+                    lambda data: data.get("db_id", "unknown_db"),
+                )
 
             # Start worker threads
             threads = []
@@ -384,11 +513,12 @@ def main():
                     target=process_queue,
                     args=(
                         work_queue,
-                        db_queues,
+                        db_pool,
                         results_dict,
                         global_stats_lock,
                         args,
                         i,
+                        router,
                     ),
                 )
                 thread.daemon = True
@@ -399,7 +529,10 @@ def main():
             with tqdm(total=len(data_list), desc="Evaluating instances") as pbar:
                 completed = 0
                 while completed < len(data_list):
-                    current_completed = len(results_dict)
+                    if shared_queue is not None:
+                        current_completed = shared_queue.done_count()
+                    else:
+                        current_completed = len(results_dict)
                     if current_completed > completed:
                         pbar.update(current_completed - completed)
                         completed = current_completed
@@ -421,53 +554,29 @@ def main():
             for thread in threads:
                 thread.join(timeout=1)
 
-            # Ensure all instances have results
-            for data in data_list:
-                instance_id = data.get(
-                    "instance_id", f"instance_{data_list.index(data)}"
-                )
-                if instance_id not in results_dict:
-                    logger.error(f"Missing result for instance {instance_id}")
-                    results_dict[instance_id] = {
-                        "instance_id": instance_id,
-                        "status": "failed",
-                        "error_message": "Result missing from processing",
-                        "evaluation_phase_execution_error": True,
-                        "total_test_cases": len(data.get("test_cases", [])),
-                        "passed_test_cases": 0,
-                        "failed_test_cases": [],
-                    }
-
-            # Organize results in original list order
-            results = []
-            for data in data_list:
-                instance_id = data.get(
-                    "instance_id", f"instance_{data_list.index(data)}"
-                )
-                if instance_id in results_dict:
-                    results.append(results_dict[instance_id])
-
-            # Compile statistics
-            number_of_execution_errors = sum(
-                1 for r in results if r.get("evaluation_phase_execution_error", False)
-            )
-            number_of_timeouts = sum(
-                1 for r in results if r.get("evaluation_phase_timeout_error", False)
-            )
-            number_of_assertion_errors = sum(
-                1 for r in results if r.get("evaluation_phase_assertion_error", False)
-            )
-            total_passed_instances = sum(
-                1 for r in results if r.get("status") == "success"
-            )
+            # Only one node merges the results of a shared queue
+            if shared_queue is not None:
+                shared_queue.close()
+                if not shared_queue.claim_merge():
+                    logger.info("Queue drained; results are merged by another node.")
+                    return
+                logger.info("Queue drained, merging results from all nodes")
+                merged_results = shared_queue.results_by_instance_id()
+                results_dict = open_result_writer()
+                results_dict.update(merged_results)
+
+            # Results in original order; instances without a result are marked failed
+            results = results_dict.finish()
+
+            # Compile statistics from the writer's running counters
+            number_of_execution_errors = results_dict.number_of_execution_errors
+            number_of_timeouts = results_dict.number_of_timeouts
+            number_of_assertion_errors = results_dict.number_of_assertion_errors
+            total_passed_instances = results_dict.total_passed_instances
 
             # Generate summary report
             total_instances = len(results)
-            total_errors = (
-                number_of_execution_errors
-                + number_of_timeouts
-                + number_of_assertion_errors
-            )
+            total_errors = results_dict.total_errors
             overall_accuracy = (
                 ((total_instances - total_errors) / total_instances * 100)
                 if total_instances > 0
@@ -489,22 +598,17 @@ def main():
                 timestamp=timestamp,
                 output_data=data_list,
                 base_output_folder=base_output_folder,
-                logging_enabled=args.logging,
+                # The status JSONL has already been streamed by results_dict
+                logging_enabled="false",
             )
 
-            print("Overall report generated:", report_file_path)
+            # Resets skipped because the database was known to be clean
+            with open(report_file_path, "a") as f:
+                f.write(f"\n{reset_ledger.summary()}\n")
+            logger.info(reset_ledger.summary())
 
-            # Output JSONL with status
-            output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
-            with open(output_jsonl_file, "w") as f:
-                for data in data_list:
-                    instance_id = data.get("instance_id")
-                    for result in results:
-                        if data.get("instance_id") == result.get("instance_id"):
-                            data["status"] = result["status"]
-                            data["error_message"] = result.get("error_message")
-                            f.write(json.dumps(data, ensure_ascii=False) + "\n")
-                            break
+            print("Overall report generated:", report_file_path)
+            print("Output with status:", output_jsonl_file)
 
             # Generate difficulty level performance report if requested
             if args.report == "true":
@@ -523,6 +627,9 @@ def main():
                 )
                 print(f"Difficulty report generated: {report_file_path}")
 
+            if shared_queue is not None:
+                shared_queue.finish_merge()
+
             # Print summary to console
             print("\nEvaluation Summary:")
             print(f"Total instances: {total_instances}")
@@ -532,6 +639,7 @@ def main():
             print(f"Timeouts: {number_of_timeouts}")
             print(f"Assertion errors: {number_of_assertion_errors}")
             print(f"Overall accuracy: {overall_accuracy:.2f}%")
+            print(reset_ledger.summary())
 
         except Exception as e:
             logger.error(f"Error during evaluation: {e}")
@@ -542,36 +650,59 @@ def main():
             logger.info("Starting final cleanup...")
             try:
                 # Regular cleanup
-                drop_ephemeral_dbs(ephemeral_db_pool_dict, args.mysql_password, logger)
-                cleanup_ephemeral_databases(
-                    "root", args.mysql_password, "bird_critic_mysql", 3306, logger
-                )
+                logger.info(f"Ephemeral databases created: {db_pool.describe()}")
+                created = db_pool.created_copies()
+                for host, host_db_names in router.group_by_host(sorted(created)):
+                    drop_ephemeral_dbs(
+                        {db_name: created[db_name] for db_name in host_db_names},
+                        args.mysql_password,
+                        logger,
+                        mysql_host=host["host"],
+                        mysql_port=host["port"],
+                    )
+                for host in router.hosts:
+                    cleanup_ephemeral_databases(
+                        "root", args.mysql_password, host["host"], host["port"], logger
+                    )
 
-                # Forced cleanup
-                enhanced_cleanup(args.mysql_password, logger, force=True)
-
-                # Clean disk space (if applicable)
-                subprocess.run(
-                    [
-                        "mysql",
-                        "-h",
-                        "bird_critic_mysql",  # Specify hostname
-                        "-P",
-                        "3306",  # Specify port
-                        "-u",
-                        "root",  # Specify username
-                        f"-p{args.mysql_password}",
-                        "-e",
-                        "PURGE BINARY LOGS BEFORE NOW()",
-                    ]
-                )
+                    # Forced cleanup
+                    enhanced_cleanup(
+                        args.mysql_password,
+                        logger,
+                        force=True,
+                        mysql_host=host["host"],
+                        mysql_port=host["port"],
+                    )
+
+                    # Clean disk space (if applicable)
+                    subprocess.run(
+                        [
+                            "mysql",
+                            "-h",
+                            host["host"],  # Specify hostname
+                            "-P",
+                            str(host["port"]),  # Specify port
+                            "-u",
+                            "root",  # Specify username
+                            f"-p{args.mysql_password}",
+                            "-e",
+                            "PURGE BINARY LOGS BEFORE NOW()",
+                        ]
+                    )
 
                 logger.info("All ephemeral databases have been dropped.")
             except Exception as e:
                 logger.error(f"Error during final database cleanup: {e}")
                 # Perform stronger emergency cleanup
                 try:
-                    enhanced_cleanup(args.mysql_password, logger, force=True)
+                    for host in router.hosts:
+                        enhanced_cleanup(
+                            args.mysql_password,
+                            logger,
+                            force=True,
+                            mysql_host=host["host"],
+                            mysql_port=host["port"],
+                        )
                 except Exception as cleanup_error:
                     logger.error(f"Emergency cleanup also failed: {cleanup_error}")
 
@@ -579,9 +710,10 @@ def main():
         logger.error(f"Fatal error in main: {main_error}")
         # Last attempt to clean up
         try:
-            cleanup_ephemeral_databases(
-                "root", args.mysql_password, "bird_critic_mysql", 3306, logger
-            )
+            for host in router.hosts:
+                cleanup_ephemeral_databases(
+                    "root", args.mysql_password, host["host"], host["port"], logger
+                )
         except:
             pass
         raise
@@ -16,17 +16,31 @@ import time
 import gc
 import threading
 import queue
+from contextlib import ExitStack
+from collections import Counter
 from datetime import datetime
 import tqdm
 from oracle_utils import (
-    create_ephemeral_users,
+    DEFAULT_ORACLE_CONFIG,
+    FLASHBACK,
+    MASTER_RESET_STRATEGIES,
+    create_ephemeral_user,
     drop_ephemeral_users,
     generate_category_report,
     generate_report_and_output,
     cleanup_all_ephemeral_users,
+    master_table_names,
+    wait_for_quiescence,
+    written_table_candidates,
 )
 from oracle_test_utils import load_jsonl
 from logger import configure_logger
+from host_router import HostRouter, host_key, parse_db_hosts
+from work_queue import SharedWorkQueue
+from result_writer import StreamingResultWriter
+from deadline import DEADLINE_GRACE_SECONDS
+from ephemeral_pool import DatabaseDispatcher, LazyEphemeralPool
+import fetch_limits
 
 # Global dictionary to store database locks
 db_template_locks = {}
@@ -42,7 +56,35 @@ def get_db_lock(db_name):
         return db_template_locks[db_name]
 
 
-def run_instance(instance_data, instance_id, args, thread_idx, ephemeral_user):
+# MASTER table names per host_key, filled in by main() (None: unknown)
+master_tables = {}
+
+
+def instance_lock_names(instance_data, ephemeral_user, db_name, host, args):
+    """
+    Names of the locks an instance holds while it runs: its ephemeral user,
+    so instances of one database run in parallel on different users, and,
+    with the flashback reset, every MASTER table it may write, since
+    flashing a table back undoes the changes of anyone else writing it. If
+    the MASTER tables are unknown, instances of one database run one at a
+    time as before.
+    """
+    prefix = f"{host_key(host)}/" if host else ""
+    names = [f"{prefix}{ephemeral_user or db_name}"]
+    if args.master_reset == FLASHBACK:
+        known = master_tables.get(host_key(host) if host else "")
+        if known is None:
+            names.append(f"{prefix}{db_name}")
+        else:
+            candidates = written_table_candidates(instance_data, args.mode)
+            names += [f"{prefix}MASTER.{table}" for table in candidates & known]
+    # Taken in one global order, so two instances cannot deadlock
+    return sorted(set(names))
+
+
+def run_instance(
+    instance_data, instance_id, args, thread_idx, ephemeral_user, router=None
+):
     """Run a single evaluation instance in a separate process"""
     tmp_input = None
     tmp_output = None
@@ -78,31 +120,51 @@ def run_instance(instance_data, instance_id, args, thread_idx, ephemeral_user):
             instance_log_file,  # Pass the full log file path
             "--ephemeral_user",
             ephemeral_user,
+            "--master_reset",
+            args.master_reset,
+            "--max_rows",
+            str(args.max_rows),
+            "--max_result_bytes",
+            str(args.max_result_bytes),
         ]
 
-        # Get the corresponding database template lock
         db_name = instance_data.get("db_id", "unknown").upper()
-        db_lock = get_db_lock(db_name)
+
+        # Route the instance to the host that holds its ephemeral users
+        host = None
+        if router is not None:
+            host = router.route(db_name)
+            cmd += ["--db_host", host["host"], "--db_port", str(host["port"])]
+
+        lock_names = instance_lock_names(
+            instance_data, ephemeral_user, db_name, host, args
+        )
 
         print(
             f"[Thread {thread_idx}] Running instance {instance_id} with ephemeral user {ephemeral_user}..."
         )
 
-        # Use lock to ensure the same template isn't used to create multiple databases simultaneously
-        with db_lock:
+        # Hold the user (and the MASTER tables the instance may write)
+        with ExitStack() as held:
+            for lock_name in lock_names:
+                held.enter_context(get_db_lock(lock_name))
             print(
-                f"[Thread {thread_idx}] Acquired lock for database {db_name}, running process..."
+                f"[Thread {thread_idx}] Acquired locks {lock_names}, running process..."
             )
+            # The evaluator cancels its own queries at the deadline; the process
+            # is only killed if it has not finished after the grace period
+            timed_out = False
+            instance_deadline = time.time() + args.instance_timeout
             try:
                 # Run the process with timeout
                 import subprocess
 
                 result = subprocess.run(
-                    cmd,
+                    cmd + ["--deadline", f"{instance_deadline:.3f}"],
                     capture_output=True,
                     text=True,
                     check=False,
-                    timeout=300,  # 5 minute timeout per instance
+                    timeout=args.instance_timeout + DEADLINE_GRACE_SECONDS,
                 )
                 success = result.returncode == 0
                 if not success:
@@ -113,16 +175,21 @@ def run_instance(instance_data, instance_id, args, thread_idx, ephemeral_user):
                     print(f"[Thread {thread_idx}] STDERR: {result.stderr[:500]}...")
             except subprocess.TimeoutExpired:
                 print(
-                    f"[Thread {thread_idx}] Instance {instance_id} timed out after 300 seconds"
+                    f"[Thread {thread_idx}] Instance {instance_id} timed out after {args.instance_timeout + DEADLINE_GRACE_SECONDS} seconds"
                 )
                 success = False
+                timed_out = True
 
-            # Add a short delay to ensure database operations are fully completed
-            time.sleep(1)
+            # Hand the user over as soon as the evaluator's sessions are gone
+            wait_for_quiescence(
+                ephemeral_user,
+                host=host["host"] if host else None,
+                port=host["port"] if host else None,
+            )
 
         # Lock has been released, process results
         print(
-            f"[Thread {thread_idx}] Released lock for database {db_name}, processing results..."
+            f"[Thread {thread_idx}] Released locks for {ephemeral_user}, processing results..."
         )
 
         # If successful, read output, otherwise create failure result
@@ -142,12 +209,16 @@ def run_instance(instance_data, instance_id, args, thread_idx, ephemeral_user):
         return {
             "instance_id": instance_id,
             "status": "failed",
-            "error_message": "Failed to evaluate instance (process error)",
+            "error_message": (
+                "Instance exceeded its time budget"
+                if timed_out
+                else "Failed to evaluate instance (process error)"
+            ),
             "total_test_cases": len(instance_data.get("test_cases", [])),
             "passed_test_cases": 0,
             "failed_test_cases": [],
-            "solution_phase_execution_error": True,
-            "solution_phase_timeout_error": False,
+            "solution_phase_execution_error": not timed_out,
+            "solution_phase_timeout_error": timed_out,
             "solution_phase_assertion_error": False,
         }
 
@@ -180,23 +251,38 @@ def run_instance(instance_data, instance_id, args, thread_idx, ephemeral_user):
 
 
 def process_queue(
-    work_queue, ephemeral_users, results_dict, global_stats_lock, args, thread_idx
+    work_queue,
+    ephemeral_users,
+    results_dict,
+    global_stats_lock,
+    args,
+    thread_idx,
+    router=None,
 ):
     """Worker function to process items from the queue"""
     while True:
         try:
-            # Get the next item from the queue
-            original_idx, instance_data = work_queue.get(timeout=1)
+            # Get the next item: from the shared queue in its order, or from the
+            # dispatcher, which only hands out instances whose database has a
+            # free copy and reserves that copy
+            if isinstance(work_queue, SharedWorkQueue):
+                original_idx, instance_data = work_queue.get(timeout=1)
+                reservation = None
+            else:
+                original_idx, instance_data, reservation = work_queue.get()
             instance_id = instance_data.get("instance_id", f"instance_{original_idx}")
 
             # Get database name for this instance
             db_name = instance_data.get("db_id", "unknown").upper()
 
-            # Get an ephemeral user for this database
+            # Get an ephemeral user for this database (created on first demand)
             ephemeral_user = None
             try:
                 if db_name in ephemeral_users:
-                    ephemeral_user = ephemeral_users[db_name].get(timeout=60)
+                    # Waits for a free user instead of failing the instance
+                    ephemeral_user = ephemeral_users.get(
+                        db_name, reservation=reservation
+                    )
                 else:
                     # No ephemeral users for this database
                     with global_stats_lock:
@@ -213,15 +299,20 @@ def process_queue(
                             "solution_phase_timeout_error": False,
                             "solution_phase_assertion_error": False,
                         }
+                    if isinstance(work_queue, SharedWorkQueue):
+                        work_queue.complete(original_idx, results_dict[instance_id])
                     work_queue.task_done()
                     continue
-            except queue.Empty:
-                # No ephemeral user available, store error result and continue
+            except Exception as e:
+                # The user could not be created, store error result and continue
+                error_message = (
+                    f"Failed to create ephemeral user for database {db_name}: {e}"
+                )
                 with global_stats_lock:
                     results_dict[instance_id] = {
                         "instance_id": instance_id,
                         "status": "failed",
-                        "error_message": f"No ephemeral user available for database {db_name} (timeout)",
+                        "error_message": error_message,
                         "total_test_cases": len(instance_data.get("test_cases", [])),
                         "passed_test_cases": 0,
                         "failed_test_cases": [],
@@ -229,20 +320,24 @@ def process_queue(
                         "solution_phase_timeout_error": False,
                         "solution_phase_assertion_error": False,
                     }
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, results_dict[instance_id])
                 work_queue.task_done()
                 continue
 
             # Process the instance
             try:
                 result = run_instance(
-                    instance_data, instance_id, args, thread_idx, ephemeral_user
+                    instance_data, instance_id, args, thread_idx, ephemeral_user, router
                 )
                 with global_stats_lock:
                     results_dict[instance_id] = result
+                if isinstance(work_queue, SharedWorkQueue):
+                    work_queue.complete(original_idx, result)
             finally:
                 # Always return the ephemeral user to the queue
                 if ephemeral_user and db_name in ephemeral_users:
-                    ephemeral_users[db_name].put(ephemeral_user)
+                    ephemeral_users.put(db_name, ephemeral_user)
 
             # Mark the task as done
             work_queue.task_done()
@@ -304,6 +399,59 @@ def main():
         default="true",
         help="If 'true', generates an additional difficulty-level performance report.",
     )
+    parser.add_argument(
+        "--db_hosts",
+        type=str,
+        default=None,
+        help="Comma-separated Oracle hosts 'host[:port][@weight]' to shard "
+        "databases across (default: the single configured host).",
+    )
+    parser.add_argument(
+        "--queue_db",
+        type=str,
+        default=None,
+        help="Shared SQLite work queue (e.g. on NFS). When set, instances are "
+        "claimed from the queue so several nodes can split one evaluation.",
+    )
+    parser.add_argument(
+        "--node_id",
+        type=str,
+        default=None,
+        help="Name of this node in the shared queue (default: hostname:pid).",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=900,
+        help="Seconds before work held by an unresponsive node is re-leased.",
+    )
+    parser.add_argument(
+        "--instance_timeout",
+        type=int,
+        default=300,
+        help="Time budget per instance in seconds. Queries still running when "
+        "it runs out are cancelled on the server.",
+    )
+    parser.add_argument(
+        "--master_reset",
+        choices=MASTER_RESET_STRATEGIES,
+        default=FLASHBACK,
+        help="How MASTER tables changed by an instance are restored: flashback "
+        "(FLASHBACK TABLE to the SCN captured before it) or none.",
+    )
+    parser.add_argument(
+        "--max_rows",
+        type=int,
+        default=fetch_limits.MAX_ROWS,
+        help="Most rows fetched per query result; results past it are cut and "
+        "the test cases see result_truncated.",
+    )
+    parser.add_argument(
+        "--max_result_bytes",
+        type=int,
+        default=fetch_limits.MAX_BYTES,
+        help="Most bytes of values fetched per query result (approximate).",
+    )
 
     args = parser.parse_args()
 
@@ -330,11 +478,51 @@ def main():
         f"Processing {len(data_list)} instances from {args.jsonl_file} using {args.num_threads} threads"
     )
 
+    # Claim work from a shared queue when several nodes split one evaluation
+    shared_queue = None
+    if args.queue_db:
+        shared_queue = SharedWorkQueue(
+            args.queue_db,
+            node_id=args.node_id,
+            lease_seconds=args.lease_seconds,
+            execution_error_key="solution_phase_execution_error",
+        )
+        added = shared_queue.enqueue(data_list, source=args.jsonl_file)
+        data_list = shared_queue.load_instances()
+        logger.info(
+            f"Using shared queue {args.queue_db} as node {shared_queue.node_id} "
+            f"({added} instances added, {len(data_list)} total)"
+        )
+
+    # Place each database on one host, weighted by its number of instances
+    router = HostRouter(
+        parse_db_hosts(
+            args.db_hosts, DEFAULT_ORACLE_CONFIG["host"], DEFAULT_ORACLE_CONFIG["port"]
+        )
+    )
+    router.place(Counter(item.get("db_id", "unknown").upper() for item in data_list))
+    logger.info(f"Database placement across hosts:\n{router.describe()}")
+
+    # Instances writing the same MASTER table are run one at a time
+    if args.master_reset == FLASHBACK:
+        for host in router.hosts:
+            master_tables[host_key(host)] = master_table_names(
+                logger, host=host["host"], port=host["port"]
+            )
+
+    def cleanup_all_hosts(force=False):
+        for host in router.hosts:
+            cleanup_all_ephemeral_users(
+                logger, force=force, host=host["host"], port=host["port"]
+            )
+
     # Add signal handler for graceful cleanup
     def cleanup_handler(signum, frame):
         logger.info("Received termination signal. Starting cleanup...")
         try:
-            cleanup_all_ephemeral_users(logger)
+            if shared_queue is not None:
+                shared_queue.release_all()
+            cleanup_all_hosts()
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
         finally:
@@ -343,38 +531,60 @@ def main():
     signal.signal(signal.SIGINT, cleanup_handler)
     signal.signal(signal.SIGTERM, cleanup_handler)
 
+    # Status records are streamed to the output JSONL as results arrive
+    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
+
+    def open_result_writer():
+        return StreamingResultWriter(
+            output_jsonl_file,
+            data_list,
+            phase="solution",
+            copy_fields=("original_schema", "preprocess_schema"),
+            logger=logger,
+        )
+
     try:
         # Ensure num_threads is at least 1
         num_threads = max(1, min(args.num_threads, len(data_list)))
 
-        # Collect all needed database names
-        all_databases = set(
-            item.get("db_id", "unknown").upper()
-            for item in data_list
-            if "db_id" in item
-        )
-
-        # Create ephemeral users for each database
-        logger.info(f"Creating ephemeral users for databases: {all_databases}")
-        ephemeral_pool = create_ephemeral_users(all_databases, args.num_threads, logger)
+        # Ephemeral users are created on first demand, on the host that holds
+        # the database; each database gets users in proportion to its instances
+        def create_user(db_name, copy_index):
+            host = router.route(db_name)
+            return create_ephemeral_user(
+                db_name, copy_index, logger, host=host["host"], port=host["port"]
+            )
 
-        # Create queues for ephemeral users, to facilitate parallel processing
-        ephemeral_queues = {}
-        for db_name, users in ephemeral_pool.items():
-            q = queue.Queue()
-            for user in users:
-                q.put(user)
-            ephemeral_queues[db_name] = q
+        ephemeral_pool = LazyEphemeralPool(
+            Counter(
+                item.get("db_id", "unknown").upper()
+                for item in data_list
+                if "db_id" in item
+            ),
+            args.num_threads,
+            create_user,
+            logger=logger,
+        )
+        logger.info(f"Ephemeral user quotas: {ephemeral_pool.describe()}")
 
         try:
-            # Create dictionary to store results, using instance_id as keys
-            results_dict = {}
+            # Collect results keyed by instance_id. A node sharing a queue only
+            # sees part of the run, so its status file is written at merge time.
+            if shared_queue is not None:
+                results_dict = {}
+            else:
+                results_dict = open_result_writer()
             global_stats_lock = threading.Lock()
 
-            # Create work queue
-            work_queue = queue.Queue()
-            for i, data in enumerate(data_list):
-                work_queue.put((i, data))
+            # Create work queue (or claim from the shared one)
+            if shared_queue is not None:
+                work_queue = shared_queue
+            else:
+                work_queue = DatabaseDispatcher(
+                    enumerate(data_list),
+                    ephemeral_pool,
+                    lambda item: item.get("db_id", "unknown").upper(),
+                )
 
             # Start worker threads
             threads = []
@@ -383,11 +593,12 @@ def main():
                     target=process_queue,
                     args=(
                         work_queue,
-                        ephemeral_queues,
+                        ephemeral_pool,
                         results_dict,
                         global_stats_lock,
                         args,
                         i,
+                        router,
                     ),
                 )
                 thread.daemon = True
@@ -398,7 +609,10 @@ def main():
             with tqdm.tqdm(total=len(data_list), desc="Evaluating instances") as pbar:
                 completed = 0
                 while completed < len(data_list):
-                    current_completed = len(results_dict)
+                    if shared_queue is not None:
+                        current_completed = shared_queue.done_count()
+                    else:
+                        current_completed = len(results_dict)
                     if current_completed > completed:
                         pbar.update(current_completed - completed)
                         completed = current_completed
@@ -420,47 +634,25 @@ def main():
             for thread in threads:
                 thread.join(timeout=1)
 
-            # Ensure all instances have results
-            for i, data in enumerate(data_list):
-                instance_id = data.get("instance_id", f"instance_{i}")
-                if instance_id not in results_dict:
-                    logger.error(f"Missing result for instance {instance_id}")
-                    results_dict[instance_id] = {
-                        "instance_id": instance_id,
-                        "status": "failed",
-                        "error_message": "Result missing from processing",
-                        "solution_phase_execution_error": True,
-                        "total_test_cases": len(data.get("test_cases", [])),
-                        "passed_test_cases": 0,
-                        "failed_test_cases": [],
-                    }
-
-            # Organize results in original list order
-            results = []
-            for i, data in enumerate(data_list):
-                instance_id = data.get("instance_id", f"instance_{i}")
-                if instance_id in results_dict:
-                    results.append(results_dict[instance_id])
-
-            # Count statistics
-            number_of_execution_errors = sum(
-                1 for r in results if r.get("solution_phase_execution_error", False)
-            )
-            number_of_timeouts = sum(
-                1 for r in results if r.get("solution_phase_timeout_error", False)
-            )
-            number_of_assertion_errors = sum(
-                1 for r in results if r.get("solution_phase_assertion_error", False)
-            )
-            number_of_issue_sql_errors = sum(
-                1 for r in results if r.get("issue_sql_error", 0) == 1
-            )
-            number_error_unexpected_pass = sum(
-                1 for r in results if r.get("error_phase_unexpected_pass", 0) == 1
-            )
-            total_passed_instances = sum(
-                1 for r in results if r.get("status") == "success"
-            )
+            # Only one node merges the results of a shared queue
+            if shared_queue is not None:
+                shared_queue.close()
+                if not shared_queue.claim_merge():
+                    logger.info("Queue drained; results are merged by another node.")
+                    return
+                logger.info("Queue drained, merging results from all nodes")
+                merged_results = shared_queue.results_by_instance_id()
+                results_dict = open_result_writer()
+                results_dict.update(merged_results)
+
+            # Results in original order; instances without a result are marked failed
+            results = results_dict.finish()
+
+            # Statistics come from the writer's running counters
+            number_of_execution_errors = results_dict.number_of_execution_errors
+            number_of_timeouts = results_dict.number_of_timeouts
+            number_of_assertion_errors = results_dict.number_of_assertion_errors
+            total_passed_instances = results_dict.total_passed_instances
 
             # Generate summary report and output file
             generate_report_and_output(
@@ -493,17 +685,10 @@ def main():
                 )
                 print(f"Difficulty report generated: {report_file_path}")
 
-            # Output JSONL with status
-            output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
-            with open(output_jsonl_file, "w") as f:
-                for i, data in enumerate(data_list):
-                    instance_id = data.get("instance_id", f"instance_{i}")
-                    for result in results:
-                        if result.get("instance_id") == instance_id:
-                            data["status"] = result["status"]
-                            data["error_message"] = result.get("error_message")
-                            f.write(json.dumps(data, ensure_ascii=False) + "\n")
-                            break
+            print("Output with status:", output_jsonl_file)
+
+            if shared_queue is not None:
+                shared_queue.finish_merge()
 
             # Print summary to console
             print("\nEvaluation Summary:")
@@ -526,14 +711,22 @@ def main():
             logger.info("Starting final cleanup...")
             try:
                 # Drop ephemeral users
-                drop_ephemeral_users(ephemeral_pool, logger)
-                cleanup_all_ephemeral_users(logger)
+                logger.info(f"Ephemeral users created: {ephemeral_pool.describe()}")
+                created = ephemeral_pool.created_copies()
+                for host, host_databases in router.group_by_host(sorted(created)):
+                    drop_ephemeral_users(
+                        {db_name: created[db_name] for db_name in host_databases},
+                        logger,
+                        host=host["host"],
+                        port=host["port"],
+                    )
+                cleanup_all_hosts()
                 logger.info("All ephemeral users have been dropped.")
             except Exception as e:
                 logger.error(f"Error during final database cleanup: {e}")
                 # Try emergency cleanup
                 try:
-                    cleanup_all_ephemeral_users(logger, force=True)
+                    cleanup_all_hosts(force=True)
                 except Exception as cleanup_error:
                     logger.error(f"Emergency cleanup also failed: {cleanup_error}")
 
@@ -541,7 +734,7 @@ def main():
         logger.error(f"Fatal error in main: {main_error}")
         # Last attempt to clean up
         try:
-            cleanup_all_ephemeral_users(logger, force=True)
+            cleanup_all_hosts(force=True)
         except:
             pass
         raise
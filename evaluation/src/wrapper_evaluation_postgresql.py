@@ -16,14 +16,31 @@ import time
 import gc
 import concurrent.futures
 import threading
+import queue
+from collections import Counter, deque
+from contextlib import nullcontext
 from datetime import datetime
 from tqdm import tqdm
 from postgresql_utils import (
+    DEFAULT_DB_CONFIG,
+    cancel_backend_queries,
+    create_read_only_replica,
+    drop_ephemeral_dbs,
+    reset_and_restore_database,
+    wait_for_quiescence,
     load_jsonl,
     save_report_and_status,
     generate_category_report,
 )
-from logger import configure_logger
+from logger import configure_logger, PrintLogger
+from host_router import HostRouter, parse_db_hosts
+from work_queue import SharedWorkQueue
+from result_writer import StreamingResultWriter
+from deadline import DEADLINE_GRACE_SECONDS
+from db_scheduler import DbAffinityScheduler
+from straggler import DurationModel, StragglerTracker
+import read_only
+import reset_ledger
 
 # Create a dictionary to store database locks
 db_template_locks = {}
@@ -31,12 +48,12 @@ db_template_locks = {}
 template_locks_lock = threading.Lock()
 
 
-def get_db_lock(db_name):
+def get_db_lock(db_name, host_key=""):
     """Get a lock for the specified database, create one if it doesn't exist"""
     with template_locks_lock:
         # Extract base database name (remove possible _process_N suffix)
         base_db_name = db_name.split("_process_")[0]
-        template_db_name = f"{base_db_name}_template"
+        template_db_name = f"{host_key}/{base_db_name}_template"
 
         if template_db_name not in db_template_locks:
             db_template_locks[template_db_name] = threading.Lock()
@@ -44,14 +61,44 @@ def get_db_lock(db_name):
         return db_template_locks[template_db_name]
 
 
-def run_instance(instance_data, instance_id, args, idx):
-    """Run a single evaluation instance in a separate process"""
+def run_instance(
+    instance_data,
+    instance_id,
+    args,
+    idx,
+    router=None,
+    race=None,
+    spare_db=None,
+    read_only_db=None,
+):
+    """
+    Run a single evaluation instance in a separate process.
+
+    With a race, the evaluator process is registered under the attempt name
+    ("primary", or "backup" when running on spare_db, a spare clone owned by
+    the calling thread) so the winning attempt can kill it. An attempt that
+    lost resets its database and returns None. A backup attempt also returns
+    None when its evaluator failed or timed out, leaving the race to the
+    primary attempt.
+
+    With read_only_db, the instance runs in the read-only lane on that
+    shared replica, without the database lock.
+    """
 
     # Get the database name used by this instance
     db_name = instance_data.get("db_id", "")
     if not db_name:
         print(f"Warning: Instance {instance_id} has no db_id specified.")
         db_name = "unknown_db"
+    attempt = "primary"
+    if spare_db is not None:
+        # The evaluator connects to and resets whatever db_id says
+        attempt = "backup"
+        instance_data = dict(instance_data, db_id=spare_db)
+        db_name = spare_db
+    if read_only_db is not None:
+        instance_data = dict(instance_data, db_id=read_only_db)
+        db_name = read_only_db
 
     # Create temporary file
     with tempfile.NamedTemporaryFile(mode="w", suffix=".jsonl", delete=False) as tmp:
@@ -63,7 +110,10 @@ def run_instance(instance_data, instance_id, args, idx):
 
     # Create log directory in the same location as the input file
     log_dir = os.path.dirname(os.path.abspath(args.jsonl_file))
-    instance_log_file = os.path.join(log_dir, f"instance_{instance_id}.log")
+    log_suffix = "" if spare_db is None else "_backup"
+    if read_only_db is not None:
+        log_suffix = "_readonly"
+    instance_log_file = os.path.join(log_dir, f"instance_{instance_id}{log_suffix}.log")
 
     # Build command to run single instance evaluation script
     cmd = [
@@ -80,38 +130,116 @@ def run_instance(instance_data, instance_id, args, idx):
         "--log_file",
         instance_log_file,  # Pass complete log file path
     ]
-
-    # Get the corresponding database template lock
-    db_lock = get_db_lock(db_name)
-
-    print(f"[Thread {idx}] Running instance {instance_id} with database {db_name}...")
+    db_state = reset_ledger.state(db_name)
+    if read_only_db is not None:
+        # Whatever happens, a shared replica must never be reset
+        cmd += ["--read_only", "lane"]
+        db_state = reset_ledger.SHARED
+
+    # Route the instance to the host that holds its database
+    host = None
+    host_label = ""
+    if router is not None:
+        host = router.route(db_name)
+        host_label = f"{host['host']}:{host['port']}"
+        cmd += ["--db_host", host["host"], "--db_port", str(host["port"])]
+
+    # Get the corresponding database template lock; a spare clone is only
+    # ever used by the thread that owns it, and a read-only replica is
+    # shared by design
+    db_lock = get_db_lock(db_name, host_label)
+    if spare_db is not None or read_only_db is not None:
+        db_lock = nullcontext()
+
+    print(
+        f"[Thread {idx}] Running instance {instance_id} with database {db_name} {host_label}..."
+    )
 
     # Use lock to ensure the same template is not used to create multiple databases simultaneously
     with db_lock:
         print(
             f"[Thread {idx}] Acquired lock for database {db_name}, running process..."
         )
+        # The evaluator cancels its own queries at the deadline; the process
+        # is only killed if it has not finished after the grace period
+        timed_out = False
+        instance_deadline = time.time() + args.instance_timeout
+        proc = subprocess.Popen(
+            cmd + ["--deadline", f"{instance_deadline:.3f}"] + ["--db_state", db_state],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if race is not None and not race.register(attempt, proc):
+            proc.kill()
         try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=False,
-                timeout=300,  # 5 minute timeout per instance
+            stdout, stderr = proc.communicate(
+                timeout=args.instance_timeout + DEADLINE_GRACE_SECONDS
             )
-            success = result.returncode == 0
-            if not success:
+            success = proc.returncode == 0
+            if race is not None and race.lost(attempt):
                 print(
-                    f"[Thread {idx}] Instance {instance_id} process returned error code {result.returncode}"
+                    f"[Thread {idx}] {attempt.capitalize()} attempt at instance {instance_id} lost the race"
                 )
-                print(f"[Thread {idx}] STDOUT: {result.stdout[:500]}...")
-                print(f"[Thread {idx}] STDERR: {result.stderr[:500]}...")
+            elif not success:
+                print(
+                    f"[Thread {idx}] Instance {instance_id} process returned error code {proc.returncode}"
+                )
+                print(f"[Thread {idx}] STDOUT: {stdout[:500]}...")
+                print(f"[Thread {idx}] STDERR: {stderr[:500]}...")
         except subprocess.TimeoutExpired:
-            print(f"[Thread {idx}] Instance {instance_id} timed out after 300 seconds")
+            proc.kill()
+            proc.communicate()
+            print(
+                f"[Thread {idx}] Instance {instance_id} timed out after {args.instance_timeout + DEADLINE_GRACE_SECONDS} seconds"
+            )
             success = False
-
-        # Add a short delay to ensure database operations are completely finished
-        time.sleep(1)
+            timed_out = True
+            # Other instances' sessions on a shared replica are left alone
+            if read_only_db is None:
+                try:
+                    cancel_backend_queries(
+                        db_name,
+                        DEFAULT_DB_CONFIG["password"],
+                        pg_host=host["host"] if host else None,
+                        pg_port=host["port"] if host else None,
+                    )
+                except Exception as e:
+                    print(f"[Thread {idx}] Failed to cancel queries on {db_name}: {e}")
+
+        # Record the state the evaluator left the database in
+        if read_only_db is None:
+            reset_ledger.absorb_output(tmp_output, db_name)
+
+        # The killed evaluator of a lost race did not reset its database
+        if race is not None and race.lost(attempt):
+            try:
+                reset_ledger.reset(
+                    db_name,
+                    lambda: reset_and_restore_database(
+                        db_name,
+                        DEFAULT_DB_CONFIG["password"],
+                        PrintLogger(),
+                        pg_host=host["host"] if host else None,
+                        pg_port=host["port"] if host else None,
+                    ),
+                )
+            except Exception as e:
+                print(f"[Thread {idx}] Failed to reset {db_name}: {e}")
+            for path in (tmp_input, tmp_output):
+                if os.path.exists(path):
+                    os.unlink(path)
+            return None
+
+        # Hand the database over as soon as the evaluator's sessions are gone
+        # (a shared replica is never handed over)
+        if read_only_db is None:
+            wait_for_quiescence(
+                db_name,
+                DEFAULT_DB_CONFIG["password"],
+                pg_host=host["host"] if host else None,
+                pg_port=host["port"] if host else None,
+            )
 
     # Lock has been released, process results
     print(f"[Thread {idx}] Released lock for database {db_name}, processing results...")
@@ -121,6 +249,7 @@ def run_instance(instance_data, instance_id, args, idx):
         try:
             with open(tmp_output, "r") as f:
                 evaluation_result = json.load(f)
+                evaluation_result.pop("reset_ledger", None)
                 # Add instance_id to ensure correct sorting later
                 evaluation_result["instance_id"] = instance_id
                 # Clean up temporary files
@@ -140,11 +269,34 @@ def run_instance(instance_data, instance_id, args, idx):
     except:
         pass
 
+    # A failed backup attempt does not count; the primary attempt still runs
+    if spare_db is not None:
+        return None
+
     # If any step fails, return failure result
     return {
         "instance_id": instance_id,
         "status": "failed",
-        "error_message": "Failed to evaluate instance (process error)",
+        "error_message": (
+            "Instance exceeded its time budget"
+            if timed_out
+            else "Failed to evaluate instance (process error)"
+        ),
+        "total_test_cases": len(instance_data.get("test_cases", [])),
+        "passed_test_cases": 0,
+        "failed_test_cases": [],
+        "evaluation_phase_execution_error": not timed_out,
+        "evaluation_phase_timeout_error": timed_out,
+        "evaluation_phase_assertion_error": False,
+    }
+
+
+def failed_result(instance_data, instance_id, error):
+    """Result recorded when the wrapper itself fails on an instance"""
+    return {
+        "instance_id": instance_id,
+        "status": "failed",
+        "error_message": f"Error in wrapper: {str(error)}",
         "total_test_cases": len(instance_data.get("test_cases", [])),
         "passed_test_cases": 0,
         "failed_test_cases": [],
@@ -154,6 +306,435 @@ def run_instance(instance_data, instance_id, args, idx):
     }
 
 
+class SpareClones:
+    """
+    Spare clones (<db>_process_spareN) for backup attempts at stragglers,
+    created from the database's template on first use and kept for reuse.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._created = {}
+        self._count = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, db_name, host, logger):
+        host_addr = (host["host"], host["port"]) if host else (None, None)
+        key = (host_addr, db_name)
+        with self._lock:
+            if self._idle.get(key):
+                return self._idle[key].popleft()
+            self._count[key] += 1
+            spare_db = f"{db_name}_process_spare{self._count[key]}"
+        # Dropping and re-creating from the template is exactly a reset
+        reset_and_restore_database(
+            spare_db,
+            DEFAULT_DB_CONFIG["password"],
+            logger,
+            pg_host=host_addr[0],
+            pg_port=host_addr[1],
+        )
+        reset_ledger.mark_clean(spare_db, "created from template")
+        with self._lock:
+            self._created.setdefault(host_addr, []).append(spare_db)
+        return spare_db
+
+    def put(self, db_name, host, spare_db):
+        host_addr = (host["host"], host["port"]) if host else (None, None)
+        with self._lock:
+            self._idle.setdefault((host_addr, db_name), deque()).append(spare_db)
+
+    def drop_all(self, logger):
+        with self._lock:
+            created = dict(self._created)
+        for (pg_host, pg_port), spare_dbs in created.items():
+            drop_ephemeral_dbs(
+                {"spare": spare_dbs},
+                DEFAULT_DB_CONFIG["password"],
+                logger,
+                pg_host=pg_host,
+                pg_port=pg_port,
+            )
+
+
+class ReadOnlyReplicas:
+    """
+    One read-only replica (<db>_process_readonly) per database for the
+    read-only lane, created from the template on first use and shared by
+    every worker.
+    """
+
+    def __init__(self):
+        self._replicas = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, db_name, host, logger):
+        host_addr = (host["host"], host["port"]) if host else (None, None)
+        key = (host_addr, db_name)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        # The first worker creates the replica; the others wait for it
+        with key_lock:
+            if key not in self._replicas:
+                replica_db = create_read_only_replica(
+                    db_name,
+                    DEFAULT_DB_CONFIG["password"],
+                    logger,
+                    pg_host=host_addr[0],
+                    pg_port=host_addr[1],
+                )
+                reset_ledger.set_state(replica_db, reset_ledger.SHARED, "replica")
+                self._replicas[key] = replica_db
+            return self._replicas[key]
+
+    def drop_all(self, logger):
+        with self._lock:
+            replicas = dict(self._replicas)
+        for (host_addr, _), replica_db in replicas.items():
+            drop_ephemeral_dbs(
+                {"readonly": [replica_db]},
+                DEFAULT_DB_CONFIG["password"],
+                logger,
+                pg_host=host_addr[0],
+                pg_port=host_addr[1],
+            )
+
+
+def run_in_read_only_lane(
+    data, instance_id, args, thread_idx, router, replicas, logger
+):
+    """
+    Run a read-only instance on its database's shared replica. An instance
+    that attempts a write there is run again on its own database.
+    """
+    db_name = data.get("db_id", "unknown_db")
+    host = router.route(db_name) if router is not None else None
+    try:
+        replica_db = replicas.get(db_name, host, logger)
+    except Exception as e:
+        logger.error(f"Could not create a read-only replica of {db_name}: {e}")
+        return run_instance(data, instance_id, args, thread_idx, router)
+
+    result = run_instance(
+        data, instance_id, args, thread_idx, router, read_only_db=replica_db
+    )
+    violation = result.pop("read_only_violation", None)
+    if violation is None:
+        return result
+    logger.info(
+        f"Instance {instance_id} attempted a write in the read-only lane "
+        f"({violation}); running it on {db_name}"
+    )
+    return run_instance(data, instance_id, args, thread_idx, router)
+
+
+def record_result(results_dict, instance_id, result, pbar, pbar_lock):
+    results_dict[instance_id] = result
+    with pbar_lock:
+        pbar.update(1)
+
+
+def process_affinity_queue(
+    scheduler,
+    tracker,
+    spares,
+    read_only_lane,
+    replicas,
+    args,
+    thread_idx,
+    router,
+    logger,
+    results_dict,
+    pbar,
+    pbar_lock,
+):
+    """
+    Worker loop: drain the read-only lane, then run the instances of one
+    database at a time until none are left, then back up stragglers until
+    nothing is running
+    """
+    while True:
+        try:
+            original_idx, data = read_only_lane.popleft()
+        except IndexError:
+            break
+        instance_id = data.get("instance_id", f"instance_{original_idx}")
+        try:
+            result = run_in_read_only_lane(
+                data, instance_id, args, thread_idx, router, replicas, logger
+            )
+        except Exception as e:
+            logger.error(f"Error processing instance {instance_id}: {e}")
+            result = failed_result(data, instance_id, e)
+        record_result(results_dict, instance_id, result, pbar, pbar_lock)
+        gc.collect()
+
+    while True:
+        item = scheduler.next(thread_idx)
+        if item is None:
+            break
+        original_idx, data = item
+        instance_id = data.get("instance_id", f"instance_{original_idx}")
+        race = tracker.start(instance_id, data)
+        try:
+            result = run_instance(
+                data, instance_id, args, thread_idx, router, race=race
+            )
+        except Exception as e:
+            logger.error(f"Error processing instance {instance_id}: {e}")
+            result = failed_result(data, instance_id, e)
+        # None means a backup attempt won and has recorded the result
+        if result is not None and race.finish("primary"):
+            record_result(results_dict, instance_id, result, pbar, pbar_lock)
+        tracker.done(race)
+        gc.collect()
+
+    if tracker.enabled:
+        speculate_on_stragglers(
+            tracker,
+            spares,
+            args,
+            thread_idx,
+            router,
+            logger,
+            results_dict,
+            pbar,
+            pbar_lock,
+        )
+
+
+def speculate_on_stragglers(
+    tracker, spares, args, thread_idx, router, logger, results_dict, pbar, pbar_lock
+):
+    """
+    Run a second attempt at instances that have run far beyond their
+    expected duration, on a spare clone; the first attempt to finish wins
+    """
+    while True:
+        race = tracker.claim_straggler()
+        if race is None:
+            # Re-check whenever an instance finishes, or every few seconds
+            if not tracker.wait(5):
+                return
+            continue
+
+        db_name = race.instance_data.get("db_id", "unknown_db")
+        host = router.route(db_name) if router is not None else None
+        try:
+            spare_db = spares.get(db_name, host, logger)
+        except Exception as e:
+            logger.error(f"Could not create a spare clone of {db_name}: {e}")
+            continue
+
+        logger.info(
+            f"Instance {race.instance_id} has run {time.time() - race.started:.0f}s "
+            f"(expected {race.expected:.0f}s); starting a backup attempt on {spare_db}"
+        )
+        try:
+            result = run_instance(
+                race.instance_data,
+                race.instance_id,
+                args,
+                thread_idx,
+                router,
+                race=race,
+                spare_db=spare_db,
+            )
+        except Exception as e:
+            logger.error(f"Backup attempt at instance {race.instance_id} failed: {e}")
+            result = None
+        finally:
+            spares.put(db_name, host, spare_db)
+
+        # None unless the backup attempt read a result from its evaluator
+        if result is not None and race.finish("backup"):
+            tracker.record_backup_win()
+            logger.info(f"Backup attempt won for instance {race.instance_id}")
+            record_result(results_dict, race.instance_id, result, pbar, pbar_lock)
+
+
+def evaluate_with_affinity(data_list, args, num_threads, router, logger, results_dict):
+    """
+    Evaluate all instances on this node, keeping each worker on one database
+    until that database's instances are done. Instances whose SQL is all
+    read-only go first, concurrently, on one shared read-only replica per
+    database. Workers with nothing left to do re-run stragglers on spare
+    clones.
+    """
+    read_only_lane = deque()
+    cloned = []
+    for original_idx, data in enumerate(data_list):
+        if args.read_only_lane == "on" and read_only.instance_is_read_only(
+            data, args.mode, "postgresql"
+        ):
+            read_only_lane.append((original_idx, data))
+        else:
+            cloned.append((original_idx, data))
+    if read_only_lane:
+        logger.info(f"Read-only lane: {len(read_only_lane)} instances")
+    scheduler = DbAffinityScheduler(cloned)
+    durations = DurationModel(
+        args.duration_history
+        or f"{os.path.splitext(args.jsonl_file)[0]}_durations.json"
+    )
+    tracker = StragglerTracker(
+        durations,
+        slowdown=args.speculation_slowdown,
+        min_seconds=args.speculation_min_seconds,
+    )
+    spares = SpareClones()
+    replicas = ReadOnlyReplicas()
+    pbar_lock = threading.Lock()
+    try:
+        with tqdm(total=len(data_list), desc="Evaluating instances") as pbar:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=num_threads
+            ) as executor:
+                workers = [
+                    executor.submit(
+                        process_affinity_queue,
+                        scheduler,
+                        tracker,
+                        spares,
+                        read_only_lane,
+                        replicas,
+                        args,
+                        thread_idx,
+                        router,
+                        logger,
+                        results_dict,
+                        pbar,
+                        pbar_lock,
+                    )
+                    for thread_idx in range(num_threads)
+                ]
+                for worker in workers:
+                    worker.result()
+    finally:
+        spares.drop_all(logger)
+        replicas.drop_all(logger)
+        durations.save()
+    if tracker.speculated:
+        logger.info(
+            f"Backup attempts at stragglers: {tracker.speculated}, "
+            f"won by the backup: {tracker.backup_wins}"
+        )
+
+
+def evaluate_locally(data_list, args, num_threads, router, logger, results_dict):
+    """Evaluate all instances on this node, storing results in results_dict"""
+    if args.schedule == "affinity":
+        evaluate_with_affinity(
+            data_list, args, num_threads, router, logger, results_dict
+        )
+        return
+    print(
+        "Round-robin schedule: no straggler speculation or read-only lane "
+        "(they need --schedule affinity)"
+    )
+
+    # Round robin: preprocess and group instances by database
+    # This allows arranging instances that use the same database in different batches
+    db_groups = {}
+    for i, data in enumerate(data_list):
+        db_name = data.get("db_id", "unknown")
+        if db_name not in db_groups:
+            db_groups[db_name] = []
+        db_groups[db_name].append((i, data))
+
+    # Create cyclically assigned list
+    ordered_instances = []
+    while any(len(group) > 0 for group in db_groups.values()):
+        for db_name in list(db_groups.keys()):
+            if db_groups[db_name]:
+                ordered_instances.append(db_groups[db_name].pop(0))
+
+    # Process instances in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # Submit tasks
+        future_to_instance = {
+            executor.submit(
+                run_instance,
+                data,
+                data.get("instance_id", f"instance_{original_idx}"),
+                args,
+                thread_idx,  # Pass thread index for logging
+                router,
+            ): (original_idx, data.get("instance_id", f"instance_{original_idx}"))
+            for thread_idx, (original_idx, data) in enumerate(ordered_instances)
+        }
+
+        # Process completed results
+        for future in tqdm(
+            concurrent.futures.as_completed(future_to_instance),
+            desc="Evaluating instances",
+            total=len(data_list),
+        ):
+            original_idx, instance_id = future_to_instance[future]
+            try:
+                result = future.result()
+                # Store result, using original index to ensure correct sorting
+                results_dict[instance_id] = result
+            except Exception as e:
+                logger.error(f"Error processing instance {instance_id}: {e}")
+                # Add failure result
+                results_dict[instance_id] = failed_result(
+                    data_list[original_idx], instance_id, e
+                )
+
+            # Force garbage collection after each instance completes
+            gc.collect()
+
+
+def process_shared_queue(shared_queue, args, thread_idx, router, logger):
+    """Worker loop: claim instances from the shared queue until it is drained"""
+    while True:
+        try:
+            original_idx, data = shared_queue.get()
+        except queue.Empty:
+            break
+
+        instance_id = data.get("instance_id", f"instance_{original_idx}")
+        try:
+            result = run_instance(data, instance_id, args, thread_idx, router)
+        except Exception as e:
+            logger.error(f"Error processing instance {instance_id}: {e}")
+            result = failed_result(data, instance_id, e)
+        shared_queue.complete(original_idx, result)
+        gc.collect()
+
+
+def evaluate_from_shared_queue(
+    shared_queue, data_list, args, num_threads, router, logger
+):
+    """
+    Evaluate instances claimed from a queue shared with other nodes. Returns
+    {instance_id: result} for the whole run if this node is elected to merge
+    the results, otherwise None.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        workers = [
+            executor.submit(
+                process_shared_queue, shared_queue, args, thread_idx, router, logger
+            )
+            for thread_idx in range(num_threads)
+        ]
+        with tqdm(total=len(data_list), desc="Evaluating instances") as pbar:
+            while not all(worker.done() for worker in workers):
+                pbar.update(shared_queue.done_count() - pbar.n)
+                time.sleep(1)
+        for worker in workers:
+            worker.result()
+
+    shared_queue.close()
+    if not shared_queue.claim_merge():
+        logger.info("Queue drained; results are merged by another node.")
+        return None
+    logger.info("Queue drained, merging results from all nodes")
+    return shared_queue.results_by_instance_id()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Wrapper script to run PostgreSQL evaluation cases using multiple threads."
@@ -199,6 +780,78 @@ def main():
         default="true",
         help="If 'true', generates an additional difficulty-level performance report.",
     )
+    parser.add_argument(
+        "--db_hosts",
+        type=str,
+        default=None,
+        help="Comma-separated PostgreSQL hosts 'host[:port][@weight]' to shard "
+        "databases across (default: the single configured host).",
+    )
+    parser.add_argument(
+        "--queue_db",
+        type=str,
+        default=None,
+        help="Shared SQLite work queue (e.g. on NFS). When set, instances are "
+        "claimed from the queue so several nodes can split one evaluation.",
+    )
+    parser.add_argument(
+        "--node_id",
+        type=str,
+        default=None,
+        help="Name of this node in the shared queue (default: hostname:pid).",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=900,
+        help="Seconds before work held by an unresponsive node is re-leased.",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=["affinity", "round_robin"],
+        default="round_robin",
+        help="'affinity' keeps each worker on one database until its instances "
+        "are done; 'round_robin' interleaves databases across workers. "
+        "Straggler speculation (--speculation_slowdown) and the read-only lane "
+        "(--read_only_lane) only run with 'affinity'. Compare the two with "
+        "run/benchmark_schedule.sh.",
+    )
+    parser.add_argument(
+        "--instance_timeout",
+        type=int,
+        default=300,
+        help="Time budget per instance in seconds. Queries still running when "
+        "it runs out are cancelled on the server.",
+    )
+    parser.add_argument(
+        "--speculation_slowdown",
+        type=float,
+        default=2.0,
+        help="With the affinity schedule, once no work is left to hand out, "
+        "re-run an instance on a spare clone when it has run this many times "
+        "its expected duration (0 disables speculative re-execution).",
+    )
+    parser.add_argument(
+        "--speculation_min_seconds",
+        type=float,
+        default=30.0,
+        help="Never re-run an instance that has run for less than this.",
+    )
+    parser.add_argument(
+        "--duration_history",
+        type=str,
+        default=None,
+        help="JSON file of per-instance durations from earlier runs, updated "
+        "after each run (default: <jsonl base>_durations.json).",
+    )
+    parser.add_argument(
+        "--read_only_lane",
+        choices=["on", "off"],
+        default="on",
+        help="With the affinity schedule, run instances whose SQL is all "
+        "read-only concurrently on one shared read-only replica per database "
+        "instead of on the database itself.",
+    )
 
     args = parser.parse_args()
 
@@ -225,112 +878,74 @@ def main():
         f"Processing {len(data_list)} instances from {args.jsonl_file} using {args.num_threads} threads"
     )
 
+    # Claim work from a shared queue when several nodes split one evaluation
+    shared_queue = None
+    if args.queue_db:
+        shared_queue = SharedWorkQueue(
+            args.queue_db,
+            node_id=args.node_id,
+            lease_seconds=args.lease_seconds,
+            execution_error_key="evaluation_phase_execution_error",
+        )
+        added = shared_queue.enqueue(data_list, source=args.jsonl_file)
+        data_list = shared_queue.load_instances()
+        logger.info(
+            f"Using shared queue {args.queue_db} as node {shared_queue.node_id} "
+            f"({added} instances added, {len(data_list)} total)"
+        )
+
     # Ensure num_threads is at least 1
     num_threads = max(1, min(args.num_threads, len(data_list)))
 
-    # Preprocess and group instances by database
-    # This allows arranging instances that use the same database in different batches
-    db_groups = {}
-    for i, data in enumerate(data_list):
-        db_name = data.get("db_id", "unknown")
-        if db_name not in db_groups:
-            db_groups[db_name] = []
-        db_groups[db_name].append((i, data))
-
-    # Create cyclically assigned list
-    ordered_instances = []
-    while any(len(group) > 0 for group in db_groups.values()):
-        for db_name in list(db_groups.keys()):
-            if db_groups[db_name]:
-                ordered_instances.append(db_groups[db_name].pop(0))
-
-    # Create dictionary to store results, using instance_id as key to ensure correct sorting
-    results_dict = {}
-
-    # Process instances in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        # Submit tasks
-        future_to_instance = {
-            executor.submit(
-                run_instance,
-                data,
-                data.get("instance_id", f"instance_{original_idx}"),
-                args,
-                thread_idx,  # Pass thread index for logging
-            ): (original_idx, data.get("instance_id", f"instance_{original_idx}"))
-            for thread_idx, (original_idx, data) in enumerate(ordered_instances)
-        }
+    # Place each database on one host, weighted by its number of instances
+    router = HostRouter(
+        parse_db_hosts(
+            args.db_hosts, DEFAULT_DB_CONFIG["host"], DEFAULT_DB_CONFIG["port"]
+        )
+    )
+    router.place(Counter(data.get("db_id", "unknown") for data in data_list))
+    logger.info(f"Database placement across hosts:\n{router.describe()}")
 
-        # Process completed results
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_instance),
-            desc="Evaluating instances",
-            total=len(data_list),
-        ):
-            original_idx, instance_id = future_to_instance[future]
-            try:
-                result = future.result()
-                # Store result, using original index to ensure correct sorting
-                results_dict[instance_id] = result
-            except Exception as e:
-                logger.error(f"Error processing instance {instance_id}: {e}")
-                # Add failure result
-                error_result = {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": f"Error in wrapper: {str(e)}",
-                    "total_test_cases": len(
-                        data_list[original_idx].get("test_cases", [])
-                    ),
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                    "evaluation_phase_execution_error": True,
-                    "evaluation_phase_timeout_error": False,
-                    "evaluation_phase_assertion_error": False,
-                }
-                results_dict[instance_id] = error_result
+    # Status records are streamed to the output JSONL as results arrive
+    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
+    if shared_queue is not None:
+        merged_results = evaluate_from_shared_queue(
+            shared_queue, data_list, args, num_threads, router, logger
+        )
+        if merged_results is None:
+            return
 
-            # Force garbage collection after each instance completes
-            gc.collect()
+    results_dict = StreamingResultWriter(
+        output_jsonl_file,
+        data_list,
+        phase="evaluation",
+        drop_fields=("prompt", "reasoning_content"),
+        logger=logger,
+    )
+    if shared_queue is not None:
+        results_dict.update(merged_results)
+    else:
+        eval_start = time.time()
+        evaluate_locally(data_list, args, num_threads, router, logger, results_dict)
+        eval_seconds = time.time() - eval_start
+        logger.info(
+            f"Evaluated {len(data_list)} instances in {eval_seconds:.1f}s "
+            f"(schedule={args.schedule}, threads={num_threads})"
+        )
+        print(f"Evaluation time: {eval_seconds:.1f}s (schedule={args.schedule})")
 
-    # Sort results according to original order
-    results = []
-    for data in data_list:
-        instance_id = data.get("instance_id", f"instance_{data_list.index(data)}")
-        if instance_id in results_dict:
-            results.append(results_dict[instance_id])
-        else:
-            # This should not happen, but add a fallback
-            logger.error(f"Missing result for instance {instance_id}")
-            results.append(
-                {
-                    "instance_id": instance_id,
-                    "status": "failed",
-                    "error_message": "Result missing from processing",
-                    "evaluation_phase_execution_error": True,
-                    "total_test_cases": len(data.get("test_cases", [])),
-                    "passed_test_cases": 0,
-                    "failed_test_cases": [],
-                }
-            )
+    # Results in original order; instances without a result are marked failed
+    results = results_dict.finish()
 
-    # Compile statistics
-    number_of_execution_errors = sum(
-        1 for r in results if r.get("evaluation_phase_execution_error", False)
-    )
-    number_of_timeouts = sum(
-        1 for r in results if r.get("evaluation_phase_timeout_error", False)
-    )
-    number_of_assertion_errors = sum(
-        1 for r in results if r.get("evaluation_phase_assertion_error", False)
-    )
-    total_passed_instances = sum(1 for r in results if r.get("status") == "success")
+    # Compile statistics from the writer's running counters
+    number_of_execution_errors = results_dict.number_of_execution_errors
+    number_of_timeouts = results_dict.number_of_timeouts
+    number_of_assertion_errors = results_dict.number_of_assertion_errors
+    total_passed_instances = results_dict.total_passed_instances
 
     # Generate summary report
     total_instances = len(results)
-    total_errors = (
-        number_of_execution_errors + number_of_timeouts + number_of_assertion_errors
-    )
+    total_errors = results_dict.total_errors
     overall_accuracy = (
         ((total_instances - total_errors) / total_instances * 100)
         if total_instances > 0
@@ -352,23 +967,13 @@ def main():
         logger,
     )
 
-    print("Overall report generated:", report_file_path)
+    # Resets skipped because the database was known to be clean
+    with open(report_file_path, "a") as f:
+        f.write(f"\n{reset_ledger.summary()}\n")
+    logger.info(reset_ledger.summary())
 
-    # Output JSONL with status
-    output_jsonl_file = f"{base_output_folder}_output_with_status.jsonl"
-    with open(output_jsonl_file, "w") as f:
-        for data in data_list:
-            instance_id = data.get("instance_id")
-            for result in results:
-                if data.get("instance_id") == result.get("instance_id"):
-                    data["status"] = result["status"]
-                    data["error_message"] = result.get("error_message")
-                    # Remove potentially large fields
-                    data.pop("prompt", None)
-                    # data.pop("response", None)
-                    data.pop("reasoning_content", None)
-                    f.write(json.dumps(data, ensure_ascii=False) + "\n")
-                    break
+    print("Overall report generated:", report_file_path)
+    print("Output with status:", output_jsonl_file)
 
     # Generate difficulty level performance report if requested
     if args.report == "true":
@@ -387,6 +992,9 @@ def main():
         )
         print(f"Difficulty report generated: {report_file_path}")
 
+    if shared_queue is not None:
+        shared_queue.finish_merge()
+
     # Print summary to console
     print("\nEvaluation Summary:")
     print(f"Total instances: {total_instances}")
@@ -396,6 +1004,7 @@ def main():
     print(f"Timeouts: {number_of_timeouts}")
     print(f"Assertion errors: {number_of_assertion_errors}")
     print(f"Overall accuracy: {overall_accuracy:.2f}%")
+    print(reset_ledger.summary())
 
     logger.info(
         "=== PostgreSQL Evaluation via Wrapper Script (Multithreaded with DB locking) Completed ==="
@@ -20,10 +20,18 @@ from tqdm import tqdm
 from logger import configure_logger
 from utils import load_jsonl, save_report_and_status
 from sqlite_utils import create_ephemeral_db_copies, drop_ephemeral_dbs, cleanup_all_database_files
+from deadline import DEADLINE_GRACE_SECONDS
+import read_only
+import reset_ledger
 
 
-def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, logger):
-    """Run a single evaluation instance in a separate process"""
+def run_single_instance(
+    instance_data, instance_id, args, ephemeral_db_path, logger, read_only_lane=False
+):
+    """
+    Run a single evaluation instance in a separate process. In the read-only
+    lane, ephemeral_db_path is a template shared with other evaluators.
+    """
 
     # Create temporary input file
     with tempfile.NamedTemporaryFile(mode="w", suffix=".jsonl", delete=False) as tmp:
@@ -54,6 +62,10 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
         "--log_file",
         log_file_path,
     ]
+    db_state = reset_ledger.state(ephemeral_db_path)
+    if read_only_lane:
+        cmd += ["--read_only", "lane"]
+        db_state = reset_ledger.SHARED
 
     # Set up environment with ephemeral database path
     env = os.environ.copy()
@@ -62,14 +74,18 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
     # Log the start
     logger.info(f"Starting instance {instance_id} with DB: {ephemeral_db_path}")
 
+    # The evaluator interrupts its own queries at the deadline; the process
+    # is only killed if it has not finished after the grace period
+    timed_out = False
+    instance_deadline = time.time() + args.instance_timeout
     try:
         # Run the subprocess with timeout
         result = subprocess.run(
-            cmd,
+            cmd + ["--deadline", f"{instance_deadline:.3f}"] + ["--db_state", db_state],
             capture_output=True,
             text=True,
             check=False,
-            timeout=180,  # 3 minute timeout per instance
+            timeout=args.instance_timeout + DEADLINE_GRACE_SECONDS,
             env=env,
         )
 
@@ -81,17 +97,25 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
                 logger.error(f"STDERR: {result.stderr[:300]}...")
 
     except subprocess.TimeoutExpired:
-        logger.error(f"Instance {instance_id} timed out after 180 seconds")
+        logger.error(
+            f"Instance {instance_id} timed out after {args.instance_timeout + DEADLINE_GRACE_SECONDS} seconds"
+        )
         success = False
+        timed_out = True
     except Exception as e:
         logger.error(f"Exception running instance {instance_id}: {e}")
         success = False
 
+    # Record the state the evaluator left the copy in
+    if not read_only_lane:
+        reset_ledger.absorb_output(tmp_output, ephemeral_db_path)
+
     # Process results
     if success and os.path.exists(tmp_output) and os.path.getsize(tmp_output) > 0:
         try:
             with open(tmp_output, "r") as f:
                 evaluation_result = json.load(f)
+                evaluation_result.pop("reset_ledger", None)
                 evaluation_result["instance_id"] = instance_id
                 evaluation_result["_index"] = instance_data.get("_index")
                 logger.info(f"Instance {instance_id} completed successfully")
@@ -113,12 +137,16 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
         "instance_id": instance_id,
         "_index": instance_data.get("_index"),
         "status": "failed",
-        "error_message": "Failed to evaluate instance (subprocess error)",
+        "error_message": (
+            "Instance exceeded its time budget"
+            if timed_out
+            else "Failed to evaluate instance (subprocess error)"
+        ),
         "total_test_cases": len(instance_data.get("test_cases", [])),
         "passed_test_cases": 0,
         "failed_test_cases": [],
-        "evaluation_phase_execution_error": True,
-        "evaluation_phase_timeout_error": False,
+        "evaluation_phase_execution_error": not timed_out,
+        "evaluation_phase_timeout_error": timed_out,
         "evaluation_phase_assertion_error": False,
     }
 
@@ -132,6 +160,32 @@ def process_instances_batch(instances_batch, ephemeral_db_paths, args, logger):
         db_name = instance_data.get(
             "selected_database", instance_data.get("db_id", "unknown")
         )
+
+        # Read-only instances run on the shared template, opened read-only;
+        # one that attempts a write goes through a copy like the others
+        template_path = os.path.join(args.db_dir, db_name, f"{db_name}_template.sqlite")
+        if (
+            args.read_only_lane == "on"
+            and read_only.instance_is_read_only(instance_data, args.mode, "sqlite")
+            and os.path.exists(template_path)
+        ):
+            result = run_single_instance(
+                instance_data,
+                instance_id,
+                args,
+                template_path,
+                logger,
+                read_only_lane=True,
+            )
+            violation = result.pop("read_only_violation", None)
+            if violation is None:
+                results.append(result)
+                continue
+            logger.info(
+                f"Instance {instance_id} attempted a write in the read-only lane "
+                f"({violation}); running it on a copy"
+            )
+
         if db_name in ephemeral_db_paths and ephemeral_db_paths[db_name]:
             ephemeral_db_path = ephemeral_db_paths[db_name][
                 i % len(ephemeral_db_paths[db_name])
@@ -189,6 +243,19 @@ def main():
         default="./sqlite_databases_test",
         help="Path to the directory containing SQLite databases",
     )
+    parser.add_argument(
+        "--instance_timeout",
+        type=int,
+        default=180,
+        help="Time budget per instance in seconds; running queries are interrupted when it runs out",
+    )
+    parser.add_argument(
+        "--read_only_lane",
+        choices=["on", "off"],
+        default="on",
+        help="Run instances whose SQL is all read-only on the shared template, "
+        "opened read-only, instead of on a copy",
+    )
 
     args = parser.parse_args()
 
@@ -250,6 +317,9 @@ def main():
             db_dir=args.db_dir,
         )
         print("✓ Ephemeral database copies created")
+        for paths in ephemeral_db_pool_dict.values():
+            for path in paths:
+                reset_ledger.mark_clean(path, "fresh copy")
     except Exception as e:
         logger.error(f"Failed to create ephemeral database copies: {e}")
         print(f"✗ Error creating ephemeral databases: {e}")
@@ -368,6 +438,7 @@ def main():
     print(f"Timeout errors: {timeout_errors}")
     print(f"Assertion errors: {assertion_errors}")
     print(f"Overall accuracy: {overall_accuracy:.2f}%")
+    print(reset_ledger.summary())
     print("=" * 60)
 
     # Save results
@@ -386,6 +457,10 @@ def main():
             timestamp,
             logger,
         )
+        # Resets skipped because the database was known to be clean
+        with open(report_file_path, "a") as f:
+            f.write(f"\n{reset_ledger.summary()}\n")
+        logger.info(reset_ledger.summary())
         print(f"\nReport saved: {report_file_path}")
     except Exception as e:
         print(f"Error saving report: {e}")